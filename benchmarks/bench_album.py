@@ -0,0 +1,133 @@
+"""
+Relay of WhatsApp photo albums to Telegram: every photo as its own
+sendPhoto (album window 0) versus photos collected by wtalbum.py and sent as
+one sendMediaGroup per album.
+
+Each customer sends --photos photos, one webhook every --interval seconds, as
+WhatsApp delivers an album. The webhooks are passed to wa_point of TGWACOM
+directly, the Graph API and the Bot API are local stand-ins and PostgreSQL is
+the in-memory stand-in. The outgoing limit of the Telegram group is the
+default one (20 messages a minute, bursts of 20) unless --no-rate-limits is
+given. The time is measured from the first webhook until every photo is in
+Telegram. Every mode runs in a fresh interpreter.
+
+Usage: python benchmarks/bench_album.py [--customers 3] [--photos 10] [--interval 0.05] [--windows 0,1] [--no-rate-limits]
+"""
+from sys import executable, path
+from pathlib import Path
+from argparse import ArgumentParser
+from json import dumps, loads
+from subprocess import run
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, sleep
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+path.insert(0, str(ROOT / 'benchmarks'))
+
+WA_NUMBER_ID = '16638298930'
+TG_CHAT_ID = -18489340930
+
+
+def photo_webhook(number, n) -> dict:
+    message = {"from": number, "id": f"wamid.album{number}.{n}", "timestamp": "1700000000", "type": "image",
+               "image": {"id": f"image{number}.{n}", "mime_type": "image/jpeg", "sha256": "0", "caption": f"Photo {n}" if n == 0 else ''}}
+    value = {"messaging_product": "whatsapp", "metadata": {"display_phone_number": "15550000000", "phone_number_id": WA_NUMBER_ID},
+             "contacts": [{"profile": {"name": "Customer"}, "wa_id": number}], "messages": [message]}
+    return {"object": "whatsapp_business_account", "entry": [{"id": "1", "changes": [{"field": "messages", "value": value}]}]}
+
+
+def relay(args) -> None:
+
+    # relay - один замер в отдельном процессе: печатает время, вызовы Bot API и записи в базу
+
+    import logging
+    logging.disable(logging.CRITICAL)
+    from standins import MemoryDB, FakeGraphAPI, FakeTelegramAPI
+    import wtdb
+    wtdb.WTCombotDB = lambda *args_, **kwargs: MemoryDB(latency=0.001)
+    from telebot import apihelper
+    from wtcombot import TGWACOM
+    from wtmetrics import STAGE_SECONDS
+
+    api_settings = {'latency': args.latency_ms / 1000, 'media_size': args.media_size}
+    graph = FakeGraphAPI(**api_settings).start()
+    telegram = FakeTelegramAPI(chat_id=TG_CHAT_ID, **api_settings).start()
+    with TemporaryDirectory() as folder:
+        env = {'WT_COMBOT_WA_NUMBER_ID': WA_NUMBER_ID, 'WT_COMBOT_WA_ACCESS_TOKEN': 'bench', 'WT_COMBOT_WA_VERIFY_TOKEN': 'bench',
+               'WT_COMBOT_TG_BOT_ID': 17546223, 'WT_COMBOT_TG_CHAT_ID': TG_CHAT_ID, 'WT_COMBOT_TG_API_TOKEN': '1:bench',
+               'WT_COMBOT_ALBUM_WINDOW': args.window}
+        if(not args.rate_limits):
+            env.update({'WT_COMBOT_TG_CHAT_RATE': 10 ** 9, 'WT_COMBOT_TG_CHAT_BURST': 10 ** 9})
+        env_file = Path(folder) / 'bench.env'
+        env_file.write_text(''.join(f"{name}={value}\n" for name, value in env.items()))
+        bot = TGWACOM(str(env_file))
+        bot.check_env_variables()
+        bot.setup()
+        apihelper.API_URL, apihelper.FILE_URL = telegram.api_url, telegram.file_url
+        bot.whatsapp_bot.base_url = graph.base_url
+        bot.whatsapp_bot.url = f"{graph.base_url}/{WA_NUMBER_ID}/messages"
+
+        def customer(number):
+            for n in range(args.photos):
+                bot.wa_point(photo_webhook(number, n))
+                sleep(args.interval)
+
+        threads = [Thread(target=customer, args=(f"7999{n:07d}",)) for n in range(args.customers)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # -- фото в телеграме, когда id его сообщения записан в базу --
+        deadline = perf_counter() + args.timeout
+        while len(bot.db.numbers) < args.customers * args.photos and perf_counter() < deadline:
+            sleep(0.01)
+        elapsed = perf_counter() - started
+        writes = {stage: sum(counts[:-1]) for (stage,), counts in STAGE_SECONDS._values.items() if stage.startswith('db_set_message')}
+        bot.close()
+    graph.stop()
+    telegram.stop()
+    print(dumps({'elapsed': elapsed, 'calls': {name: telegram.calls[name] for name in ('sendPhoto', 'sendMediaGroup', 'sendMessage')},
+                 'writes': writes}))
+
+
+def measure(window, args) -> dict:
+    command = [executable, __file__, '--relay', '--window', str(window), '--customers', str(args.customers), '--photos', str(args.photos),
+               '--interval', str(args.interval), '--latency-ms', str(args.latency_ms), '--media-size', str(args.media_size),
+               '--timeout', str(args.timeout)]
+    if(not args.rate_limits):
+        command.append('--no-rate-limits')
+    output = run(command, cwd=ROOT / 'wtcombot', capture_output=True, text=True, check=True).stdout
+    return loads(output.strip().split('\n')[-1])
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--customers', type=int, default=3, help='customers sending an album at the same time')
+    parser.add_argument('--photos', type=int, default=10, help='photos in every album')
+    parser.add_argument('--interval', type=float, default=0.05, help='seconds between the webhooks of one album')
+    parser.add_argument('--windows', default='0,1', help='comma-separated values of WT_COMBOT_ALBUM_WINDOW to measure')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='response time of the API stand-ins')
+    parser.add_argument('--media-size', type=int, default=256 * 1024, help='size of every photo, bytes')
+    parser.add_argument('--no-rate-limits', dest='rate_limits', action='store_false', help='lift the limit of the Telegram group')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for the photos to reach Telegram')
+    parser.add_argument('--relay', action='store_true', help=None)
+    parser.add_argument('--window', type=float, default=0.0, help=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if(args.relay):
+        relay(args)
+        raise SystemExit(0)
+    print(f"{args.customers} customers x {args.photos} photos, a webhook every {args.interval} s, API latency {args.latency_ms:.0f} ms, "
+          f"Telegram group limit {'20/min' if args.rate_limits else 'lifted'}")
+    print(f"\n{'album window':<14} {'seconds':>8} {'sendPhoto':>10} {'sendMediaGroup':>15} {'sendMessage':>12} {'reply-routing writes':>21}")
+    for window in (float(value) for value in args.windows.split(',')):
+        result = measure(window, args)
+        calls = result['calls']
+        print(f"{window:<14g} {result['elapsed']:>8.2f} {calls['sendPhoto']:>10} {calls['sendMediaGroup']:>15} {calls['sendMessage']:>12} "
+              f"{sum(result['writes'].values()):>21}")
@@ -0,0 +1,114 @@
+"""
+Consumer throughput: per-message iteration with a synchronous commit after every
+record (the old consumeData) versus batched poll() with count/interval based
+asynchronous commits.
+
+The broker is a local stand-in that charges COMMIT_RTT seconds for every
+synchronous commit and FETCH_RTT seconds for every fetch round trip.
+
+Usage: python benchmarks/bench_consumer.py [--messages 5000] [--commit-rtt-ms 2]
+"""
+from sys import path
+from argparse import ArgumentParser
+from pathlib import Path
+from collections import namedtuple
+from time import perf_counter, sleep
+
+path.insert(0, str(Path(__file__).resolve().parent.parent / 'wtcombot'))
+
+from kafka.structs import TopicPartition
+
+from wtconsumer import OffsetCommitter, offset_and_metadata
+
+Record = namedtuple('Record', 'topic partition offset value')
+FETCH_RTT = 0.001
+
+
+class LocalBroker():
+
+    # LocalBroker - заглушка KafkaConsumer с задержками сетевых запросов
+
+    def __init__(self, messages, commit_rtt, fetch_size=500):
+        self.tp = TopicPartition('whatsapp', 0)
+        self.records = [Record('whatsapp', 0, offset, {'n': offset}) for offset in range(messages)]
+        self.position = 0
+        self.commit_rtt = commit_rtt
+        self.fetch_size = fetch_size
+        self.committed = 0
+        self.commits = 0
+
+    def __iter__(self):
+        while self.position < len(self.records):
+            if(self.position % self.fetch_size == 0):
+                sleep(FETCH_RTT)
+            self.position += 1
+            yield self.records[self.position - 1]
+
+    def poll(self, timeout_ms=0, max_records=None):
+        if(self.position >= len(self.records)):
+            return {}
+        sleep(FETCH_RTT)
+        batch = self.records[self.position:self.position + (max_records or self.fetch_size)]
+        self.position += len(batch)
+        return {self.tp: batch}
+
+    def commit(self, offsets):
+        sleep(self.commit_rtt)
+        self.commits += 1
+        self.committed = offsets[self.tp].offset
+
+    def commit_async(self, offsets, callback=None):
+        self.commits += 1
+        self.committed = offsets[self.tp].offset
+        if(callback):
+            callback(offsets, None)
+
+
+def relay(data) -> None:
+    pass
+
+
+def per_message(broker) -> None:
+    for msg in broker:
+        relay(msg.value)
+        broker.commit({broker.tp: offset_and_metadata(msg.offset + 1)})
+
+
+def batched(broker, max_records, commit_every, commit_interval, async_commit) -> None:
+    committer = OffsetCommitter(broker, commit_every=commit_every, commit_interval=commit_interval, async_commit=async_commit)
+    while broker.position < len(broker.records):
+        records = broker.poll(max_records=max_records)
+        for tp, messages in records.items():
+            for msg in messages:
+                committer.started(tp, msg.offset)
+                relay(msg.value)
+                committer.done(tp, msg.offset)
+        committer.maybe_commit()
+    committer.close()
+
+
+def run(name, messages, commit_rtt, consume) -> None:
+    broker = LocalBroker(messages, commit_rtt)
+    started = perf_counter()
+    consume(broker)
+    elapsed = perf_counter() - started
+    assert broker.committed == messages, broker.committed
+    print(f"{name:<36} {messages / elapsed:10.0f} msg/s  commits: {broker.commits}")
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=5000, help='messages consumed per mode')
+    parser.add_argument('--commit-rtt-ms', type=float, default=2.0, help='round trip of a synchronous commit, ms')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    messages = args.messages
+    commit_rtt = args.commit_rtt_ms / 1000
+
+    run('per message, sync commit', messages, commit_rtt, per_message)
+    run('batched, sync commit every 100', messages, commit_rtt, lambda b: batched(b, 100, 100, 5.0, False))
+    run('batched, async commit every 100', messages, commit_rtt, lambda b: batched(b, 100, 100, 5.0, True))
+    run('batched 500, async commit every 500', messages, commit_rtt, lambda b: batched(b, 500, 500, 5.0, True))
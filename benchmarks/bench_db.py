@@ -0,0 +1,93 @@
+"""
+Per-message database overhead: a new psycopg2 connection per WhatsApp message
+(the old wa_point behaviour) versus the shared WTCombotDB pool.
+
+Usage: python benchmarks/bench_db.py [--env WT_COMBOT_ENVFILE.env] [--messages 1000]
+Requires the tg_user_messages table from the README. Rows for the synthetic
+numbers used here are deleted at the end.
+"""
+from sys import path
+from argparse import ArgumentParser
+from pathlib import Path
+from os import getenv
+from statistics import mean, quantiles
+from time import perf_counter
+
+path.insert(0, str(Path(__file__).resolve().parent.parent / 'wtcombot'))
+
+from dotenv import load_dotenv
+from psycopg2 import connect as ps_connect
+
+from wtdb import WTCombotDB
+
+FIRST_NUMBER = 70000000000
+
+
+def report(name, timings) -> None:
+    percentiles = quantiles(timings, n=100)
+    p50, p95 = percentiles[49], percentiles[94]
+    print(f"{name:<22} mean {mean(timings) * 1000:7.3f} ms  p50 {p50 * 1000:7.3f} ms  p95 {p95 * 1000:7.3f} ms")
+
+
+def connection_per_message(dsn, messages) -> list[float]:
+    timings = []
+    for i in range(messages):
+        number = FIRST_NUMBER + i % 100
+        started = perf_counter()
+        conn = ps_connect(**dsn)
+        cursor = conn.cursor()
+        cursor.execute('SELECT message_id FROM tg_user_messages WHERE user_number = %s', (number,))
+        old = cursor.fetchone()
+        if(old):
+            cursor.execute('UPDATE tg_user_messages SET message_id = %s WHERE user_number = %s', (i, number))
+        else:
+            cursor.execute('INSERT INTO tg_user_messages VALUES (%s, %s)', (number, i))
+        conn.commit()
+        cursor.close()
+        conn.close()
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def pooled(dsn, messages) -> list[float]:
+    db = WTCombotDB(**dsn, minconn=1, maxconn=2)
+    timings = []
+    try:
+        for i in range(messages):
+            number = FIRST_NUMBER + i % 100
+            started = perf_counter()
+            db.get_message_id(number)
+            db.set_message_id(number, i)
+            timings.append(perf_counter() - started)
+    finally:
+        db.close()
+    return timings
+
+
+def cleanup(dsn) -> None:
+    conn = ps_connect(**dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('DELETE FROM tg_user_messages WHERE user_number >= %s AND user_number < %s', (FIRST_NUMBER, FIRST_NUMBER + 100))
+    conn.commit()
+    conn.close()
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--env', default='WT_COMBOT_ENVFILE.env', help='env file with the database settings')
+    parser.add_argument('--messages', type=int, default=1000, help='messages written per mode')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    load_dotenv(args.env)
+    messages = args.messages
+    dsn = {'dbname': getenv('WT_COMBOT_DB_NAME'), 'user': getenv('WT_COMBOT_DB_USER'),
+           'password': getenv('WT_COMBOT_DB_PASSWORD'), 'host': getenv('WT_COMBOT_DB_HOST', 'localhost'),
+           'port': int(getenv('WT_COMBOT_DB_PORT', 5432))}
+    try:
+        report('connection per message', connection_per_message(dsn, messages))
+        report('WTCombotDB pool', pooled(dsn, messages))
+    finally:
+        cleanup(dsn)
@@ -0,0 +1,374 @@
+"""
+End-to-end load test of the bridge. Synthetic webhooks (texts, media and
+delivery statuses from WhatsApp, replies with texts and files from Telegram)
+are posted over HTTP to the Flask endpoints of main.py, go through the queue
+to the consumers and the TGWACOM pipeline, and are relayed to the other
+messenger.
+
+Nothing leaves the machine: PostgreSQL is replaced by an in-memory store, and
+the Graph API and the Telegram Bot API by local HTTP servers with configurable
+latency and error injection (standins.py). Webhooks are passed to the consumers
+through the in-process queue (--transport local, optionally kept in SQLite with
+--queue-path) or through a Kafka broker (--transport kafka, needs a broker at
+--kafka-servers).
+
+The latency of a message is measured from the webhook POST until its handler
+(wa_point or tg_point) returns, so statuses and failed relays are counted too.
+Outgoing rate limits are lifted unless --rate-limits is given.
+
+Usage: python benchmarks/bench_e2e.py [--requests 2000] [--concurrency 8] [--latency-ms 50] [--jitter-ms 20]
+                                      [--error-rate 0] [--limit-rate 0] [--media-size 65536] [--batch 1]
+                                      [--duplicate-rate 0] [--retry-attempts 5] [--retry-base-delay 0.1]
+                                      [--mix wa:text=40,wa:image=10,...] [--transport local|kafka] [--queue-path FILE]
+                                      [--kafka-servers localhost:9092] [--coalesce-window 0] [--tenants 1] [--rate-limits] [--verbose]
+                                      [--workers 4] [--media-workers 2] [--media-budget BYTES]
+"""
+from sys import path
+from pathlib import Path
+from argparse import ArgumentParser
+from collections import defaultdict
+from json import dump, dumps
+from os import getenv
+from random import Random
+from statistics import quantiles
+from tempfile import NamedTemporaryFile
+from threading import Thread, Lock
+from time import perf_counter, sleep
+import logging
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+
+import requests
+from standins import MemoryDB, FakeGraphAPI, FakeTelegramAPI
+
+WA_NUMBER_ID = '16638298930'
+TG_BOT_ID = 17546223
+TG_CHAT_ID = -18489340930
+DEFAULT_MIX = 'wa:text=40,wa:image=10,wa:document=5,wa:status=15,wa:failed=5,tg:text=15,tg:photo=5,tg:document=5'
+
+
+def parse_args():
+    parser = ArgumentParser(description='End-to-end load test of the bridge against local API stand-ins')
+    parser.add_argument('--requests', type=int, default=2000, help='number of webhooks to send')
+    parser.add_argument('--concurrency', type=int, default=8, help='webhooks posted in parallel')
+    parser.add_argument('--customers', type=int, default=200, help='distinct WhatsApp-users in the traffic')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='base response time of the fake APIs')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='random extra response time of the fake APIs')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with HTTP 500')
+    parser.add_argument('--limit-rate', type=float, default=0.0, help='share of API calls answered with HTTP 429')
+    parser.add_argument('--retry-attempts', type=int, default=5, help='retries of a message after a transient error')
+    parser.add_argument('--retry-base-delay', type=float, default=0.1, help='first retry delay, seconds; doubles with every attempt')
+    parser.add_argument('--db-latency-ms', type=float, default=1.0, help='latency of one database query')
+    parser.add_argument('--media-size', type=int, default=64 * 1024, help='size of every relayed file, bytes')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='share of webhooks delivered twice')
+    parser.add_argument('--batch', type=int, default=1, help='messages and statuses in one WhatsApp webhook')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='content types and their weights')
+    parser.add_argument('--transport', choices=['local', 'kafka'], default='local', help='how webhooks reach the consumers')
+    parser.add_argument('--queue-path', default='', help='SQLite file of the local queue, memory only if empty')
+    parser.add_argument('--kafka-servers', default='localhost:9092', help='Kafka brokers for --transport kafka')
+    parser.add_argument('--coalesce-window', type=float, default=0.0,
+                        help='merge texts of one user sent within this many seconds (their latency then ends when they are queued)')
+    parser.add_argument('--workers', type=int, default=4, help='consumer workers per topic')
+    parser.add_argument('--media-workers', type=int, default=2, help='consumer workers per topic for messages with files, 0 for one lane')
+    parser.add_argument('--media-budget', type=int, default=None, help='bytes of media in flight, 0 for no limit; WT_COMBOT_MEDIA_BUDGET by default')
+    parser.add_argument('--tenants', type=int, default=1, help='WhatsApp numbers and Telegram chats served by the process')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the outgoing rate limits from the env file')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for the pipeline to drain')
+    parser.add_argument('--verbose', action='store_true', help='show the log of the bridge')
+    return parser.parse_args()
+
+
+class Traffic():
+
+    # Traffic - генератор синтетических вебхуков ватсапа и телеграма
+
+    def __init__(self, mix, customers, batch=1, tenants=1, seed=1):
+        self.kinds, self.weights = zip(*[(kind, float(weight)) for kind, weight in (item.split('=') for item in mix.split(','))])
+        self.wa_kinds = [(kind, weight) for kind, weight in zip(self.kinds, self.weights) if kind.startswith('wa:')]
+        self.numbers = [f"7999{n:07d}" for n in range(customers)]
+        self.batch = batch
+        self.tenants = bench_tenants(tenants)
+        self.random = Random(seed)
+
+    def generate(self, n) -> tuple[str, list, bytes]:
+
+        # generate возвращает путь вебхука, пары (id, тип) всех сообщений вебхука и тело вебхука;
+        # при batch > 1 ватсап-вебхук содержит batch сообщений и статусов, как при пакетной доставке
+
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        number = self.random.choice(self.numbers)
+        name, number_id, chat_id = self.random.choice(self.tenants)
+        if(kind.startswith('tg:')):
+            return f"/t/{name}" if name else '/t', [(n, kind)], dumps(self.telegram(kind[3:], n, number, chat_id)).encode('utf-8')
+        kinds = [kind] + self.random.choices(*zip(*self.wa_kinds), k=self.batch - 1)
+        envelope = self.whatsapp(kind[3:], f"{n}", number, number_id)
+        value = envelope['entry'][0]['changes'][0]['value']
+        for index, extra in enumerate(kinds[1:], 1):
+            extra_value = self.whatsapp(extra[3:], f"{n}.{index}", self.random.choice(self.numbers), number_id)['entry'][0]['changes'][0]['value']
+            for field in ('contacts', 'messages', 'statuses'):
+                value.setdefault(field, []).extend(extra_value.get(field, []))
+        return '/w', [(f"wamid.bench{n}" + (f".{index}" if index else ''), kind) for index, kind in enumerate(kinds)], \
+               dumps(envelope).encode('utf-8')
+
+    def whatsapp(self, kind, n, number, number_id=WA_NUMBER_ID) -> dict:
+        value = {"messaging_product": "whatsapp", "metadata": {"display_phone_number": "15550000000", "phone_number_id": number_id}}
+        if(kind in ['status', 'failed']):
+            status = {"id": f"wamid.bench{n}", "status": "delivered", "timestamp": "1700000000", "recipient_id": number}
+            if(kind == 'failed'):
+                status.update(status='failed', errors=[{"code": 131047, "title": "Re-engagement message"}])
+            value['statuses'] = [status]
+        else:
+            message = {"from": number, "id": f"wamid.bench{n}", "timestamp": "1700000000", "type": kind}
+            if(kind == 'text'):
+                message['text'] = {"body": f"Hello, what is the price of item {n}? " * 3}
+            elif(kind == 'image'):
+                message['image'] = {"id": f"image{n}", "mime_type": "image/jpeg", "sha256": "0", "caption": f"Photo {n}"}
+            elif(kind == 'document'):
+                message['document'] = {"id": f"document{n}", "mime_type": "application/pdf", "sha256": "0", "filename": f"order{n}.pdf"}
+            else:
+                raise ValueError(f"Unknown whatsapp content type: {kind}")
+            value['contacts'] = [{"profile": {"name": "Customer"}, "wa_id": number}]
+            value['messages'] = [message]
+        return {"object": "whatsapp_business_account", "entry": [{"id": "1", "changes": [{"field": "messages", "value": value}]}]}
+
+    def telegram(self, kind, n, number, chat_id=TG_CHAT_ID) -> dict:
+        chat = {"id": chat_id, "type": "supergroup", "title": "Operators"}
+        message = {"message_id": n, "date": 1700000000, "chat": chat, "from": {"id": 5, "is_bot": False, "first_name": "Operator"},
+                   "reply_to_message": {"message_id": n - 1, "date": 1700000000, "chat": chat,
+                                        "from": {"id": TG_BOT_ID, "is_bot": True, "first_name": "bot"},
+                                        "text": f"Hello!\n\n~whatsapp Customer +{number} #ID{number}"}}
+        if(kind == 'text'):
+            message['text'] = f"Good afternoon! Your order {n} is ready."
+        elif(kind == 'photo'):
+            message['photo'] = [{"file_id": f"photo{n}", "file_unique_id": f"uphoto{n}", "width": 1280, "height": 960}]
+            message['caption'] = f"Order {n}"
+        elif(kind == 'document'):
+            message['document'] = {"file_id": f"document{n}", "file_unique_id": f"udocument{n}", "file_name": f"invoice{n}.pdf",
+                                   "mime_type": "application/pdf"}
+        else:
+            raise ValueError(f"Unknown telegram content type: {kind}")
+        return {"update_id": n, "message": message}
+
+
+class Recorder():
+
+    # Recorder запоминает время отправки вебхука и время, когда обработчик закончил его разбирать
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sent = {}
+        self.kinds = {}
+        self.latencies = defaultdict(list)
+        self.failed = defaultdict(int)
+        self.started = 0
+        self.finished = 0
+        self.last = 0.0
+
+    def start(self, message_id, kind) -> None:
+        with self.lock:
+            self.sent[message_id] = perf_counter()
+            self.kinds[message_id] = kind
+            self.started += 1
+
+    def done(self, message_id, ok) -> None:
+        now = perf_counter()
+        with self.lock:
+            started = self.sent.pop(message_id, None)
+            if(started is None):
+                return
+            kind = self.kinds[message_id]
+            self.latencies[kind].append(now - started)
+            if(not ok):
+                self.failed[kind] += 1
+            self.finished += 1
+            self.last = now
+
+    def timed(self, handler, get_ids):
+
+        # timed оборачивает wa_point/tg_point, чтобы отметить время окончания обработки.
+        # Сообщение с ошибкой будет повторено, поэтому его время отмечается после успешного повтора или в dead_letter
+
+        def point(data):
+            handler(data)
+            for message_id in get_ids(data):
+                self.done(message_id, True)
+        return point
+
+    def dead_letter(self, topic, data, reason) -> None:
+        for message_id in (whatsapp_ids if topic == 'whatsapp' else telegram_ids)(data):
+            self.done(message_id, False)
+
+
+def whatsapp_ids(data) -> list[str]:
+    value = data['entry'][0]['changes'][0]['value']
+    return [item['id'] for item in value.get('messages', []) + value.get('statuses', [])]
+
+
+def telegram_ids(data) -> list[int]:
+    return [data['update_id']]
+
+
+def bench_tenants(count) -> list[tuple[str, str, int]]:
+
+    # bench_tenants - имя, бизнес-номер и чат клиентов; первый клиент - клиент по умолчанию из файла окружения
+
+    return [('' if i == 0 else f"tenant{i}", str(int(WA_NUMBER_ID) + i), TG_CHAT_ID - i) for i in range(max(1, count))]
+
+
+def write_env(args) -> str:
+    env = {'WT_COMBOT_WA_NUMBER_ID': WA_NUMBER_ID, 'WT_COMBOT_WA_ACCESS_TOKEN': 'bench', 'WT_COMBOT_WA_VERIFY_TOKEN': 'bench',
+           'WT_COMBOT_TG_BOT_ID': TG_BOT_ID, 'WT_COMBOT_TG_CHAT_ID': TG_CHAT_ID, 'WT_COMBOT_TG_API_TOKEN': '1:bench',
+           'WT_COMBOT_HTTP_POOL_MAXSIZE': max(10, args.workers * 2), 'WT_COMBOT_TRANSPORT': args.transport,
+           'WT_COMBOT_QUEUE_PATH': args.queue_path, 'WT_COMBOT_KAFKA_SERVERS': args.kafka_servers,
+           'WT_COMBOT_COALESCE_WINDOW': args.coalesce_window, 'WT_COMBOT_RETRY_ATTEMPTS': args.retry_attempts,
+           'WT_COMBOT_RETRY_BASE_DELAY': args.retry_base_delay}
+    if(not args.rate_limits):
+        env.update({'WT_COMBOT_TG_CHAT_RATE': 10 ** 9, 'WT_COMBOT_TG_CHAT_BURST': 10 ** 9,
+                    'WT_COMBOT_WA_NUMBER_RATE': 10 ** 9, 'WT_COMBOT_WA_NUMBER_BURST': 10 ** 9})
+    if(args.tenants > 1):
+        with NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+            dump([{'name': name, 'wa_number_id': number_id, 'tg_chat_id': chat_id} for name, number_id, chat_id in bench_tenants(args.tenants)], file)
+        env['WT_COMBOT_TENANTS'] = file.name
+    if(args.media_budget is not None):
+        env['WT_COMBOT_MEDIA_BUDGET'] = args.media_budget
+    with NamedTemporaryFile('w', suffix='.env', delete=False) as file:
+        file.writelines(f"{name}={value}\n" for name, value in env.items())
+    return file.name
+
+
+def post_webhooks(url, traffic, recorder, requests_count, concurrency, duplicate_rate=0.0) -> None:
+    numbers = iter(range(1, requests_count + 1))
+    lock = Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                n = next(numbers, None)
+            if(n is None):
+                return
+            route, messages, body = traffic.generate(n)
+            for message_id, kind in messages:
+                recorder.start(message_id, kind)
+            session.post(url + route, data=body, headers={'Content-Type': 'application/json'})
+            # -- повторная доставка того же вебхука, как при ретраях Meta --
+            if(traffic.random.random() < duplicate_rate):
+                session.post(url + route, data=body, headers={'Content-Type': 'application/json'})
+
+    threads = [Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def stage_report(metrics) -> None:
+
+    # stage_report печатает среднее время этапов по гистограмме wtcombot_stage_seconds из /metrics
+    # и счётчики пропущенных повторов вебхуков, повторных попыток и сообщений в dead-letter топиках,
+    # а также наибольший объём файлов в пути
+
+    totals = {'duplicate webhooks skipped': 'wtcombot_duplicates_total', 'retries': 'wtcombot_retries_total',
+              'dead letters': 'wtcombot_dead_letters_total'}
+    sums, counts, values = {}, {}, dict.fromkeys(totals, 0)
+    budget = {}
+    for line in metrics.splitlines():
+        if(line.startswith('wtcombot_media_budget_bytes{')):
+            budget[line.split('"')[1]] = float(line.rsplit(' ', 1)[1])
+        for title, metric in totals.items():
+            if(line.startswith(metric)):
+                values[title] += float(line.rsplit(' ', 1)[1])
+        if(line.startswith('wtcombot_stage_seconds_sum') or line.startswith('wtcombot_stage_seconds_count')):
+            name, value = line.rsplit(' ', 1)
+            stage = name.split('"')[1]
+            (sums if '_sum' in name else counts)[stage] = float(value)
+    print(f"\n{'stage':<30} {'count':>7} {'mean ms':>9}")
+    for stage in sorted(counts):
+        print(f"{stage:<30} {counts[stage]:>7.0f} {sums[stage] / counts[stage] * 1000:>9.1f}")
+    for title, value in values.items():
+        if(value):
+            print(f"{title}: {value:.0f}")
+    if(budget):
+        limit = f"{budget['limit'] / 2 ** 20:.0f} MB" if budget.get('limit') else 'no limit'
+        print(f"media in flight, peak: {budget.get('peak', 0) / 2 ** 20:.1f} MB ({limit})")
+
+
+def report(recorder, started, apis) -> None:
+    elapsed = recorder.last - started
+    print(f"\n{'content type':<14} {'count':>6} {'failed':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind in sorted(recorder.latencies):
+        values = recorder.latencies[kind]
+        cuts = quantiles(values, n=100, method='inclusive') if len(values) > 1 else values * 99
+        p50, p95, p99 = (cuts[q - 1] * 1000 for q in (50, 95, 99))
+        print(f"{kind:<14} {len(values):>6} {recorder.failed[kind]:>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+    all_values = [value for values in recorder.latencies.values() for value in values]
+    cuts = quantiles(all_values, n=100, method='inclusive') if len(all_values) > 1 else all_values * 99
+    print(f"{'all':<14} {len(all_values):>6} {sum(recorder.failed.values()):>6} "
+          f"{cuts[49] * 1000:>9.1f} {cuts[94] * 1000:>9.1f} {cuts[98] * 1000:>9.1f}")
+    print(f"\nthroughput: {recorder.finished / elapsed:.0f} msg/s ({recorder.finished} messages in {elapsed:.2f} s)")
+    for api in apis:
+        print(f"{api.name} API calls: {dict(sorted(api.calls.items()))}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if(not args.verbose):
+        logging.disable(logging.CRITICAL)
+
+    api_settings = {'latency': args.latency_ms / 1000, 'jitter': args.jitter_ms / 1000, 'error_rate': args.error_rate,
+                    'limit_rate': args.limit_rate, 'media_size': args.media_size}
+    graph = FakeGraphAPI(**api_settings).start()
+    telegram = FakeTelegramAPI(chat_id=TG_CHAT_ID, **api_settings).start()
+
+    env_file = write_env(args)
+
+    # -- база заменяется до setup, чтобы её получили и кэши, которые создаются вместе с ботом --
+    import wtdb
+    wtdb.WTCombotDB = lambda *args_, **kwargs: MemoryDB(latency=args.db_latency_ms / 1000)
+
+    import main
+    from telebot import apihelper
+    from werkzeug.serving import make_server
+
+    app = main.create_app(env_file, 'all', start_consumers=False)
+    bridge = app.extensions['wtcombot']
+    bridge.wait_ready()
+    tenants = bridge.tenants
+    apihelper.API_URL, apihelper.FILE_URL = telegram.api_url, telegram.file_url
+    for bot in tenants.bots.values():
+        bot.whatsapp_bot.base_url = graph.base_url
+        bot.whatsapp_bot.url = f"{graph.base_url}/{bot.get_wa_number_id()}/messages"
+
+    recorder = Recorder()
+    bridge.start_consumers({**main.consumer_settings(), 'workers': args.workers, 'media_workers': args.media_workers},
+                           {'whatsapp': recorder.timed(tenants.wa_point, whatsapp_ids), 'telegram': recorder.timed(tenants.tg_point, telegram_ids)})
+    bridge.dead_letters.on_dead_letter = recorder.dead_letter
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"{args.requests} webhooks via {args.transport}{' (' + args.queue_path + ')' if args.queue_path else ''}, "
+          f"concurrency {args.concurrency}, API latency {args.latency_ms:.0f}+{args.jitter_ms:.0f} ms, "
+          f"errors {args.error_rate:.0%}, 429 {args.limit_rate:.0%}" + (f", {args.tenants} tenants" if args.tenants > 1 else ''))
+    started = perf_counter()
+    post_webhooks(f"http://127.0.0.1:{server.server_port}", Traffic(args.mix, args.customers, args.batch, args.tenants), recorder,
+                  args.requests, args.concurrency, args.duplicate_rate)
+    deadline = perf_counter() + args.timeout
+    while recorder.finished < recorder.started and perf_counter() < deadline:
+        sleep(0.05)
+
+    url = f"http://127.0.0.1:{server.server_port}"
+    metrics = requests.get(f"{url}/metrics").text
+    bridge.stop()
+    server.shutdown()
+    graph.stop()
+    telegram.stop()
+    if(args.tenants > 1):
+        Path(getenv('WT_COMBOT_TENANTS')).unlink()
+    Path(env_file).unlink()
+
+    if(recorder.finished < recorder.started):
+        print(f"timed out: {recorder.started - recorder.finished} messages were not processed")
+    report(recorder, started, [graph, telegram])
+    stage_report(metrics)
@@ -0,0 +1,96 @@
+"""
+Webhook ingress throughput (requests per second) of the Flask endpoints in
+main.py, which hand the raw body to Kafka, versus the old endpoints, which
+built a telebot Update, called process_new_updates, parsed the body again with
+get_json() and re-serialized it in the producer.
+
+Kafka is replaced by an in-memory producer stand-in; requests go through the
+Flask test client, so the numbers show the CPU cost of the handlers only.
+
+Usage: python benchmarks/bench_ingress.py [--requests 5000]
+"""
+from sys import path
+from argparse import ArgumentParser
+from pathlib import Path
+from json import dumps
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+path.insert(0, str(ROOT / 'benchmarks'))
+
+import kafka
+
+
+class MemoryProducer():
+
+    # MemoryProducer - заглушка KafkaProducer, которая только сериализует и складывает записи в список
+
+    def __init__(self, value_serializer=None, key_serializer=None, **kwargs):
+        self.value_serializer = value_serializer
+        self.key_serializer = key_serializer
+        self.records = []
+
+    def send(self, topic, value=None, key=None):
+        value = self.value_serializer(value) if self.value_serializer else value
+        key = self.key_serializer(key) if self.key_serializer else key
+        self.records.append((topic, key, value))
+
+    def partitions_for(self, topic):
+        return {0}
+
+
+kafka.KafkaProducer = MemoryProducer
+
+import main
+from flask import Flask, request
+from standins import WA_WEBHOOK, TG_WEBHOOK
+from telebot import TeleBot, types as tb_types
+
+def legacy_app() -> Flask:
+
+    # legacy_app - обработчики вебхуков в том виде, в котором они были до передачи сырого тела в kafka
+
+    app = Flask('legacy')
+    producer = MemoryProducer(value_serializer=lambda v: dumps(v).encode('utf-8'))
+    telegram_bot = TeleBot('1:token', threaded=False)
+
+    @app.route("/w", methods=["POST"])
+    def wa_webhook():
+        producer.send('whatsapp', request.get_json())
+        return ''
+
+    @app.route("/t", methods=["POST"])
+    def tg_webhook():
+        update = tb_types.Update.de_json(request.get_data().decode('utf-8'))
+        telegram_bot.process_new_updates([update])
+        producer.send('telegram', request.get_json())
+        return ''
+
+    return app
+
+
+def run(name, app, route, body, requests) -> None:
+    client = app.test_client()
+    started = perf_counter()
+    for _ in range(requests):
+        client.post(route, data=body, content_type='application/json')
+    elapsed = perf_counter() - started
+    print(f"{name:<26} {requests / elapsed:8.0f} req/s")
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=5000, help='requests per endpoint')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    app = main.create_app(str(ROOT / 'WT_COMBOT_ENVFILE.env'), 'web')
+    app.extensions['wtcombot'].wait_ready()
+    legacy = legacy_app()
+    run('legacy /w (whatsapp)', legacy, '/w', WA_WEBHOOK, args.requests)
+    run('raw    /w (whatsapp)', app, '/w', WA_WEBHOOK, args.requests)
+    run('legacy /t (telegram)', legacy, '/t', TG_WEBHOOK, args.requests)
+    run('raw    /t (telegram)', app, '/t', TG_WEBHOOK, args.requests)
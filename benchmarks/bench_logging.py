@@ -0,0 +1,144 @@
+"""
+Consumer throughput with logging off, with every record written synchronously
+by the consumer threads, and with the queue handler of wtlog.py (every record,
+and sampled as by default).
+
+The consumer threads call wa_point and tg_point of TGWACOM for webhooks that
+need no call to the messengers: batches of WhatsApp delivery statuses and
+Telegram messages of operators that are not replies to the bot. So the time
+is spent in parsing, deduplication, the cache of message ids and logging.
+PostgreSQL is replaced by the in-memory stand-in, the log is written to a
+temporary file. --sink-latency-ms adds a pause to every write of the log, as
+a slow disk or a full pipe to a log collector would. Every mode runs in a
+fresh interpreter.
+
+Usage: python benchmarks/bench_logging.py [--messages 20000] [--threads 2] [--batch 5] [--sink-latency-ms 0]
+"""
+from sys import executable, path
+from pathlib import Path
+from argparse import ArgumentParser
+from json import dumps, loads
+from subprocess import run
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+path.insert(0, str(ROOT / 'benchmarks'))
+
+MODES = {
+    'off': {'WT_COMBOT_LOG_LEVEL': 'WARNING'},
+    'every record, synchronous': {'WT_COMBOT_LOG_ASYNC': 'false', 'WT_COMBOT_LOG_SAMPLE': 'webhook=1,sent=1'},
+    'every record, queue': {'WT_COMBOT_LOG_SAMPLE': 'webhook=1,sent=1'},
+    'sampled, queue (default)': {},
+}
+
+
+def webhooks(count, batch) -> list[tuple[str, bytes]]:
+
+    # webhooks - вебхуки, которые потребитель обрабатывает без запросов к API: статусы доставки и переписка операторов
+
+    from bench_e2e import Traffic, DEFAULT_MIX
+    traffic = Traffic(DEFAULT_MIX, customers=1000, batch=batch)
+    result = []
+    for n in range(count):
+        if(n % 2 == 0):
+            envelope = traffic.whatsapp('status', f"{n}", traffic.random.choice(traffic.numbers))
+            statuses = envelope['entry'][0]['changes'][0]['value']['statuses']
+            statuses.extend(dict(statuses[0], id=f"wamid.bench{n}.{index}") for index in range(1, batch))
+            result.append(('whatsapp', dumps(envelope).encode('utf-8')))
+        else:
+            update = traffic.telegram('text', n, traffic.random.choice(traffic.numbers))
+            update['message']['reply_to_message']['from'] = {"id": 7, "is_bot": False, "first_name": "Operator"}
+            result.append(('telegram', dumps(update).encode('utf-8')))
+    return result
+
+
+def consume(args) -> None:
+
+    # consume - один замер в отдельном процессе: печатает время потоков-потребителей, время дописывания журнала и число строк
+
+    from os import environ
+    from standins import MemoryDB
+    import wtdb
+    wtdb.WTCombotDB = lambda *args_, **kwargs: MemoryDB()
+    from bench_e2e import WA_NUMBER_ID, TG_BOT_ID, TG_CHAT_ID
+    from wtcombot import TGWACOM
+    from wtlog import configure_logging, stop_logging
+    from wtmetrics import LOG_DROPPED
+
+    if(args.sink_latency_ms > 0):
+        import logging
+        from time import sleep
+        flush = logging.StreamHandler.flush
+
+        def slow_flush(handler):
+            flush(handler)
+            sleep(args.sink_latency_ms / 1000)
+
+        logging.StreamHandler.flush = slow_flush
+
+    with TemporaryDirectory() as folder:
+        env_file = Path(folder) / 'bench.env'
+        log_file = Path(folder) / 'bench.log'
+        env_file.write_text(f"WT_COMBOT_WA_NUMBER_ID={WA_NUMBER_ID}\nWT_COMBOT_WA_ACCESS_TOKEN=EAAGbenchtoken\nWT_COMBOT_WA_VERIFY_TOKEN=bench\n"
+                            f"WT_COMBOT_TG_BOT_ID={TG_BOT_ID}\nWT_COMBOT_TG_CHAT_ID={TG_CHAT_ID}\nWT_COMBOT_TG_API_TOKEN=1:bench\n")
+        environ['WT_COMBOT_LOG_FILE'] = str(log_file)
+        configure_logging()
+        bot = TGWACOM(str(env_file))
+        bot.setup()
+        items = webhooks(args.messages, args.batch)
+        points = {'whatsapp': bot.wa_point, 'telegram': bot.tg_point}
+
+        def worker(part):
+            for topic, body in part:
+                points[topic](loads(body))
+
+        threads = [Thread(target=worker, args=(items[i::args.threads],)) for i in range(args.threads)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - started
+        stop_logging()
+        drained = perf_counter() - started
+        lines = sum(1 for _ in open(log_file, encoding='utf-8')) if log_file.exists() else 0
+        bot.close()
+        print(dumps({'elapsed': elapsed, 'drained': drained, 'lines': lines, 'dropped': sum(LOG_DROPPED._values.values())}))
+
+
+def measure(mode, args) -> dict:
+    from os import environ
+    command = [executable, __file__, '--consume', '--messages', str(args.messages), '--threads', str(args.threads), '--batch', str(args.batch),
+               '--sink-latency-ms', str(args.sink_latency_ms)]
+    output = run(command, cwd=ROOT / 'wtcombot', env={**environ, **MODES[mode]}, capture_output=True, text=True, check=True).stdout
+    return loads(output.strip().split('\n')[-1])
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=20000, help='webhooks processed by the consumers')
+    parser.add_argument('--threads', type=int, default=2, help='consumer threads')
+    parser.add_argument('--batch', type=int, default=5, help='statuses in every WhatsApp webhook')
+    parser.add_argument('--sink-latency-ms', type=float, default=0.0, help='pause after every write of a log record')
+    parser.add_argument('--consume', action='store_true', help=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if(args.consume):
+        consume(args)
+        raise SystemExit(0)
+    print(f"{args.messages} webhooks, {args.threads} consumer threads, {args.batch} statuses per WhatsApp webhook, "
+          f"log write latency {args.sink_latency_ms} ms")
+    print(f"\n{'logging':<28} {'webhooks/s':>11} {'vs off':>7} {'log lines':>10} {'dropped':>8} {'drain ms':>9}")
+    baseline = None
+    for mode in MODES:
+        result = measure(mode, args)
+        rate = args.messages / result['elapsed']
+        baseline = baseline or rate
+        print(f"{mode:<28} {rate:>11.0f} {rate / baseline:>7.0%} {result['lines']:>10} {result['dropped']:>8} "
+              f"{(result['drained'] - result['elapsed']) * 1000:>9.0f}")
@@ -0,0 +1,114 @@
+"""
+Preparation of photos from Telegram for WhatsApp (wtprepare.py): photos
+larger than 5 MB and WebP/GIF images are recompressed to JPEG, in the
+consumer thread (--workers 0) or in a process pool.
+
+Consumer threads prepare a stream of camera-sized photos while one more
+thread stands in for the text lane: every 5 ms it parses a webhook and
+measures how late it woke up. With preparation in the consumer threads,
+Python-level work of Pillow competes with the text lane for the GIL; with
+the pool it runs in other processes. The cache row repeats the photos with the
+prepared-image cache warm, as after a transient upload error.
+
+Needs Pillow. Usage: python benchmarks/bench_media.py [--photos 24] [--threads 2] [--workers 0,1,2]
+"""
+from sys import path
+from pathlib import Path
+from argparse import ArgumentParser
+from io import BytesIO
+from json import dumps, loads
+from os import cpu_count
+from statistics import quantiles
+from threading import Thread, Event
+from time import perf_counter, sleep
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+
+from wtprepare import MediaPreparer, WHATSAPP_LIMITS
+
+TEXT_INTERVAL = 0.005
+TEXT_WEBHOOK = dumps({"update_id": 1, "message": {"message_id": 1, "chat": {"id": -100}, "text": "Hello! " * 40}})
+
+
+def photos(count, width, height) -> list[tuple[str, bytes]]:
+
+    # photos - снимки с шумом (сжимаются как настоящие фото): JPEG больше 5 МБ, PNG-скриншоты и WebP
+
+    from PIL import Image, ImageFilter
+    noise = Image.effect_noise((width, height), 64).filter(ImageFilter.GaussianBlur(1))
+    image = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    samples = []
+    for name, fmt, options in (('photos/file.jpg', 'JPEG', {'quality': 98}), ('photos/file.png', 'PNG', {'compress_level': 1}),
+                               ('photos/file.webp', 'WEBP', {'quality': 90})):
+        output = BytesIO()
+        image.save(output, fmt, **options)
+        samples.append((name, output.getvalue()))
+    return [samples[n % len(samples)] for n in range(count)]
+
+
+def text_lane(stop, delays) -> None:
+    while not stop.is_set():
+        planned = perf_counter() + TEXT_INTERVAL
+        sleep(TEXT_INTERVAL)
+        loads(TEXT_WEBHOOK)
+        delays.append(perf_counter() - planned)
+
+
+def run(preparer, items, threads, use_cache=False) -> tuple[float, list[float], int]:
+    stop = Event()
+    delays = []
+    lane = Thread(target=text_lane, args=(stop, delays))
+    sizes = []
+
+    def consumer(part):
+        for n, (name, data) in part:
+            prepared = preparer.prepare(BytesIO(data), name, 'image', key=f"photo{n}" if use_cache else None)
+            sizes.append(prepared.size)
+
+    workers = [Thread(target=consumer, args=(list(enumerate(items))[i::threads],)) for i in range(threads)]
+    lane.start()
+    started = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - started
+    stop.set()
+    lane.join()
+    return elapsed, delays, max(sizes)
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--photos', type=int, default=24, help='photos prepared per mode')
+    parser.add_argument('--threads', type=int, default=2, help='consumer threads')
+    parser.add_argument('--workers', default='0,1,2', help='comma-separated sizes of the process pool, 0 for the consumer threads')
+    parser.add_argument('--size', default='4000x3000', help='photo size in pixels')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    width, height = (int(value) for value in args.size.split('x'))
+    items = photos(args.photos, width, height)
+    print(f"{args.photos} photos {args.size} ({', '.join(f'{name[-4:]} {len(data) / 2 ** 20:.1f} MB' for name, data in items[:3])}), "
+          f"{args.threads} consumer threads, {cpu_count()} CPU cores, limit {WHATSAPP_LIMITS['image'] / 2 ** 20:.0f} MB")
+    print(f"\n{'preparation':<26} {'photos/s':>9} {'max MB':>7} {'text p50 ms':>12} {'text p99 ms':>12}")
+    for workers in (int(value) for value in args.workers.split(',')):
+        preparer = MediaPreparer(workers=workers, cache_bytes=args.photos * WHATSAPP_LIMITS['image'])
+        if(workers):
+            # -- процессы пула запускаются заранее: замер не включает их старт --
+            preparer.prepare(BytesIO(items[2][1]), items[2][0], 'image')
+        rows = [(f"pool, {workers} process{'es' if workers > 1 else ''}" if workers else 'consumer threads', False)]
+        if(workers == 0):
+            rows.append(('prepared-image cache', True))
+        for name, use_cache in rows:
+            if(use_cache):
+                run(preparer, items, args.threads, use_cache=True)
+            elapsed, delays, largest = run(preparer, items, args.threads, use_cache)
+            # -- из кэша фото отдаются быстрее, чем поток текстов успевает проснуться --
+            cuts = quantiles(delays, n=100, method='inclusive') if len(delays) > 1 else None
+            text = f"{cuts[49] * 1000:>12.2f} {cuts[98] * 1000:>12.2f}" if cuts else f"{'-':>12} {'-':>12}"
+            print(f"{name:<26} {args.photos / elapsed:>9.2f} {largest / 2 ** 20:>7.2f} {text}")
+        preparer.close()
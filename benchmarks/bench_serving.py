@@ -0,0 +1,125 @@
+"""
+Webhook ingestion throughput of the two ways to serve main.py: the Flask
+development server started by `python main.py` (one process, debug mode) and
+the pre-fork server started by `python main.py --workers N` (role web, one
+producer per worker process).
+
+Kafka is replaced by a producer stand-in that drops the records, so the
+numbers show the cost of serving the webhooks only. Client processes post
+WhatsApp and Telegram webhooks in turn; connections are kept alive when the
+server allows it. Worker processes can only help when the machine has more
+than one core.
+
+Usage: python benchmarks/bench_serving.py [--requests 20000] [--clients 8] [--workers 1,2,4]
+"""
+from sys import path
+from pathlib import Path
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from multiprocessing import get_context
+from os import cpu_count, devnull, dup2, open as os_open, O_WRONLY
+from socket import socket, create_connection
+from statistics import quantiles
+from time import perf_counter, sleep
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+path.insert(0, str(ROOT / 'benchmarks'))
+
+import kafka
+from standins import NullProducer, WA_WEBHOOK, TG_WEBHOOK
+
+ENVFILE = str(ROOT / 'WT_COMBOT_ENVFILE.env')
+CONTEXT = get_context('fork')
+
+
+def free_port() -> int:
+    with socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(mode, workers, port) -> None:
+
+    # serve запускает сервер так же, как main.py; вывод сервера отбрасывается, но журнал запросов он пишет как обычно
+
+    null = os_open(devnull, O_WRONLY)
+    dup2(null, 1)
+    dup2(null, 2)
+    kafka.KafkaProducer = NullProducer
+    import main
+    if(mode == 'dev'):
+        main.create_app(ENVFILE, 'web').run(host='127.0.0.1', port=port, debug=True, use_reloader=False)
+    else:
+        from wtserve import PreforkServer
+        PreforkServer(lambda: main.create_app(ENVFILE, 'web'), '127.0.0.1', port, workers).serve()
+
+
+def wait_for(port, timeout=30.0) -> None:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def client(port, requests_count, results) -> None:
+    connection = HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/json'}
+    latencies = []
+    for n in range(requests_count):
+        route, body = ('/w', WA_WEBHOOK) if n % 2 == 0 else ('/t', TG_WEBHOOK)
+        started = perf_counter()
+        connection.request('POST', route, body=body, headers=headers)
+        connection.getresponse().read()
+        latencies.append(perf_counter() - started)
+    connection.close()
+    results.put(latencies)
+
+
+def run(mode, workers, requests_count, clients) -> None:
+    port = free_port()
+    server = CONTEXT.Process(target=serve, args=(mode, workers, port))
+    server.start()
+    try:
+        wait_for(port)
+        # -- воркеры поднимаются не одновременно: первые запросы прогревают все процессы --
+        warmup = CONTEXT.Queue()
+        for _ in range(workers * 2):
+            client(port, 20, warmup)
+            warmup.get()
+        results = CONTEXT.Queue()
+        processes = [CONTEXT.Process(target=client, args=(port, requests_count // clients, results)) for _ in range(clients)]
+        started = perf_counter()
+        for process in processes:
+            process.start()
+        latencies = [value for _ in processes for value in results.get()]
+        elapsed = perf_counter() - started
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.join()
+    cuts = quantiles(latencies, n=100, method='inclusive')
+    name = 'dev server (debug)' if mode == 'dev' else f'pre-fork, {workers} workers'
+    print(f"{name:<26} {len(latencies) / elapsed:>8.0f} {cuts[49] * 1000:>9.2f} {cuts[98] * 1000:>9.2f}")
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=20000, help='webhooks per server mode')
+    parser.add_argument('--clients', type=int, default=8, help='client processes')
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated numbers of pre-fork workers to measure')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"{args.requests} webhooks, {args.clients} clients, {cpu_count()} CPU cores")
+    print(f"\n{'server':<26} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    run('dev', 1, args.requests, args.clients)
+    for workers in (int(value) for value in args.workers.split(',')):
+        run('prefork', workers, args.requests, args.clients)
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark of TelegramBot.smart_split against the previous implementation,
+which sliced the remaining text and split/joined every chunk, on 10 KB - 1 MB
+messages. Before timing, both implementations are checked to give the same
+chunks for plain text.
+
+Usage: python benchmarks/bench_split.py
+"""
+from sys import path
+from pathlib import Path
+from random import Random
+from timeit import timeit
+
+path.insert(0, str(Path(__file__).resolve().parent.parent / 'wtcombot'))
+
+from tgbot import TelegramBot, MAX_MESSAGE_LENGTH
+
+POSTSCRIPT = '\n\n<i>~whatsapp</i> <a href="https://wa.me/79990000000">Customer</a> +79990000000 #ID79990000000'
+
+
+def legacy_smart_split(text: str, postscript: str='', chars_per_string: int=MAX_MESSAGE_LENGTH) -> list[str]:
+    def _text_before_last(substr: str) -> str:
+        text_before = substr.join(part.split(substr)[:-1])
+        text_before += substr if(substr != '\n') else ' '
+        return text_before
+
+    chars_per_string -= len(postscript)
+
+    parts = []
+    while chars_per_string > 0:
+        if len(text) < chars_per_string:
+            parts.append(text + postscript)
+            return parts
+
+        part = text[:chars_per_string]
+
+        if "\n" in part: part = _text_before_last("\n")
+        elif ". " in part: part = _text_before_last(". ")
+        elif " " in part: part = _text_before_last(" ")
+
+        if(part not in ['\n', '.', ' ']):
+            parts.append(part + postscript)
+
+        text = text[len(part):]
+
+    return parts
+
+
+def generate(size, seed=1) -> str:
+    random = Random(seed)
+    words = ['price', 'delivery', 'order', 'tomorrow', 'please', 'thank', 'you', 'size', 'colour', 'address']
+    chunks = []
+    length = 0
+    while length < size:
+        word = random.choice(words)
+        separator = random.choices([' ', '. ', '\n'], weights=[20, 3, 1])[0]
+        chunks.append(word + separator)
+        length += len(word) + len(separator)
+    return ''.join(chunks)[:size]
+
+
+if __name__ == "__main__":
+    bot = TelegramBot('1:token')
+    for seed in range(20):
+        text = generate(50_000, seed)
+        assert bot.smart_split(text, POSTSCRIPT) == legacy_smart_split(text, POSTSCRIPT), seed
+
+    for size in (10_000, 100_000, 1_000_000):
+        text = generate(size)
+        number = max(1, 2_000_000 // size)
+        legacy = timeit(lambda: legacy_smart_split(text, POSTSCRIPT), number=number) / number
+        current = timeit(lambda: bot.smart_split(text, POSTSCRIPT), number=number) / number
+        print(f"{size // 1000:>5} KB  legacy {legacy * 1000:9.3f} ms  smart_split {current * 1000:9.3f} ms  x{legacy / current:.1f}")
@@ -0,0 +1,116 @@
+"""
+Cold start of main.py: how long `import main` takes, which heavy libraries it
+loads, and how soon a freshly started process answers the hub.challenge of
+Meta and reports /ready.
+
+Every measurement runs in a new interpreter. The server is started as
+`python main.py <envfile> --role all` with the local queue; the second run
+uses Kafka on a port where no broker listens, so the webhook endpoint must
+answer while the producer is still trying to connect.
+
+Usage: python benchmarks/bench_startup.py [--runs 10]
+"""
+from sys import executable
+from pathlib import Path
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from os import environ
+from socket import socket
+from statistics import median
+from subprocess import Popen, run, DEVNULL
+from time import perf_counter, sleep
+
+ROOT = Path(__file__).resolve().parent.parent
+ENVFILE = str(ROOT / 'WT_COMBOT_ENVFILE.env')
+HEAVY_MODULES = ('flask', 'kafka', 'telebot', 'heyoo', 'psycopg2', 'requests', 'requests_toolbelt')
+VERIFY_TOKEN = 'bench'
+TIMEOUT = 30.0
+
+IMPORT_SCRIPT = f"""
+import sys
+from time import perf_counter
+started = perf_counter()
+import main
+elapsed = perf_counter() - started
+print(elapsed)
+print(', '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+def free_port() -> int:
+    with socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(runs) -> tuple[float, str]:
+    times = []
+    loaded = ''
+    for _ in range(runs):
+        output = run([executable, '-c', IMPORT_SCRIPT], cwd=ROOT / 'wtcombot', capture_output=True, text=True, check=True).stdout
+        elapsed, loaded = output.split('\n')[-3:-1]
+        times.append(float(elapsed))
+    return median(times), loaded
+
+
+def get(port, url) -> tuple[int, bytes]|None:
+    connection = HTTPConnection('127.0.0.1', port, timeout=1)
+    try:
+        connection.request('GET', url)
+        response = connection.getresponse()
+        return response.status, response.read()
+    except OSError:
+        return None
+    finally:
+        connection.close()
+
+
+def measure_server(env, wait_ready=True) -> tuple[float, float|None]:
+
+    # measure_server возвращает время от запуска процесса до ответа на hub.challenge и до /ready = 200
+
+    port = free_port()
+    started = perf_counter()
+    server = Popen([executable, 'main.py', ENVFILE, '--role', 'all', '--port', str(port)], cwd=ROOT / 'wtcombot',
+                   env={**environ, 'WT_COMBOT_WA_VERIFY_TOKEN': VERIFY_TOKEN, **env}, stdout=DEVNULL, stderr=DEVNULL)
+    first_request = ready = None
+    try:
+        deadline = started + TIMEOUT
+        while first_request is None and perf_counter() < deadline:
+            if(get(port, f'/w?hub.verify_token={VERIFY_TOKEN}&hub.challenge=42') == (200, b'42')):
+                first_request = perf_counter() - started
+            else:
+                sleep(0.005)
+        deadline = perf_counter() + 5.0
+        while wait_ready and ready is None and first_request is not None and perf_counter() < deadline:
+            response = get(port, '/ready')
+            if(response and response[0] == 200):
+                ready = perf_counter() - started
+            else:
+                sleep(0.005)
+    finally:
+        server.terminate()
+        server.wait()
+    if(first_request is None):
+        raise RuntimeError("The server did not answer the hub.challenge")
+    return first_request, ready
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='fresh processes per measurement')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    elapsed, loaded = measure_import(args.runs)
+    print(f"import main: {elapsed * 1000:.0f} ms (median of {args.runs}), loaded: {loaded or 'none of ' + ', '.join(HEAVY_MODULES)}")
+    print(f"\n{'transport':<26} {'first request ms':>17} {'ready ms':>9}")
+    # -- без брокера /ready не станет 200, поэтому его не ждём --
+    for name, env, wait_ready in (('local queue', {'WT_COMBOT_TRANSPORT': 'local'}, True),
+                                  ('kafka, broker down', {'WT_COMBOT_TRANSPORT': 'kafka', 'WT_COMBOT_KAFKA_SERVERS': f'127.0.0.1:{free_port()}'}, False)):
+        results = [measure_server(env, wait_ready) for _ in range(args.runs)]
+        first_request = median(result[0] for result in results)
+        ready = f"{median(result[1] for result in results) * 1000:>9.0f}" if wait_ready else f"{'-':>9}"
+        print(f"{name:<26} {first_request * 1000:>17.0f} {ready}")
@@ -0,0 +1,88 @@
+"""
+Cost of serving N business lines (a WhatsApp number and a Telegram chat each):
+N copies of the whole stack, one process per line as before, versus one
+process with N tenants from WT_COMBOT_TENANTS.
+
+Every stack is started in a fresh interpreter with create_app(role 'all') and
+the local queue, PostgreSQL is replaced by the in-memory stand-in. The table
+shows the resident memory and the threads of all processes together, and the
+upper bound of database and HTTP connections they may open.
+
+Usage: python benchmarks/bench_tenants.py [--tenants 1,5,20]
+"""
+from sys import executable, path
+from pathlib import Path
+from argparse import ArgumentParser
+from json import dump, dumps, loads
+from subprocess import run
+from tempfile import TemporaryDirectory
+from threading import active_count
+
+ROOT = Path(__file__).resolve().parent.parent
+path.insert(0, str(ROOT / 'wtcombot'))
+
+WA_NUMBER_ID = 16638298930
+TG_CHAT_ID = -18489340930
+DB_POOL_MAX = 4
+HTTP_POOL_MAXSIZE = 10
+
+
+def write_env(folder, count) -> str:
+    env = {'WT_COMBOT_WA_NUMBER_ID': WA_NUMBER_ID, 'WT_COMBOT_WA_ACCESS_TOKEN': 'bench', 'WT_COMBOT_WA_VERIFY_TOKEN': 'bench',
+           'WT_COMBOT_TG_BOT_ID': 17546223, 'WT_COMBOT_TG_CHAT_ID': TG_CHAT_ID, 'WT_COMBOT_TG_API_TOKEN': '1:bench',
+           'WT_COMBOT_TRANSPORT': 'local', 'WT_COMBOT_DB_POOL_MAX': DB_POOL_MAX, 'WT_COMBOT_HTTP_POOL_MAXSIZE': HTTP_POOL_MAXSIZE}
+    if(count > 1):
+        with open(Path(folder) / 'tenants.json', 'w') as file:
+            dump([{'name': '' if i == 0 else f"tenant{i}", 'wa_number_id': str(WA_NUMBER_ID + i), 'wa_access_token': f"bench{i}",
+                   'tg_chat_id': TG_CHAT_ID - i, 'tg_api_token': f"{i + 1}:bench"} for i in range(count)], file)
+        env['WT_COMBOT_TENANTS'] = 'tenants.json'
+    env_file = Path(folder) / 'bench.env'
+    env_file.write_text(''.join(f"{name}={value}\n" for name, value in env.items()))
+    return str(env_file)
+
+
+def serve(count) -> None:
+
+    # serve поднимает один процесс с count клиентами и печатает его память, потоки и число HTTP-сессий
+
+    import logging
+    logging.disable(logging.CRITICAL)
+    from standins import MemoryDB
+    import wtdb
+    wtdb.WTCombotDB = lambda *args, **kwargs: MemoryDB()
+    import main
+    with TemporaryDirectory() as folder:
+        bridge = main.create_app(write_env(folder, count), 'all').extensions['wtcombot']
+        if(not bridge.wait_ready(30.0)):
+            raise RuntimeError(f"The bridge is not ready: {bridge.readiness()}")
+        rss = next(int(line.split()[1]) for line in Path('/proc/self/status').read_text().splitlines() if line.startswith('VmRSS:'))
+        print(dumps({'tenants': len(bridge.tenants), 'rss_kb': rss, 'threads': active_count(),
+                     'sessions': len(bridge.tenants.resources.sessions)}))
+        bridge.stop()
+
+
+def measure(count) -> dict:
+    output = run([executable, __file__, '--serve', str(count)], cwd=ROOT / 'wtcombot', capture_output=True, text=True, check=True).stdout
+    return loads(output.strip().split('\n')[-1])
+
+
+def parse_args():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tenants', default='1,5,20', help='comma-separated numbers of business lines to measure')
+    parser.add_argument('--serve', type=int, help=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if(args.serve):
+        path.insert(0, str(ROOT / 'benchmarks'))
+        serve(args.serve)
+        raise SystemExit(0)
+    single = measure(1)
+    print(f"{'lines':>5} {'setup':<26} {'processes':>9} {'RSS MB':>8} {'threads':>8} {'DB conn':>8} {'HTTP conn':>10}")
+    for count in (int(value) for value in args.tenants.split(',')):
+        shared = measure(count) if count > 1 else single
+        for name, processes, result in (('stack per line', count, single), ('one process, tenants', 1, shared)):
+            print(f"{count:>5} {name:<26} {processes:>9} {processes * result['rss_kb'] / 1024:>8.1f} {processes * result['threads']:>8} "
+                  f"{processes * DB_POOL_MAX:>8} {processes * result['sessions'] * HTTP_POOL_MAXSIZE:>10}")
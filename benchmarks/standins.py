@@ -0,0 +1,302 @@
+"""
+Local stand-ins for the services the bridge talks to, used by the end-to-end
+benchmark: an in-memory store in place of PostgreSQL, and HTTP servers that
+imitate the Graph API and the Telegram Bot API with configurable latency and
+error injection.
+"""
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from json import dumps
+from random import Random
+from threading import Lock, Thread
+from time import time, sleep
+from urllib.parse import urlsplit
+
+# -- вебхуки с одним текстом из ватсапа и ответом оператора из телеграма --
+WA_WEBHOOK = dumps({"object": "whatsapp_business_account", "entry": [{"id": "1", "changes": [{"field": "messages", "value": {
+    "messaging_product": "whatsapp", "metadata": {"display_phone_number": "15550000000", "phone_number_id": "16638298930"},
+    "contacts": [{"profile": {"name": "Customer"}, "wa_id": "79990000000"}],
+    "messages": [{"from": "79990000000", "id": "wamid.HBgLNzk5OTAwMDAwMDAVAgASGBQzQTg1", "timestamp": "1700000000",
+                  "type": "text", "text": {"body": "Hello! " * 40}}]}}]}]})
+
+TG_WEBHOOK = dumps({"update_id": 100, "message": {"message_id": 10, "date": 1700000000,
+    "from": {"id": 5, "is_bot": False, "first_name": "Operator"}, "chat": {"id": -18489340930, "type": "supergroup", "title": "Chat"},
+    "reply_to_message": {"message_id": 9, "date": 1700000000, "from": {"id": 17546223, "is_bot": True, "first_name": "bot"},
+                         "chat": {"id": -18489340930, "type": "supergroup", "title": "Chat"},
+                         "text": "Hello!\n\n~whatsapp Customer +79990000000 #ID79990000000"},
+    "text": "Good afternoon! " * 20}})
+
+
+class MemoryDB():
+
+    # MemoryDB - заглушка WTCombotDB: те же методы, данные в словарях, задержка запроса задаётся latency
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = {}
+        self.numbers = {}
+        self.media = {}
+        self.seen = {}
+        self.lock = Lock()
+
+    def get_message_id(self, phone_number, tenant='') -> int|None:
+        sleep(self.latency)
+        return self.messages.get((tenant, int(phone_number)))
+
+    def get_message_ids(self, phone_numbers, tenant='') -> dict[int, int]:
+        sleep(self.latency)
+        return {int(number): self.messages[(tenant, int(number))] for number in phone_numbers if (tenant, int(number)) in self.messages}
+
+    def set_message_id(self, phone_number, message_id, tenant='') -> None:
+        sleep(self.latency)
+        with self.lock:
+            self.messages[(tenant, int(phone_number))] = message_id
+
+    def get_message_number(self, message_id, tenant='') -> int|None:
+        sleep(self.latency)
+        return self.numbers.get((tenant, int(message_id)))
+
+    def set_message_numbers(self, message_ids, phone_number, tenant='') -> None:
+        sleep(self.latency)
+        with self.lock:
+            for message_id in message_ids:
+                self.numbers[(tenant, int(message_id))] = int(phone_number)
+
+    def get_media_id(self, media_key, max_age) -> tuple[str, float]|None:
+        sleep(self.latency)
+        row = self.media.get(media_key)
+        if(row and time() - row[1] < max_age):
+            return row[0], time() - row[1]
+        return None
+
+    def set_media_id(self, media_key, media_id) -> None:
+        sleep(self.latency)
+        with self.lock:
+            self.media[media_key] = (media_id, time())
+
+    def delete_expired_media(self, max_age) -> int:
+        with self.lock:
+            expired = [key for key, (_, uploaded_at) in self.media.items() if time() - uploaded_at >= max_age]
+            for key in expired:
+                del self.media[key]
+        return len(expired)
+
+    def get_seen(self, relay_hashes, max_age) -> list[int]:
+        sleep(self.latency)
+        return [relay_hash for relay_hash in relay_hashes if time() - self.seen.get(relay_hash, float('-inf')) < max_age]
+
+    def set_seen(self, relay_hash) -> None:
+        sleep(self.latency)
+        with self.lock:
+            self.seen[relay_hash] = time()
+
+    def delete_expired_seen(self, max_age) -> int:
+        with self.lock:
+            expired = [key for key, seen_at in self.seen.items() if time() - seen_at >= max_age]
+            for key in expired:
+                del self.seen[key]
+        return len(expired)
+
+    def close(self) -> None:
+        pass
+
+
+class NullProducer():
+
+    # NullProducer - заглушка KafkaProducer: записи только считаются
+
+    def __init__(self, **kwargs):
+        self.sent = 0
+
+    def send(self, topic, value=None, key=None):
+        self.sent += 1
+
+    def partitions_for(self, topic):
+        return {0}
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class FakeAPI():
+
+    # FakeAPI - HTTP-сервер, который отвечает как API мессенджера; каждый ответ задерживается
+    # на latency + случайную долю jitter, часть ответов заменяется ошибкой 500 или 429
+
+    def __init__(self, name, latency=0.0, jitter=0.0, error_rate=0.0, limit_rate=0.0, retry_after=1, media_size=64 * 1024, seed=1):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.limit_rate = limit_rate
+        self.retry_after = retry_after
+        self.media_size = media_size
+        self.calls = Counter()
+        self.ids = count(1)
+        self.__random = Random(seed)
+        self.__lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> 'FakeAPI':
+        Thread(target=self.server.serve_forever, name=f'{self.name}-api', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method, path, body) -> tuple[int, dict|bytes, dict]:
+        raise NotImplementedError
+
+    def error(self) -> tuple[int, dict, dict]:
+        raise NotImplementedError
+
+    def limit(self) -> tuple[int, dict, dict]:
+        raise NotImplementedError
+
+    def media(self, name) -> bytes:
+
+        # содержимое файла зависит от имени, чтобы разные файлы не совпадали по хэшу
+
+        prefix = name.encode('utf-8')
+        return prefix + b'\0' * max(0, self.media_size - len(prefix))
+
+    def respond(self, method, path, body) -> tuple[int, dict|bytes, dict]:
+        with self.__lock:
+            delay = self.latency + self.__random.random() * self.jitter
+            draw = self.__random.random()
+        sleep(delay)
+        if(draw < self.limit_rate):
+            self.calls['429'] += 1
+            return self.limit()
+        if(draw < self.limit_rate + self.error_rate):
+            self.calls['500'] += 1
+            return self.error()
+        return self.route(method, path, body)
+
+    def __handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle(self):
+
+                # клиент закрывает соединение, не дочитав ответ с ошибкой на потоковый запрос
+
+                try:
+                    super().handle()
+                except ConnectionResetError:
+                    pass
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def handle_request(self, method):
+                body = self.read_body()
+                status, payload, headers = api.respond(method, urlsplit(self.path).path, body)
+                if(isinstance(payload, bytes)):
+                    data, content_type = payload, 'application/octet-stream'
+                else:
+                    data, content_type = dumps(payload).encode('utf-8'), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_body(self) -> bytes:
+                if(self.headers.get('Transfer-Encoding', '').lower() == 'chunked'):
+                    chunks = []
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0], 16)
+                        chunks.append(self.rfile.read(size + 2)[:size])
+                        if(size == 0):
+                            return b''.join(chunks)
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeGraphAPI(FakeAPI):
+
+    # FakeGraphAPI отвечает на запросы WhatsAppBot: отправка сообщений, загрузка и скачивание медиа
+
+    def __init__(self, **kwargs):
+        super().__init__('graph', **kwargs)
+        self.base_url = f"{self.url}/v15.0"
+
+    def route(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if(method == 'POST' and parts[-1] == 'messages'):
+            self.calls['messages'] += 1
+            return 200, {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.out{next(self.ids)}"}]}, {}
+        if(method == 'POST' and parts[-1] == 'media'):
+            self.calls['media upload'] += 1
+            return 200, {"id": f"media{next(self.ids)}"}, {}
+        if(method == 'GET' and parts[0] == 'download'):
+            self.calls['media download'] += 1
+            return 200, self.media(parts[-1]), {}
+        if(method == 'GET' and len(parts) == 2):
+            self.calls['media url'] += 1
+            return 200, {"url": f"{self.url}/download/{parts[1]}", "id": parts[1], "mime_type": "application/octet-stream",
+                         "file_size": self.media_size}, {}
+        return 404, {"error": {"code": 100, "message": f"Unknown path {path}"}}, {}
+
+    def error(self):
+        return 500, {"error": {"code": 1, "message": "An unknown error occurred"}}, {}
+
+    def limit(self):
+        return 429, {"error": {"code": 130429, "message": "Rate limit hit"}}, {'Retry-After': str(self.retry_after)}
+
+
+class FakeTelegramAPI(FakeAPI):
+
+    # FakeTelegramAPI отвечает на запросы TelegramBot: send*, sendMediaGroup, getFile и скачивание файлов
+
+    def __init__(self, chat_id=-100, **kwargs):
+        super().__init__('telegram', **kwargs)
+        self.chat_id = chat_id
+        self.api_url = f"{self.url}/bot{{0}}/{{1}}"
+        self.file_url = f"{self.url}/file/bot{{0}}/{{1}}"
+
+    def route(self, method, path, body):
+        parts = path.strip('/').split('/')
+        if(parts[0] == 'file'):
+            self.calls['file download'] += 1
+            return 200, self.media(parts[-1]), {}
+        api_method = parts[-1]
+        self.calls[api_method] += 1
+        if(api_method == 'getFile'):
+            file_id = f"file{next(self.ids)}"
+            return 200, {"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id, "file_size": self.media_size,
+                                                "file_path": f"documents/{file_id}.pdf"}}, {}
+        if(api_method == 'sendMediaGroup'):
+            # -- в ответ на альбом приходит по сообщению на каждый файл из multipart-тела --
+            return 200, {"ok": True, "result": [self.message() for _ in range(max(1, body.count(b'Content-Disposition')))]}, {}
+        return 200, {"ok": True, "result": self.message()}, {}
+
+    def message(self) -> dict:
+        return {"message_id": next(self.ids), "date": int(time()), "chat": {"id": self.chat_id, "type": "supergroup"}}
+
+    def error(self):
+        return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}, {}
+
+    def limit(self):
+        return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                     "parameters": {"retry_after": self.retry_after}}, {}
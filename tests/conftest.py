@@ -0,0 +1,5 @@
+from sys import path
+from pathlib import Path
+
+# -- модули бота импортируют друг друга по имени, как при запуске из папки wtcombot --
+path.insert(0, str(Path(__file__).resolve().parent.parent / 'wtcombot'))
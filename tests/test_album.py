@@ -0,0 +1,131 @@
+from threading import Event
+from time import sleep, monotonic
+
+import pytest
+
+from wterror import WTCombotTransientError
+from wtretry import RetryPolicy
+from wtalbum import AlbumCollector, MAX_ALBUM_ITEMS
+
+NUMBER = ('', '79990000000')
+
+
+def collector(send, **kwargs) -> AlbumCollector:
+    return AlbumCollector(send, **kwargs).start()
+
+
+def test_album_is_closed_by_the_timer():
+    sent = []
+    done = Event()
+
+    def send(number, items, name):
+        sent.append((monotonic(), number, list(items)))
+        done.set()
+
+    albums = collector(send, window=0.1)
+    try:
+        started = monotonic()
+        albums.add(NUMBER, 'photo1', 'Customer')
+        sleep(0.05)
+        albums.add(NUMBER, 'photo2', 'Customer')
+        assert done.wait(2)
+        sent_at, number, items = sent[0]
+        # -- окно отсчитывается от первого файла, а не от последнего --
+        assert 0.1 <= sent_at - started < 0.5
+        assert (number, items) == (NUMBER, ['photo1', 'photo2'])
+    finally:
+        albums.stop()
+
+
+def test_album_is_not_larger_than_telegram_allows():
+    sent = []
+    albums = collector(lambda number, items, name: sent.append(list(items)), window=60, max_items=50)
+    try:
+        for n in range(MAX_ALBUM_ITEMS + 1):
+            albums.add(NUMBER, n, 'Customer')
+        assert sent == [list(range(MAX_ALBUM_ITEMS))]
+    finally:
+        albums.stop()
+    assert sent[-1] == [MAX_ALBUM_ITEMS]
+
+
+def test_failed_album_is_retried_then_dead_lettered():
+    error = WTCombotTransientError('sending')
+    failed = []
+
+    def send(number, items, name):
+        raise error
+
+    albums = collector(send, window=0.01, retry_policy=RetryPolicy(attempts=2, base_delay=0.01, max_delay=0.01),
+                       on_failure=lambda number, items, attempts, err: failed.append((number, list(items), attempts, err)))
+    try:
+        albums.add(NUMBER, 'photo1', 'Customer')
+        albums.add(NUMBER, 'photo2', 'Customer')
+        for _ in range(200):
+            if(failed):
+                break
+            sleep(0.01)
+        assert failed == [(NUMBER, ['photo1', 'photo2'], 3, error)]
+    finally:
+        albums.stop()
+
+
+def test_run_parallel_waits_for_every_call():
+    finished = []
+
+    def download(n):
+        if(n == 0):
+            raise ValueError('download failed')
+        sleep(0.05)
+        finished.append(n)
+        return n
+
+    albums = collector(lambda number, items, name: None, window=60)
+    try:
+        assert albums.run_parallel(lambda n: n * 2, [1, 2, 3]) == [2, 4, 6]
+        with pytest.raises(ValueError):
+            albums.run_parallel(download, [0, 1, 2])
+        assert sorted(finished) == [1, 2]
+    finally:
+        albums.stop()
+
+
+def test_file_already_in_the_album_is_not_added_again():
+    sent = []
+    albums = collector(lambda number, items, name: sent.append(list(items)), window=60)
+    try:
+        assert albums.add(NUMBER, 'photo1', 'Customer', key='wamid.1') == 1
+        assert albums.add(NUMBER, 'photo2', 'Customer', key='wamid.2') == 2
+        # -- тот же вебхук пришёл ещё раз, пока альбом собирается --
+        assert albums.add(NUMBER, 'photo1', 'Customer', key='wamid.1') == 0
+        albums.flush(NUMBER)
+        assert sent == [['photo1', 'photo2']]
+        # -- после отправки повтор отсекает дедупликация бота, сборщик ключ уже не держит --
+        assert albums.add(NUMBER, 'photo1', 'Customer', key='wamid.1') == 1
+    finally:
+        albums.stop()
+
+
+def test_retried_album_keeps_its_files_unique():
+    failures = [WTCombotTransientError('sending')]
+    sent = []
+
+    def send(number, items, name):
+        if(failures):
+            raise failures.pop()
+        sent.append(list(items))
+
+    albums = collector(send, window=60, retry_policy=RetryPolicy(attempts=3, base_delay=0.05, max_delay=0.05))
+    try:
+        albums.add(NUMBER, 'photo1', 'Customer', key='wamid.1')
+        albums.flush(NUMBER)
+        # -- вебхук повторяется после временной ошибки другого сообщения, пока альбом ждёт повтора --
+        assert albums.add(NUMBER, 'photo1', 'Customer', key='wamid.1') == 0
+        for _ in range(200):
+            if(sent):
+                break
+            sleep(0.01)
+        assert sent == [['photo1']]
+    finally:
+        albums.stop()
+    assert sent == [['photo1']]
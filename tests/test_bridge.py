@@ -0,0 +1,80 @@
+from os import fork, getpid, waitpid, waitstatus_to_exitcode, _exit
+from threading import Event
+
+import pytest
+
+from main import Bridge, create_app
+from wttenant import TenantRegistry
+
+ENV = {'WT_COMBOT_WA_NUMBER_ID': '16638298930', 'WT_COMBOT_WA_ACCESS_TOKEN': 'test', 'WT_COMBOT_WA_VERIFY_TOKEN': 'test',
+       'WT_COMBOT_TG_BOT_ID': '17546223', 'WT_COMBOT_TG_CHAT_ID': '-18489340930', 'WT_COMBOT_TG_API_TOKEN': '1:test',
+       'WT_COMBOT_TRANSPORT': 'local'}
+
+
+def test_worker_forked_before_the_producer_is_ready_warms_up_again(tmp_path, monkeypatch):
+    for name in ENV:
+        monkeypatch.delenv(name, raising=False)
+    env_file = tmp_path / 'test.env'
+    env_file.write_text(''.join(f"{name}={value}\n" for name, value in ENV.items()))
+    bridge = Bridge(str(env_file))
+    parent = getpid()
+    release = Event()
+    producer = bridge.transport.producer
+
+    def slow_producer():
+        # -- в родителе продюсер не подключается, пока тест его не отпустит --
+        if(getpid() == parent):
+            release.wait(10)
+        return producer()
+
+    monkeypatch.setattr(bridge.transport, 'producer', slow_producer)
+    bridge.warm_up(setup=False, consumers=False)
+    try:
+        pid = fork()
+        if(pid == 0):
+            _exit(0 if bridge.wait_ready(5) and bridge.readiness()['components'] == {'producer': True} else 1)
+        assert not bridge.wait_ready(0)
+        _, status = waitpid(pid, 0)
+        assert waitstatus_to_exitcode(status) == 0
+    finally:
+        release.set()
+    assert bridge.wait_ready(5)
+    bridge.stop()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    for name in ENV:
+        monkeypatch.delenv(name, raising=False)
+    env_file = tmp_path / 'test.env'
+    env_file.write_text(''.join(f"{name}={value}\n" for name, value in ENV.items()))
+    # -- setup бота (база, телеграм) тесту не нужен: продюсер локальной очереди готов сразу --
+    monkeypatch.setattr(TenantRegistry, 'setup', lambda self: None)
+    app = create_app(str(env_file), 'all', start_consumers=False)
+    bridge = app.extensions['wtcombot']
+    assert bridge.wait_ready(5)
+    yield app.test_client(), bridge
+    bridge.stop()
+
+
+@pytest.mark.parametrize('body', [b'', b'   ', b'not json', b'[1, 2]', b'"text"'])
+def test_webhook_that_is_not_a_json_object_is_refused(client, body):
+    client, bridge = client
+    assert client.post('/w', data=body, content_type='application/json').status_code == 400
+    assert client.post('/t', data=body, content_type='application/json').status_code == 400
+    assert bridge.transport.queue('whatsapp').next_offset == 0
+
+
+def test_json_object_is_queued_as_it_is(client):
+    client, bridge = client
+    body = b' \n{"object": "whatsapp_business_account", "entry": []}'
+    assert client.post('/w', data=body, content_type='application/json').status_code == 200
+    assert [record.value for record in bridge.transport.queue('whatsapp').records] == [body]
+
+
+def test_metrics_are_served_in_the_prometheus_format(client):
+    client, bridge = client
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE wtcombot_stage_seconds histogram' in response.get_data(as_text=True)
@@ -0,0 +1,67 @@
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+
+from wtbudget import ByteBudget, BudgetTimeoutError
+
+
+def test_reserve_and_release():
+    budget = ByteBudget(100, timeout=1)
+    with budget.hold(60) as reservation:
+        assert budget.in_use == 60
+        reservation.resize(80)
+        assert budget.in_use == 80
+    assert budget.stats() == {'limit': 100, 'in_use': 0, 'peak': 80, 'waiting': 0}
+
+
+def test_unknown_size_is_counted():
+    budget = ByteBudget(100, unknown_size=30)
+    reservation = budget.acquire(None)
+    assert budget.in_use == 30
+    budget.release(reservation)
+    assert budget.in_use == 0
+
+
+def test_waiting_file_goes_once_bytes_are_released():
+    budget = ByteBudget(100, timeout=2)
+    first = budget.acquire(70)
+    Thread(target=lambda: (sleep(0.05), budget.release(first))).start()
+    started = monotonic()
+    with budget.hold(50):
+        assert monotonic() - started >= 0.04
+        assert budget.in_use == 50
+
+
+def test_timeout():
+    budget = ByteBudget(100, timeout=0.05)
+    reservation = budget.acquire(70)
+    with pytest.raises(BudgetTimeoutError):
+        budget.acquire(50)
+    assert budget.waiting == 0
+    assert budget.in_use == 70
+    budget.release(reservation)
+
+
+def test_file_larger_than_the_budget_goes_alone():
+    budget = ByteBudget(100, timeout=0.05)
+    with budget.hold(500):
+        assert budget.in_use == 500
+        with pytest.raises(BudgetTimeoutError):
+            budget.acquire(1)
+    with budget.hold(500):
+        assert budget.in_use == 500
+
+
+def test_try_acquire_does_not_wait():
+    budget = ByteBudget(100)
+    reservation = budget.acquire(90)
+    assert budget.try_acquire(20) is None
+    assert budget.try_acquire(10).size == 10
+    budget.release(reservation)
+
+
+def test_no_limit_still_counts():
+    budget = ByteBudget(0)
+    with budget.hold(10 ** 9):
+        assert budget.in_use == 10 ** 9
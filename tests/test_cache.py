@@ -0,0 +1,77 @@
+from time import sleep
+from unittest.mock import Mock
+
+from wtcache import LRUCache
+from wtcombot import TGWACOM
+from wtmetrics import CACHE_REQUESTS, CACHE_EVICTIONS
+
+
+def value(metric, *labels):
+    return metric._values.get(labels, 0)
+
+
+def test_hits_misses_and_evictions_are_exported():
+    cache = LRUCache(2, 60, 'test_exported')
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    assert cache.get('missing') is None
+    cache.set('c', 3)
+    # -- 'a' прочитан последним, поэтому вытесняется 'b' --
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert value(CACHE_REQUESTS, 'test_exported', 'hit') == 2
+    assert value(CACHE_REQUESTS, 'test_exported', 'miss') == 2
+    assert value(CACHE_EVICTIONS, 'test_exported') == 1
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 2, 'evictions': 1}
+
+
+def test_expired_entry_is_a_miss_unless_stale():
+    cache = LRUCache(10, 0.01, 'test_expired')
+    cache.set('a', 1)
+    sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.get('a', stale=True) == 1
+    assert value(CACHE_REQUESTS, 'test_expired', 'miss') == 1
+    assert value(CACHE_REQUESTS, 'test_expired', 'hit') == 0
+
+
+def test_metrics_are_rendered_by_cache_name():
+    from wtmetrics import METRICS
+    LRUCache(1, 60, 'test_rendered').get('a')
+    assert 'wtcombot_cache_requests_total{cache="test_rendered",result="miss"} 1' in METRICS.render()
+
+
+def reply_bot(db, ttl=60):
+    bot = TGWACOM.__new__(TGWACOM)
+    bot.name = 'sales'
+    bot.db = db
+    bot.reply_cache = LRUCache(10, ttl, 'test_replies')
+    return bot
+
+
+def test_reply_id_is_read_from_the_database_once():
+    db = Mock(get_message_id=Mock(return_value=100))
+    bot = reply_bot(db)
+    assert bot.get_reply_to_message_id('79990000000') == 100
+    assert bot.get_reply_to_message_id('79990000000') == 100
+    db.get_message_id.assert_called_once_with('79990000000', 'sales')
+
+
+def test_new_reply_id_is_written_through():
+    db = Mock()
+    bot = reply_bot(db)
+    bot.set_reply_to_message_id('79990000000', 100, 101)
+    db.set_message_id.assert_called_once_with('79990000000', 101, 'sales')
+    assert bot.get_reply_to_message_id('79990000000') == 101
+    db.get_message_id.assert_not_called()
+
+
+def test_expired_reply_id_is_used_while_the_database_is_down():
+    db = Mock(get_message_id=Mock(side_effect=ConnectionError('database is down')),
+              get_message_ids=Mock(side_effect=ConnectionError('database is down')))
+    bot = reply_bot(db, ttl=0.01)
+    bot.set_reply_to_message_id('79990000000', None, 101)
+    sleep(0.02)
+    assert bot.get_reply_to_message_id('79990000000') == 101
+    assert bot.get_reply_to_message_ids(['79990000000', '79990000001']) == {'79990000000': 101}
@@ -0,0 +1,215 @@
+from threading import Event, Lock
+from time import sleep
+
+import pytest
+
+from wterror import WTCombotError, WTCombotTransientError
+from wtretry import RetryPolicy
+from wtcoalesce import TextCoalescer
+
+NUMBER = ('', '79990000000')
+
+
+class Recorder():
+
+    # Recorder - send и on_failure для сборщика: запоминает вызовы, первые failures отправок поднимают error
+
+    def __init__(self, failures=0, error=None):
+        self.sent = []
+        self.failed = []
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+        self.done = Event()
+        self.lock = Lock()
+
+    def send(self, number, items, name):
+        with self.lock:
+            self.calls += 1
+            if(self.calls <= self.failures):
+                raise self.error
+            self.sent.append((number, list(items), name))
+        self.done.set()
+
+    def on_failure(self, number, items, attempts, err):
+        self.failed.append((number, list(items), attempts, err))
+        self.done.set()
+
+
+@pytest.fixture
+def policy():
+    return RetryPolicy(attempts=3, base_delay=0.01, max_delay=0.01)
+
+
+def test_texts_are_sent_once_the_window_closes():
+    recorder = Recorder()
+    coalescer = TextCoalescer(recorder.send, window=0.05).start()
+    try:
+        for text in ('one', 'two', 'three'):
+            coalescer.add(NUMBER, text, 'Customer')
+        assert recorder.sent == []
+        assert recorder.done.wait(2)
+        assert recorder.sent == [(NUMBER, ['one', 'two', 'three'], 'Customer')]
+    finally:
+        coalescer.stop()
+
+
+def test_flush_sends_at_once_in_the_calling_thread():
+    recorder = Recorder()
+    coalescer = TextCoalescer(recorder.send, window=60).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        coalescer.add(('', '79990000001'), 'other', 'Other')
+        coalescer.flush(NUMBER)
+        assert recorder.sent == [(NUMBER, ['one'], 'Customer')]
+        coalescer.flush(NUMBER)
+        assert len(recorder.sent) == 1
+    finally:
+        coalescer.stop()
+    assert recorder.sent[-1] == (('', '79990000001'), ['other'], 'Other')
+
+
+def test_max_messages_sends_without_waiting():
+    recorder = Recorder()
+    coalescer = TextCoalescer(recorder.send, window=60, max_messages=2).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        coalescer.add(NUMBER, 'two', 'Customer')
+        coalescer.add(NUMBER, 'three', 'Customer')
+        assert recorder.sent == [(NUMBER, ['one', 'two'], 'Customer')]
+    finally:
+        coalescer.stop()
+    assert recorder.sent[-1] == (NUMBER, ['three'], 'Customer')
+
+
+def test_stop_sends_pending_texts():
+    recorder = Recorder()
+    coalescer = TextCoalescer(recorder.send, window=60).start()
+    coalescer.add(NUMBER, 'one', 'Customer')
+    coalescer.stop()
+    assert recorder.sent == [(NUMBER, ['one'], 'Customer')]
+
+
+def test_transient_error_is_retried(policy):
+    recorder = Recorder(failures=2, error=WTCombotTransientError('sending'))
+    coalescer = TextCoalescer(recorder.send, window=0.01, retry_policy=policy, on_failure=recorder.on_failure).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        assert recorder.done.wait(2)
+        assert recorder.sent == [(NUMBER, ['one'], 'Customer')]
+        assert recorder.calls == 3
+        assert recorder.failed == []
+    finally:
+        coalescer.stop()
+
+
+def test_later_texts_wait_for_the_retry(policy):
+    recorder = Recorder(failures=1, error=WTCombotTransientError('sending'))
+    coalescer = TextCoalescer(recorder.send, window=60, retry_policy=policy, on_failure=recorder.on_failure).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        coalescer.flush(NUMBER)
+        coalescer.add(NUMBER, 'two', 'Customer')
+        coalescer.flush(NUMBER)
+        assert recorder.sent == []
+        for _ in range(200):
+            if(len(recorder.sent) == 2):
+                break
+            sleep(0.01)
+        assert [items for _, items, _ in recorder.sent] == [['one'], ['two']]
+    finally:
+        coalescer.stop()
+
+
+def test_attempts_run_out(policy):
+    error = WTCombotTransientError('sending')
+    recorder = Recorder(failures=10, error=error)
+    coalescer = TextCoalescer(recorder.send, window=0.01, retry_policy=policy, on_failure=recorder.on_failure).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        assert recorder.done.wait(2)
+        assert recorder.failed == [(NUMBER, ['one'], 4, error)]
+        assert recorder.sent == []
+    finally:
+        coalescer.stop()
+
+
+@pytest.mark.parametrize('error', [WTCombotError('content'), ValueError('bad text')])
+def test_other_errors_are_not_retried(policy, error):
+    recorder = Recorder(failures=1, error=error)
+    coalescer = TextCoalescer(recorder.send, window=0.01, retry_policy=policy, on_failure=recorder.on_failure).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer')
+        assert recorder.done.wait(2)
+        assert recorder.failed == [(NUMBER, ['one'], 1, error)]
+        assert recorder.calls == 1
+    finally:
+        coalescer.stop()
+
+
+def test_stop_gives_a_waiting_retry_its_last_attempt():
+    recorder = Recorder(failures=1, error=WTCombotTransientError('sending'))
+    coalescer = TextCoalescer(recorder.send, window=60, retry_policy=RetryPolicy(attempts=3, base_delay=60, max_delay=60),
+                              on_failure=recorder.on_failure).start()
+    coalescer.add(NUMBER, 'one', 'Customer')
+    coalescer.flush(NUMBER)
+    assert recorder.sent == []
+    coalescer.stop()
+    assert recorder.sent == [(NUMBER, ['one'], 'Customer')]
+
+
+def test_a_slow_chat_does_not_hold_up_others():
+    release = Event()
+    sent = []
+
+    def send(number, items, name):
+        if(number == NUMBER):
+            release.wait(2)
+        sent.append(number)
+
+    coalescer = TextCoalescer(send, window=0.01, workers=2).start()
+    try:
+        coalescer.add(NUMBER, 'slow', 'Customer')
+        sleep(0.05)
+        coalescer.add(('', '79990000001'), 'fast', 'Other')
+        for _ in range(200):
+            if(sent):
+                break
+            sleep(0.01)
+        assert sent == [('', '79990000001')]
+    finally:
+        release.set()
+        coalescer.stop()
+
+
+def test_release_waits_for_the_send():
+    recorder = Recorder()
+    released = []
+    coalescer = TextCoalescer(recorder.send, window=60).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer', key='wamid.1', release=lambda: released.append('one'))
+        coalescer.add(NUMBER, 'one', 'Customer', key='wamid.1', release=lambda: released.append('duplicate'))
+        assert released == ['duplicate']
+        coalescer.flush(NUMBER)
+        assert recorder.sent == [(NUMBER, ['one'], 'Customer')]
+        assert released == ['duplicate', 'one']
+    finally:
+        coalescer.stop()
+
+
+def test_release_follows_the_dead_letter(policy):
+    error = WTCombotTransientError('sending')
+    recorder = Recorder(failures=10, error=error)
+    released = []
+    coalescer = TextCoalescer(recorder.send, window=0.01, retry_policy=policy, on_failure=recorder.on_failure).start()
+    try:
+        coalescer.add(NUMBER, 'one', 'Customer', release=lambda: released.append(len(recorder.failed)))
+        assert recorder.done.wait(2)
+        for _ in range(100):
+            if(released):
+                break
+            sleep(0.01)
+        # -- смещение отпускается только после того, как пачка передана в on_failure --
+        assert released == [1]
+    finally:
+        coalescer.stop()
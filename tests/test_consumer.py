@@ -0,0 +1,186 @@
+from threading import Lock
+from time import sleep
+
+import pytest
+
+from wterror import WTCombotTransientError
+from wtconsumer import ConversationWorkerPool, OffsetCommitter, OffsetTracker, hold_offset
+from wtretry import DelayQueue, RetryPolicy
+from wttransport import TopicPartition
+
+TP = TopicPartition('whatsapp', 0)
+OTHER_TP = TopicPartition('whatsapp', 1)
+
+
+def test_committable_waits_for_the_oldest_message():
+    tracker = OffsetTracker()
+    for offset in (10, 11, 12):
+        tracker.started(TP, offset)
+    tracker.done(TP, 12)
+    tracker.done(TP, 11)
+    assert tracker.committable() == {TP: 10}
+    tracker.committed({TP: 10})
+    assert tracker.committable() == {}
+    tracker.done(TP, 10)
+    assert tracker.committable() == {TP: 13}
+
+
+def test_committable_is_kept_per_partition():
+    tracker = OffsetTracker()
+    tracker.started(TP, 5)
+    tracker.started(OTHER_TP, 7)
+    tracker.done(OTHER_TP, 7)
+    assert tracker.committable() == {TP: 5, OTHER_TP: 8}
+    tracker.forget([OTHER_TP])
+    assert tracker.committable() == {TP: 5}
+
+
+class Committer():
+    def __init__(self):
+        self.done_offsets = []
+        self.lock = Lock()
+
+    def done(self, tp, offset) -> None:
+        with self.lock:
+            self.done_offsets.append(offset)
+
+
+class DeadLetters():
+    def __init__(self):
+        self.sent = []
+
+    def send(self, key, tp, offset, value, attempts, err) -> None:
+        self.sent.append((offset, attempts))
+
+
+class Target():
+
+    # Target - обработчик сообщений для пула: failures[value] первых вызовов для value поднимают временную ошибку
+
+    def __init__(self, failures):
+        self.failures = dict(failures)
+        self.handled = []
+        self.lock = Lock()
+
+    def __call__(self, value) -> None:
+        with self.lock:
+            if(self.failures.get(value, 0) > 0):
+                self.failures[value] -= 1
+                raise WTCombotTransientError('sending')
+            self.handled.append(value)
+
+
+@pytest.fixture
+def delay_queue():
+    queue = DelayQueue().start()
+    yield queue
+    queue.stop()
+
+
+def run_pool(target, delay_queue, messages, expected, attempts=3, dead_letters=None):
+    committer = Committer()
+    pool = ConversationWorkerPool(target, committer, workers=2, retry_policy=RetryPolicy(attempts, 0.05, 0.05),
+                                  delay_queue=delay_queue, dead_letters=dead_letters)
+    pool.start()
+    try:
+        for offset, (key, value) in enumerate(messages):
+            pool.submit(key, TP, offset, value)
+        for _ in range(200):
+            if(len(committer.done_offsets) == expected):
+                break
+            sleep(0.01)
+    finally:
+        pool.stop()
+    assert pool.pending() == len(messages) - expected
+    return committer
+
+
+def test_later_messages_wait_for_the_retry(delay_queue):
+    target = Target({'one': 2})
+    messages = [('chat', 'one'), ('chat', 'two'), ('other', 'fast'), ('chat', 'three')]
+    run_pool(target, delay_queue, messages, len(messages))
+    assert [value for value in target.handled if value != 'fast'] == ['one', 'two', 'three']
+    assert target.handled.index('fast') < target.handled.index('one')
+
+
+def test_held_message_can_be_retried_in_turn(delay_queue):
+    target = Target({'one': 1, 'two': 1})
+    messages = [('chat', 'one'), ('chat', 'two'), ('chat', 'three')]
+    run_pool(target, delay_queue, messages, len(messages))
+    assert target.handled == ['one', 'two', 'three']
+
+
+def test_dead_letter_releases_the_conversation(delay_queue):
+    target = Target({'one': 10})
+    dead_letters = DeadLetters()
+    messages = [('chat', 'one'), ('chat', 'two')]
+    committer = run_pool(target, delay_queue, messages, len(messages), attempts=1, dead_letters=dead_letters)
+    assert dead_letters.sent == [(0, 2)]
+    assert target.handled == ['two']
+    assert committer.done_offsets == [0, 1]
+
+
+def test_messages_without_a_key_are_not_held(delay_queue):
+    target = Target({'one': 1})
+    messages = [('', 'one'), ('', 'two'), ('', 'three')]
+    run_pool(target, delay_queue, messages, len(messages))
+    assert sorted(target.handled[:2]) == ['three', 'two']
+    assert target.handled[-1] == 'one'
+
+
+class Consumer():
+    def __init__(self):
+        self.commits = []
+
+    def commit(self, offsets) -> None:
+        self.commits.append({tp: meta.offset for tp, meta in offsets.items()})
+
+
+def test_committer_commits_every_n_messages():
+    consumer = Consumer()
+    committer = OffsetCommitter(consumer, commit_every=3, commit_interval=60, async_commit=False)
+    for offset in range(4):
+        committer.started(TP, offset)
+    for offset in (1, 2):
+        committer.done(TP, offset)
+        committer.maybe_commit()
+    assert consumer.commits == []
+    committer.done(TP, 0)
+    committer.maybe_commit()
+    assert consumer.commits == [{TP: 3}]
+    committer.done(TP, 3)
+    committer.maybe_commit()
+    assert consumer.commits == [{TP: 3}]
+    committer.close()
+    assert consumer.commits == [{TP: 3}, {TP: 4}]
+
+
+
+def test_held_message_is_done_after_its_release(delay_queue):
+    releases = []
+
+    def target(value):
+        if(value == 'collected'):
+            releases.append(hold_offset())
+
+    committer = Committer()
+    pool = ConversationWorkerPool(target, committer, workers=1, retry_policy=RetryPolicy(3, 0.05, 0.05), delay_queue=delay_queue)
+    pool.start()
+    try:
+        pool.submit('chat', TP, 0, 'collected')
+        pool.submit('chat', TP, 1, 'plain')
+        for _ in range(200):
+            if(committer.done_offsets):
+                break
+            sleep(0.01)
+        assert committer.done_offsets == [1]
+        assert pool.pending() == 1
+        releases.pop()()
+        assert committer.done_offsets == [1, 0]
+        assert pool.pending() == 0
+    finally:
+        pool.stop()
+
+
+def test_hold_outside_the_pool_is_none():
+    assert hold_offset() is None
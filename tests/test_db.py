@@ -0,0 +1,149 @@
+from unittest.mock import MagicMock
+
+import pytest
+from psycopg2 import OperationalError
+
+import wtdb
+from wtdb import MIGRATIONS, WTCombotDB
+
+
+class FailingCursor():
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        if(self.fail_on in statement):
+            raise RuntimeError('could not create unique index')
+
+
+def test_migration_removes_repeats_before_the_key():
+    for migration in MIGRATIONS:
+        assert migration.index('IS NULL') < migration.index('ctid') < migration.index('ADD PRIMARY KEY')
+
+
+def test_failed_migration_is_retried(caplog):
+    db = WTCombotDB('db', 'user', 'password')
+    conn = MagicMock()
+    conn.cursor.return_value = FailingCursor('DO $$')
+    with pytest.raises(RuntimeError):
+        db._WTCombotDB__prepare(conn)
+    assert 'Database schema migration failed' in caplog.text
+    conn.cursor.return_value = cursor = FailingCursor('never')
+    db._WTCombotDB__prepare(conn)
+    assert any(statement.startswith('DO $$') for statement in cursor.statements)
+    assert any(statement.startswith('PREPARE wt_get_message_id') for statement in cursor.statements)
+
+
+class FakeConnection():
+
+    # FakeConnection записывает запросы; broken=True - соединение оборвано и первый запрос бросает OperationalError
+
+    def __init__(self, statements, broken=False):
+        self.statements = statements
+        self.broken = broken
+        self.closed = 0
+        self.rows = [(42,)]
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        if(self.broken):
+            self.closed = 1
+            raise OperationalError('server closed the connection unexpectedly')
+        self.statements.append((statement, params))
+
+    def fetchone(self):
+        return self.rows[0]
+
+    @property
+    def rowcount(self):
+        return 1
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool():
+    instances = []
+
+    def __init__(self, minconn, maxconn, **dsn):
+        self.statements = []
+        self.idle = []
+        self.broken = 0
+        self.discarded = 0
+        FakePool.instances.append(self)
+
+    def getconn(self):
+        if(self.idle):
+            conn = self.idle.pop()
+        else:
+            conn = FakeConnection(self.statements)
+        if(self.broken > 0):
+            self.broken -= 1
+            conn.broken = True
+        return conn
+
+    def putconn(self, conn, close=False):
+        if(close):
+            self.discarded += 1
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        pass
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakePool.instances.clear()
+    monkeypatch.setattr(wtdb, 'ThreadedConnectionPool', FakePool)
+    db = WTCombotDB('db', 'user', 'password')
+    yield db
+    db.close()
+
+
+def executed(pool_instance) -> list[str]:
+    return [statement for statement, params in pool_instance.statements if statement.startswith('EXECUTE')]
+
+
+def test_statements_are_prepared_once_per_connection(pool):
+    pool.set_message_id(79990000000, 100, 'sales')
+    assert pool.get_message_id(79990000000, 'sales') == 42
+    fake = FakePool.instances[0]
+    prepares = [statement for statement, params in fake.statements if statement.startswith('PREPARE')]
+    assert len(prepares) == len(wtdb.PREPARED_STATEMENTS)
+    assert executed(fake) == ['EXECUTE wt_set_message_id (%s, %s, %s)', 'EXECUTE wt_get_message_id (%s, %s)']
+    assert fake.statements[-1][1] == (79990000000, 'sales')
+
+
+def test_set_message_id_is_an_upsert():
+    statement = wtdb.PREPARED_STATEMENTS['wt_set_message_id']
+    assert 'ON CONFLICT (tenant, user_number) DO UPDATE SET message_id = EXCLUDED.message_id' in statement
+
+
+def test_broken_connection_is_replaced_and_the_query_repeated(pool):
+    pool.get_message_id(1)
+    fake = FakePool.instances[0]
+    fake.broken = 1
+    # -- соединение из пула оказалось оборванным: оно закрывается, запрос повторяется на новом --
+    assert pool.get_message_id(79990000000) == 42
+    assert fake.discarded == 1
+    assert executed(fake)[-1] == 'EXECUTE wt_get_message_id (%s, %s)'
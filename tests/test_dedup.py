@@ -0,0 +1,63 @@
+from unittest.mock import Mock
+
+import pytest
+
+from wtdedup import Deduplicator, relay_hash
+from wterror import WTCombotTransientError
+from test_envelope import ENVELOPE, bot
+
+
+def test_remembered_key_is_a_duplicate():
+    dedup = Deduplicator(persist=False)
+    dedup.remember('wa:wamid.1')
+    assert dedup.duplicates(['wa:wamid.1', 'wa:wamid.2', None]) == {'wa:wamid.1'}
+
+
+def test_keys_missing_in_memory_are_looked_up_in_one_query():
+    db = Mock(get_seen=Mock(return_value=[relay_hash('wa:wamid.2')]))
+    dedup = Deduplicator(db, ttl=60)
+    dedup.remember('wa:wamid.1')
+    assert dedup.duplicates(['wa:wamid.1', 'wa:wamid.2', 'wa:wamid.3']) == {'wa:wamid.1', 'wa:wamid.2'}
+    db.get_seen.assert_called_once()
+    assert sorted(db.get_seen.call_args.args[0]) == sorted([relay_hash('wa:wamid.2'), relay_hash('wa:wamid.3')])
+    # -- ключ, найденный в базе, дальше берётся из памяти --
+    assert dedup.duplicates(['wa:wamid.2']) == {'wa:wamid.2'}
+    assert db.get_seen.call_count == 1
+
+
+def test_persisted_keys_are_cleaned_up_once_per_interval():
+    db = Mock()
+    dedup = Deduplicator(db, ttl=60, cleanup_interval=3600)
+    dedup.remember('wa:wamid.1')
+    dedup.remember('wa:wamid.2')
+    assert [call.args for call in db.set_seen.call_args_list] == [(relay_hash('wa:wamid.1'),), (relay_hash('wa:wamid.2'),)]
+    db.delete_expired_seen.assert_called_once_with(60)
+
+
+def test_database_errors_do_not_drop_messages():
+    db = Mock(get_seen=Mock(side_effect=ConnectionError('database is down')))
+    assert Deduplicator(db).duplicates(['wa:wamid.1']) == set()
+
+
+def test_repeated_webhook_is_skipped(bot, monkeypatch):
+    relayed = []
+    monkeypatch.setattr(bot, '__wa_relay__', lambda prep_data, reply_ids, key=None: relayed.append(key))
+    bot.wa_point(ENVELOPE)
+    bot.wa_point(ENVELOPE)
+    assert len(relayed) == 5
+    assert bot.db.get_message_ids.call_count == 1
+
+
+def test_message_with_a_transient_error_is_relayed_again(bot, monkeypatch):
+    relayed = []
+
+    def relay(prep_data, reply_ids, key=None):
+        relayed.append(key)
+        if(key == 'wa:wamid.2' and relayed.count(key) == 1):
+            raise WTCombotTransientError('sending')
+
+    monkeypatch.setattr(bot, '__wa_relay__', relay)
+    with pytest.raises(WTCombotTransientError):
+        bot.wa_point(ENVELOPE)
+    bot.wa_point(ENVELOPE)
+    assert relayed[5:] == ['wa:wamid.2']
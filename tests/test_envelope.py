@@ -0,0 +1,72 @@
+from unittest.mock import Mock
+
+import pytest
+
+from wabot import WhatsAppBot
+from wtcache import LRUCache
+from wtcombot import TGWACOM
+from wtdedup import Deduplicator
+from wterror import WTCombotTransientError
+
+
+def message(wamid, number, text='Hello'):
+    return {"from": number, "id": wamid, "timestamp": "1700000000", "type": "text", "text": {"body": text}}
+
+
+def envelope(*values):
+    return {"object": "whatsapp_business_account", "entry": [{"id": "1", "changes": [
+        {"field": "messages", "value": {"messaging_product": "whatsapp", "metadata": {"phone_number_id": "111"}, **value}}
+        for value in values]}]}
+
+
+ENVELOPE = envelope(
+    {"contacts": [{"profile": {"name": "Anna"}, "wa_id": "79990000001"}, {"profile": {"name": "Boris"}, "wa_id": "79990000002"}],
+     "messages": [message("wamid.1", "79990000001"), message("wamid.2", "79990000002"), message("wamid.3", "79990000001")],
+     "statuses": [{"id": "wamid.out1", "status": "read", "recipient_id": "79990000003"}]},
+    {"messages": [message("wamid.4", "79990000004")]})
+
+
+@pytest.fixture
+def bot():
+    bot = TGWACOM.__new__(TGWACOM)
+    bot.name = ''
+    bot.whatsapp_bot = WhatsAppBot('test', '111')
+    bot.dedup = Deduplicator(persist=False)
+    bot.db = Mock(get_message_ids=Mock(return_value={79990000001: 10}))
+    bot.reply_cache = LRUCache(10, 60, 'test_envelope')
+    return bot
+
+
+def test_envelope_is_split_in_order(bot):
+    items = bot.whatsapp_bot.split_envelope(ENVELOPE)
+    assert [bot.whatsapp_bot.get_relay_key(item) for item in items] == \
+        ['wa:wamid.1', 'wa:wamid.2', 'wa:wamid.3', 'wa:wamid.out1:read', 'wa:wamid.4']
+    assert [bot.whatsapp_bot.get_name(item) for item in items[:3]] == ['Anna', 'Boris', 'Anna']
+    # -- контакта нет в вебхуке: имя пустое, номер берётся из сообщения --
+    assert bot.whatsapp_bot.get_mobile(items[4]) == '79990000004'
+    assert all(item['metadata'] == {"phone_number_id": "111"} for item in items)
+
+
+def test_every_item_is_relayed_after_one_lookup(bot, monkeypatch):
+    relayed = []
+    monkeypatch.setattr(bot, '__wa_relay__', lambda prep_data, reply_ids, key=None: relayed.append((key, dict(reply_ids))))
+    bot.wa_point(ENVELOPE)
+    assert [key for key, _ in relayed] == ['wa:wamid.1', 'wa:wamid.2', 'wa:wamid.3', 'wa:wamid.out1:read', 'wa:wamid.4']
+    bot.db.get_message_ids.assert_called_once()
+    assert sorted(bot.db.get_message_ids.call_args.args[0]) == ['79990000001', '79990000002', '79990000003', '79990000004']
+    assert relayed[0][1] == {'79990000001': 10}
+
+
+def test_transient_error_is_raised_after_the_rest_of_the_envelope(bot, monkeypatch):
+    relayed = []
+    error = WTCombotTransientError('sending')
+
+    def relay(prep_data, reply_ids, key=None):
+        relayed.append(key)
+        if(key == 'wa:wamid.2'):
+            raise error
+
+    monkeypatch.setattr(bot, '__wa_relay__', relay)
+    with pytest.raises(WTCombotTransientError):
+        bot.wa_point(ENVELOPE)
+    assert len(relayed) == 5
@@ -0,0 +1,64 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from unittest.mock import patch
+
+import pytest
+
+from wthttp import create_session
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_is_reused(server):
+    session = create_session('test')
+    try:
+        for _ in range(5):
+            assert session.get(f'{server}/').text == 'ok'
+    finally:
+        session.close()
+    assert session.stats.stats() == {'requests': 5, 'opened': 1, 'reused': 4}
+
+
+def test_default_timeouts_are_applied():
+    session = create_session('test', connect_timeout=1.5, read_timeout=7.0)
+    with patch('requests.Session.request') as request:
+        session.get('http://127.0.0.1/')
+        session.get('http://127.0.0.1/', timeout=3)
+    assert [call.kwargs['timeout'] for call in request.call_args_list] == [(1.5, 7.0), 3]
+    assert session.headers['Connection'] == 'keep-alive'
+
+
+def test_telebot_requests_use_the_shared_session(monkeypatch):
+    from telebot import apihelper
+    from tgbot import TelegramBot
+    # -- TelegramBot меняет настройки модуля apihelper: после теста они возвращаются --
+    for name in ('session', 'CONNECT_TIMEOUT', 'READ_TIMEOUT', 'CUSTOM_REQUEST_SENDER'):
+        monkeypatch.setattr(apihelper, name, getattr(apihelper, name))
+    session = create_session('telegram', connect_timeout=2.0, read_timeout=30.0)
+    try:
+        TelegramBot('1:test', session=session)
+        assert apihelper._get_req_session() is session
+        assert (apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT) == (2.0, 30.0)
+    finally:
+        session.close()
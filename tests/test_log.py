@@ -0,0 +1,67 @@
+import logging
+from json import loads
+from queue import Queue
+
+from wtlog import DroppingQueueHandler, RecordFormatter, Redactor, Sampler, SAMPLER, log_sampled
+from wtmetrics import LOG_DROPPED
+
+BOT_TOKEN = '6123456789:AAHdqTcvCH1vGWJxfSeofSAs0K5PALDsaw0'
+
+
+def record(message, payload=None, category=None):
+    record = logging.LogRecord('root', logging.INFO, __file__, 1, message, None, None)
+    record.payload = payload
+    record.category = category
+    return record
+
+
+def test_sampling_rates_are_parsed():
+    sampler = Sampler()
+    sampler.configure('webhook=0, duplicate=1, broken, sent=2')
+    assert sampler.rates == {'webhook': 0.0, 'sent': 1.0, 'duplicate': 1.0}
+    assert not any(sampler.keep('webhook') for _ in range(100))
+    assert all(sampler.keep('other') for _ in range(100))
+
+
+def test_tokens_are_redacted():
+    redactor = Redactor()
+    redactor.add('EAAGm0PX4ZCpsBA')
+    redactor.add('short')
+    text = redactor.redact(f"GET https://api.telegram.org/file/bot{BOT_TOKEN}/photos/1.jpg Authorization: Bearer abc.def "
+                           f"?access_token=secret&x=1 EAAGm0PX4ZCpsBA short")
+    assert BOT_TOKEN not in text and 'abc.def' not in text and 'secret' not in text and 'EAAGm0PX4ZCpsBA' not in text
+    assert text.endswith('[redacted] short')
+
+
+def test_payload_is_serialized_redacted_and_cut_by_the_formatter():
+    formatter = RecordFormatter(Redactor(), max_payload=60)
+    payload = {'token': BOT_TOKEN, 'text': 'x' * 100}
+    text = formatter.format(record('Received:', payload))
+    assert BOT_TOKEN not in text
+    assert text.endswith('more chars]')
+    assert 'Received: {"token": "[redacted]"' in text
+
+
+def test_structured_record_is_one_json_line():
+    formatter = RecordFormatter(Redactor(), structured=True)
+    entry = loads(formatter.format(record('Sent', {'ok': True}, 'sent')))
+    assert (entry['level'], entry['message'], entry['category'], entry['payload']) == ('INFO', 'Sent', 'sent', '{"ok": true}')
+
+
+def test_full_queue_drops_instead_of_waiting():
+    handler = DroppingQueueHandler(Queue(1))
+    dropped = LOG_DROPPED._values.get((), 0)
+    handler.handle(record('first'))
+    handler.handle(record('second'))
+    assert handler.queue.qsize() == 1
+    assert LOG_DROPPED._values.get((), 0) == dropped + 1
+
+
+def test_payload_is_not_formatted_by_the_caller(caplog, monkeypatch):
+    monkeypatch.setattr(SAMPLER, 'rates', {'webhook': 1.0, 'sent': 0.0})
+    payload = {'entry': []}
+    with caplog.at_level(logging.INFO):
+        log_sampled('webhook', 'Received whatsapp webhook data:', payload)
+        log_sampled('sent', 'Sent:', payload)
+    assert len(caplog.records) == 1
+    assert caplog.records[0].payload is payload
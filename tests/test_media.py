@@ -0,0 +1,114 @@
+from hashlib import sha256
+from io import BytesIO
+from time import sleep
+from unittest.mock import Mock
+
+import pytest
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+
+import tgbot
+from wtmedia import MediaCache, spool_response
+
+
+class StreamedResponse():
+
+    # StreamedResponse - ответ requests с телом, которое отдаётся частями через iter_content
+
+    def __init__(self, chunks, failure=None):
+        self.chunks = chunks
+        self.failure = failure
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            yield chunk
+        if(self.failure):
+            raise self.failure
+
+    def close(self):
+        self.closed = True
+
+
+def test_small_file_stays_in_memory():
+    response = StreamedResponse([b'abc', b'def'])
+    digest = sha256()
+    spool = spool_response(response, spool_size=10, digest=digest)
+    assert isinstance(spool, BytesIO)
+    assert spool.read() == b'abcdef'
+    assert digest.digest() == sha256(b'abcdef').digest()
+    assert response.closed
+
+
+def test_large_file_goes_to_disk():
+    response = StreamedResponse([b'x' * 8, b'y' * 8, b'z' * 8])
+    spool = spool_response(response, spool_size=10)
+    try:
+        assert not isinstance(spool, BytesIO)
+        assert spool.fileno() >= 0
+        assert spool.read() == b'x' * 8 + b'y' * 8 + b'z' * 8
+    finally:
+        spool.close()
+
+
+def test_broken_download_closes_the_response():
+    response = StreamedResponse([b'x' * 8], failure=ConnectionError('reset'))
+    with pytest.raises(ConnectionError):
+        spool_response(response, spool_size=4)
+    assert response.closed
+
+
+def test_telegram_upload_is_streamed(monkeypatch):
+    sent = {}
+
+    class Session():
+        def request(self, method, url, **kwargs):
+            sent.update(kwargs)
+
+    monkeypatch.setattr(tgbot.apihelper, '_get_req_session', lambda *args: Session())
+    document = BytesIO(b'%PDF-1' * 1000)
+    tgbot.stream_request_sender('post', 'https://api.telegram.org/bot1:test/sendDocument',
+                                files={'document': ('price.pdf', document)}, timeout=5)
+    # -- тело - MultipartEncoder, который читает файл при отправке, а не собранные в памяти байты --
+    assert isinstance(sent['data'], MultipartEncoder)
+    assert sent['headers']['Content-Type'].startswith('multipart/form-data')
+    assert document.tell() == 0
+
+
+def test_media_id_is_reused_from_memory():
+    cache = MediaCache(maxsize=10)
+    cache.set('file-unique-1', 'media-1')
+    assert cache.get('file-unique-1') == 'media-1'
+    assert cache.get('file-unique-2') is None
+
+
+def test_persisted_media_id_lives_until_its_upload_expires():
+    db = Mock(get_media_id=Mock(return_value=('media-1', 100.0)))
+    cache = MediaCache(db, ttl=100.05, persist=True)
+    # -- запись из базы живёт в памяти только остаток срока media_id --
+    assert cache.get('file-unique-1') == 'media-1'
+    assert cache.get('file-unique-1') == 'media-1'
+    db.get_media_id.assert_called_once_with('file-unique-1', 100.05)
+    sleep(0.1)
+    db.get_media_id.return_value = None
+    assert cache.get('file-unique-1') is None
+
+
+def test_persisted_media_ids_are_cleaned_up_once_per_interval():
+    db = Mock()
+    cache = MediaCache(db, ttl=60, persist=True, cleanup_interval=3600)
+    cache.set('a', 'media-a')
+    cache.set('b', 'media-b')
+    assert db.set_media_id.call_count == 2
+    db.delete_expired_media.assert_called_once_with(60)
+
+
+def test_database_errors_do_not_break_the_relay():
+    db = Mock(get_media_id=Mock(side_effect=ConnectionError('database is down')),
+              set_media_id=Mock(side_effect=ConnectionError('database is down')))
+    cache = MediaCache(db, persist=True)
+    cache.set('a', 'media-a')
+    assert cache.get('a') == 'media-a'
+    assert cache.get('b') is None
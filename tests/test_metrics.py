@@ -0,0 +1,41 @@
+from time import sleep
+
+from wtmetrics import MetricsRegistry
+
+
+def test_counter_and_gauge_are_rendered_by_labels():
+    registry = MetricsRegistry()
+    errors = registry.counter('test_errors_total', 'Errors', ['topic', 'error'])
+    lag = registry.gauge('test_lag', 'Lag', ['partition'])
+    errors.inc('whatsapp', 'Error "uploading" media')
+    errors.inc('whatsapp', 'Error "uploading" media', amount=2)
+    lag.set(5, 0)
+    lag.set(3, 0)
+    assert registry.render().splitlines() == [
+        '# HELP test_errors_total Errors', '# TYPE test_errors_total counter',
+        'test_errors_total{topic="whatsapp",error="Error \\"uploading\\" media"} 3',
+        '# HELP test_lag Lag', '# TYPE test_lag gauge',
+        'test_lag{partition="0"} 3']
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    stage = registry.histogram('test_seconds', 'Stage', ['stage'], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        stage.observe(value, 'tg_send')
+    assert registry.render().splitlines()[2:] == [
+        'test_seconds_bucket{stage="tg_send",le="0.1"} 1',
+        'test_seconds_bucket{stage="tg_send",le="1.0"} 3',
+        'test_seconds_bucket{stage="tg_send",le="+Inf"} 4',
+        'test_seconds_sum{stage="tg_send"} 4.25',
+        'test_seconds_count{stage="tg_send"} 4']
+
+
+def test_histogram_times_a_block():
+    registry = MetricsRegistry()
+    stage = registry.histogram('test_seconds', 'Stage', ['stage'], buckets=(0.001, 10.0))
+    with stage.time('wa_send'):
+        sleep(0.01)
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{stage="wa_send",le="0.001"} 0' in lines
+    assert 'test_seconds_bucket{stage="wa_send",le="10.0"} 1' in lines
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from tgbot import TelegramBot
+from wabot import WhatsAppBot
+from wtcache import LRUCache
+from wtcombot import TGWACOM
+from wterror import WTCombotError
+
+
+def reply(message_id, text=None):
+    return {"message_id": message_id, "text": text}
+
+
+@pytest.fixture
+def bot():
+    bot = TGWACOM.__new__(TGWACOM)
+    bot.name = 'sales'
+    bot.db = Mock(get_message_number=Mock(return_value=None))
+    bot.number_cache = LRUCache(10, float('inf'), 'test_numbers')
+    bot.telegram_bot = TelegramBot.__new__(TelegramBot)
+    bot.whatsapp_bot = WhatsAppBot('test', '111')
+    # -- без настроек из env-файла: старые строки индекса не удаляются --
+    bot._TGWACOM__NUMBER_TTL = 0
+    return bot
+
+
+def test_every_part_of_a_relayed_message_is_indexed(bot):
+    bot.set_message_number(SimpleNamespace(relay_message_ids=[20, 21, 22]), '79990000001')
+    bot.db.set_message_numbers.assert_called_once_with([20, 21, 22], '79990000001', 'sales')
+    bot.db.delete_expired_message_numbers.assert_not_called()
+    assert [bot.get_message_number(message_id) for message_id in (20, 21, 22)] == ['79990000001'] * 3
+    bot.db.get_message_number.assert_not_called()
+
+
+def test_number_is_read_from_the_index_once(bot):
+    bot.db.get_message_number.return_value = 79990000001
+    assert bot.get_message_number(20) == '79990000001'
+    assert bot.get_message_number(20) == '79990000001'
+    bot.db.get_message_number.assert_called_once_with(20, 'sales')
+    assert bot.get_message_number(21, cached_only=True) is None
+    assert bot.db.get_message_number.call_count == 1
+
+
+def test_reply_goes_to_the_indexed_number_whatever_the_text(bot):
+    bot.db.get_message_number.return_value = 79990000001
+    # -- подпись в тексте отредактирована оператором или указывает на другой номер --
+    assert bot.__tg_get_reply_number__(reply(20, "Hello!\n\n~whatsapp Boris +79990000002 #ID79990000002")) == '79990000001'
+
+
+def test_postscript_is_used_for_messages_without_an_index_row(bot):
+    assert bot.__tg_get_reply_number__(reply(20, "Hello!\n\n~whatsapp Boris +79990000002 #ID79990000002")) == '79990000002'
+    bot.db.get_message_number.side_effect = ConnectionError('database is down')
+    assert bot.__tg_get_reply_number__(reply(21, "Hello!\n\n~whatsapp Boris +79990000002 #ID79990000002")) == '79990000002'
+    with pytest.raises(WTCombotError):
+        bot.__tg_get_reply_number__(reply(22, "A photo without a postscript"))
+
+
+def test_raw_reply_is_keyed_by_the_cached_number(bot):
+    bot.number_cache.set(20, '79990000001')
+    body = b'{"message": {"reply_to_message": {"message_id": 20, "text": "#ID79990000002"}, "chat": {"id": -100}}}'
+    assert bot.get_raw_conversation_key('telegram', body) == '79990000001'
+    assert bot.get_raw_conversation_key('telegram', body.replace(b'20', b'30')) == '79990000002'
+    bot.db.get_message_number.assert_not_called()
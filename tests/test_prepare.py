@@ -0,0 +1,72 @@
+from io import BytesIO
+from time import sleep
+
+import pytest
+
+from wtbudget import ByteBudget
+from wtprepare import MediaPreparer, MediaPreparationError, MediaTooLargeError, PreparedCache, sniff_mime
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = PreparedCache(maxbytes=10)
+    cache.set('a', b'12345')
+    cache.set('b', b'12345')
+    cache.set('c', b'123')
+    assert cache.get('a') is None
+    assert cache.get('b') == b'12345'
+    assert cache.size == 8
+    cache.set('huge', b'x' * 11)
+    assert cache.get('huge') is None
+
+
+def test_cache_is_charged_to_the_budget():
+    budget = ByteBudget(8)
+    cache = PreparedCache(maxbytes=100, budget=budget)
+    cache.set('a', b'12345')
+    assert budget.in_use == 5
+    reservation = budget.acquire(3)
+    # -- места в бюджете нет: кэш вытесняет свою запись, а не ждёт --
+    cache.set('b', b'1234')
+    assert cache.get('a') is None
+    assert cache.get('b') == b'1234'
+    assert budget.in_use == 7
+    cache.set('c', b'123456')
+    assert cache.get('c') is None
+    assert len(cache) == 0
+    budget.release(reservation)
+    assert budget.in_use == 0
+
+
+def test_close_releases_the_budget():
+    budget = ByteBudget(100)
+    preparer = MediaPreparer(workers=0, budget=budget)
+    preparer.cache.set('a', b'12345')
+    preparer.close()
+    assert budget.in_use == 0
+
+
+def test_document_over_the_limit_is_refused():
+    preparer = MediaPreparer(workers=0, limits={'document': 10})
+    with pytest.raises(MediaTooLargeError):
+        preparer.prepare(BytesIO(b'%PDF-' + b'0' * 10), 'price.pdf', 'document')
+    prepared = preparer.prepare(BytesIO(b'%PDF-1'), 'price', 'document')
+    assert (prepared.mime_type, prepared.size) == ('application/pdf', 6)
+
+
+def test_mime_is_sniffed_from_content():
+    assert sniff_mime(b'\x89PNG\r\n\x1a\n') == 'image/png'
+    assert sniff_mime(b'RIFF\x00\x00\x00\x00WEBP') == 'image/webp'
+    assert sniff_mime(b'\x00\x00\x00\x18ftypmp42') == 'video/mp4'
+    assert sniff_mime(b'plain text') is None
+
+
+def test_pool_is_restarted_after_a_timeout():
+    preparer = MediaPreparer(workers=1, timeout=0.5)
+    try:
+        with pytest.raises(MediaPreparationError):
+            preparer._MediaPreparer__run(sleep, 60)
+        # -- процесс с зависшей задачей завершён, а следующая задача идёт в новом пуле --
+        assert preparer._MediaPreparer__pool is None
+        assert preparer._MediaPreparer__run(abs, -3) == 3
+    finally:
+        preparer.close()
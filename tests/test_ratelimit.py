@@ -0,0 +1,87 @@
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+
+from wtratelimit import OutboundScheduler, PRIORITY_CUSTOMER, PRIORITY_NOTICE
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+def test_burst_then_rate():
+    scheduler = OutboundScheduler('test', rate=20, capacity=3)
+    started = monotonic()
+    for _ in range(3):
+        scheduler.acquire('chat')
+    assert monotonic() - started < 0.03
+    for _ in range(2):
+        scheduler.acquire('chat')
+    # -- после трёх сообщений подряд следующие идут по одному в 1/20 с --
+    assert monotonic() - started >= 0.09
+
+
+def test_destinations_do_not_wait_for_each_other():
+    scheduler = OutboundScheduler('test', rate=1, capacity=1)
+    scheduler.acquire('chat-1')
+    started = monotonic()
+    scheduler.acquire('chat-2')
+    assert monotonic() - started < 0.03
+
+
+def test_customer_messages_go_before_notices():
+    scheduler = OutboundScheduler('test', rate=20, capacity=1)
+    scheduler.acquire('chat')
+    order = []
+
+    def send(name, priority, delay):
+        sleep(delay)
+        scheduler.acquire('chat', priority)
+        order.append(name)
+
+    threads = [Thread(target=send, args=('notice', PRIORITY_NOTICE, 0)),
+               Thread(target=send, args=('customer', PRIORITY_CUSTOMER, 0.01))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert order == ['customer', 'notice']
+
+
+def test_retry_after_blocks_the_destination_and_repeats_the_send():
+    scheduler = OutboundScheduler('test', rate=100, capacity=10, max_retries=2)
+    calls = []
+
+    def send():
+        calls.append(monotonic())
+        if(len(calls) == 1):
+            raise RateLimited(0.1)
+        return 'sent'
+
+    assert scheduler.call('chat', send, get_retry_after=lambda err: getattr(err, 'retry_after', None)) == 'sent'
+    assert calls[1] - calls[0] >= 0.09
+
+
+def test_retries_run_out():
+    scheduler = OutboundScheduler('test', rate=100, capacity=10, max_retries=1)
+
+    def send():
+        raise RateLimited(0.01)
+
+    with pytest.raises(RateLimited):
+        scheduler.call('chat', send, get_retry_after=lambda err: err.retry_after)
+
+
+def test_other_errors_are_not_retried():
+    scheduler = OutboundScheduler('test', rate=100, capacity=10)
+    calls = []
+
+    def send():
+        calls.append(1)
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        scheduler.call('chat', send, get_retry_after=lambda err: getattr(err, 'retry_after', None))
+    assert len(calls) == 1
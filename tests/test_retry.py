@@ -0,0 +1,57 @@
+import pytest
+from requests import Response
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError, HTTPError
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+
+from wterror import WTCombotError, WTCombotTransientError, WTCombotRateLimitError
+from wtretry import is_transient
+
+
+def response(status_code, body=b'') -> Response:
+    result = Response()
+    result.status_code = status_code
+    result.reason = 'Reason'
+    result._content = body
+    return result
+
+
+def telegram_error(error_code) -> ApiTelegramException:
+    return ApiTelegramException('sendMessage', response(error_code), {'ok': False, 'error_code': error_code, 'description': 'Error'})
+
+
+@pytest.mark.parametrize('err, expected', [
+    (WTCombotTransientError('sending'), True),
+    (WTCombotError('content'), False),
+    (WTCombotRateLimitError('limit', retry_after=1), False),
+])
+def test_wtcombot_errors(err, expected):
+    assert is_transient(err) is expected
+
+
+@pytest.mark.parametrize('err', [ConnectionError('reset'), Timeout('timeout'), ChunkedEncodingError('broken')])
+def test_requests_connection_errors(err):
+    assert is_transient(err)
+
+
+@pytest.mark.parametrize('status_code, expected', [(429, True), (500, True), (503, True), (400, False), (404, False)])
+def test_requests_http_error(status_code, expected):
+    assert is_transient(HTTPError(response=response(status_code))) is expected
+
+
+def test_requests_http_error_without_response():
+    assert not is_transient(HTTPError('no response'))
+
+
+@pytest.mark.parametrize('error_code, expected', [(429, True), (500, True), (502, True), (400, False), (403, False)])
+def test_telegram_api_error(error_code, expected):
+    assert is_transient(telegram_error(error_code)) is expected
+
+
+@pytest.mark.parametrize('status_code, expected', [(502, True), (503, True), (429, True), (404, False), (413, False)])
+def test_telegram_http_error(status_code, expected):
+    err = ApiHTTPException('sendMessage', response(status_code, b'<html><body>Bad Gateway</body></html>'))
+    assert is_transient(err) is expected
+
+
+def test_other_errors():
+    assert not is_transient(ValueError('bad value'))
@@ -0,0 +1,91 @@
+from os import fork, getpid, kill, waitpid, waitstatus_to_exitcode, _exit
+from signal import SIGTERM
+from socket import socket
+from time import monotonic, sleep
+
+import pytest
+import requests
+from flask import Flask
+
+from main import Bridge, create_app
+from wtserve import PreforkServer
+from test_bridge import ENV
+
+
+def free_port() -> int:
+    with socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def pid_app() -> Flask:
+    app = Flask('pid')
+    app.add_url_rule('/pid', 'pid', lambda: str(getpid()))
+    return app
+
+
+def worker_pids(url, count, timeout=10) -> set[int]:
+    pids = set()
+    deadline = monotonic() + timeout
+    while len(pids) < count and monotonic() < deadline:
+        try:
+            # -- новое соединение на каждый запрос, чтобы запросы расходились по воркерам --
+            pids.add(int(requests.get(url, headers={'Connection': 'close'}, timeout=2).text))
+        except requests.ConnectionError:
+            sleep(0.05)
+    return pids
+
+
+@pytest.fixture
+def env_file(tmp_path, monkeypatch):
+    def write(**overrides):
+        settings = {**ENV, **overrides}
+        for name in settings:
+            monkeypatch.delenv(name, raising=False)
+        path = tmp_path / 'test.env'
+        path.write_text(''.join(f"{name}={value}\n" for name, value in settings.items()))
+        return str(path)
+    # -- маршруты роли проверяются без запуска продюсера и потребителей --
+    monkeypatch.setattr(Bridge, 'warm_up', lambda self, setup=True, consumers=True: None)
+    return write
+
+
+def test_web_role_needs_kafka(env_file):
+    with pytest.raises(ValueError):
+        create_app(env_file(), 'web')
+    with pytest.raises(ValueError):
+        create_app(env_file(), 'worker')
+
+
+@pytest.mark.parametrize('role, webhooks', [('all', True), ('web', True), ('consumer', False)])
+def test_routes_of_the_role(env_file, role, webhooks):
+    app = create_app(env_file(WT_COMBOT_TRANSPORT='local' if role == 'all' else 'kafka'), role)
+    routes = {rule.rule for rule in app.url_map.iter_rules()}
+    assert ({'/w', '/t', '/t/<tenant>'} <= routes) == webhooks
+    assert {'/metrics', '/ready'} <= routes
+    assert app.config['WT_COMBOT_ROLE'] == role
+
+
+def test_prefork_server_restarts_a_dead_worker():
+    port = free_port()
+    server = fork()
+    if(server == 0):
+        code = 0
+        try:
+            PreforkServer(pid_app, '127.0.0.1', port, workers=2).serve()
+        except BaseException:
+            code = 1
+        _exit(code)
+    try:
+        url = f'http://127.0.0.1:{port}/pid'
+        pids = worker_pids(url, 2)
+        assert len(pids) == 2
+        dead = pids.pop()
+        kill(dead, SIGTERM)
+        sleep(0.2)
+        restarted = worker_pids(url, 2)
+        assert dead not in restarted and len(restarted) == 2
+    finally:
+        kill(server, SIGTERM)
+        _, status = waitpid(server, 0)
+    assert waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,80 @@
+from random import Random
+from re import compile as re_compile
+
+import pytest
+
+from tgbot import TelegramBot
+
+ENTITY = re_compile(r'&(#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);')
+
+
+def baseline_split(text, postscript='', chars_per_string=4096) -> list[str]:
+
+    # baseline_split - smart_split до перехода на проход по индексам: с ним сравниваются части обычного текста
+
+    def _text_before_last(substr):
+        text_before = substr.join(part.split(substr)[:-1])
+        text_before += substr if(substr != '\n') else ' '
+        return text_before
+
+    chars_per_string -= len(postscript)
+    parts = []
+    while chars_per_string > 0:
+        if len(text) < chars_per_string:
+            parts.append(text + postscript)
+            return parts
+        part = text[:chars_per_string]
+        if "\n" in part: part = _text_before_last("\n")
+        elif ". " in part: part = _text_before_last(". ")
+        elif " " in part: part = _text_before_last(" ")
+        if(part not in ['\n', '.', ' ']):
+            parts.append(part + postscript)
+        text = text[len(part):]
+    return parts
+
+
+@pytest.fixture(scope='module')
+def bot():
+    return TelegramBot.__new__(TelegramBot)
+
+
+def random_text(rng, length) -> str:
+    words = ['word', 'longer-word', 'x', 'sentence.', 'end. ', '\n', 'да', 'многословие']
+    return ''.join(rng.choice(words) + rng.choice(['', ' ', ' ', '\n']) for _ in range(length))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_parts_match_the_baseline(bot, seed):
+    rng = Random(seed)
+    text = random_text(rng, rng.randint(1, 400))
+    chars, postscript = rng.choice([(50, ''), (64, '\n\n<b>Name</b>'), (200, ' ~'), (4096, '')])
+    assert bot.smart_split(text, postscript, chars) == baseline_split(text, postscript, chars)
+
+
+def test_text_without_separators_is_cut_at_the_limit(bot):
+    assert bot.smart_split('a' * 25, '', 10) == ['a' * 10, 'a' * 10, 'a' * 5]
+
+
+@pytest.mark.parametrize('entity', ['&amp;', '&#39;', '&#x1F600;', '&quot;'])
+def test_entities_are_kept_whole(bot, entity):
+    text = ('ab' + entity) * 30
+    for chars in range(12, 40):
+        parts = bot.smart_split(text, '', chars)
+        assert ''.join(parts) == text
+        for part in parts:
+            assert len(part) <= chars
+            assert part.count('&') == len(ENTITY.findall(part))
+
+
+def test_tags_are_kept_whole(bot):
+    text = '<b>bold</b><i>italic</i>' * 10
+    parts = bot.smart_split(text, '', 15)
+    assert ''.join(parts) == text
+    for part in parts:
+        assert part.count('<') == part.count('>')
+
+
+def test_only_the_last_part_is_signed(bot):
+    parts = bot.smart_split('one two three four', ' -- Name', 16, sign_every_part=False)
+    assert parts[-1].endswith(' -- Name')
+    assert not any(part.endswith(' -- Name') for part in parts[:-1])
@@ -0,0 +1,67 @@
+from pathlib import Path
+from subprocess import run
+from sys import executable, path
+
+import pytest
+import requests
+
+BENCHMARKS = Path(__file__).resolve().parent.parent / 'benchmarks'
+path.insert(0, str(BENCHMARKS))
+
+from standins import FakeGraphAPI, FakeTelegramAPI, MemoryDB
+
+
+@pytest.fixture
+def graph():
+    api = FakeGraphAPI(media_size=16).start()
+    yield api
+    api.stop()
+
+
+def test_graph_api_sends_and_serves_media(graph):
+    sent = requests.post(f"{graph.base_url}/1/messages", json={"to": "79990000000"}).json()
+    assert sent['messages'][0]['id'].startswith('wamid.out')
+    media = requests.get(f"{graph.base_url}/image1").json()
+    content = requests.get(media['url']).content
+    assert len(content) == 16 and content.startswith(b'image1')
+    assert graph.calls == {'messages': 1, 'media url': 1, 'media download': 1}
+
+
+def test_rate_limit_is_injected():
+    api = FakeGraphAPI(limit_rate=1.0, retry_after=3).start()
+    try:
+        response = requests.post(f"{api.base_url}/1/messages", json={})
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '3'
+    finally:
+        api.stop()
+
+
+def test_telegram_album_gets_a_message_per_file():
+    api = FakeTelegramAPI(chat_id=-100).start()
+    try:
+        files = {f'photo{n}': (f'photo{n}.jpg', b'jpeg') for n in range(3)}
+        response = requests.post(api.api_url.format('1:test', 'sendMediaGroup'), files=files).json()
+        assert len(response['result']) == 3
+        assert {message['chat']['id'] for message in response['result']} == {-100}
+    finally:
+        api.stop()
+
+
+def test_memory_db_keeps_the_message_ids():
+    db = MemoryDB()
+    db.set_message_id(79990000000, 10, 'sales')
+    db.set_message_numbers([11, 12], 79990000000, 'sales')
+    assert db.get_message_id(79990000000, 'sales') == 10
+    assert db.get_message_id(79990000000) is None
+    assert db.get_message_number(12, 'sales') == 79990000000
+
+
+def test_end_to_end_benchmark_relays_every_message():
+    result = run([executable, str(BENCHMARKS / 'bench_e2e.py'), '--requests', '20', '--latency-ms', '0', '--jitter-ms', '0',
+                  '--timeout', '60'], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert 'timed out' not in result.stdout
+    all_row = next(line for line in result.stdout.splitlines() if line.startswith('all '))
+    # -- строка итогов: all, число сообщений, число ошибок, перцентили --
+    assert all_row.split()[1:3] == ['20', '0']
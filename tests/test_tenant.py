@@ -0,0 +1,107 @@
+from json import dumps
+from types import SimpleNamespace
+from unittest.mock import Mock
+
+import pytest
+
+from wterror import WTCombotTransientError
+from wtconsumer import OffsetCommitter
+from wttenant import TenantRegistry
+from wttransport import LocalTransport
+
+ENV = {'WT_COMBOT_WA_ACCESS_TOKEN': 'test', 'WT_COMBOT_WA_VERIFY_TOKEN': 'test', 'WT_COMBOT_TG_BOT_ID': '17546223',
+       'WT_COMBOT_TG_API_TOKEN': '1:test', 'WT_COMBOT_TENANTS': 'tenants.json'}
+TENANTS = [{'name': name, 'wa_number_id': number_id, 'tg_chat_id': chat_id}
+           for name, number_id, chat_id in (('sales', '111', -1001), ('support', '222', -1002), ('billing', '333', -1003))]
+
+
+def webhook(*number_ids) -> dict:
+    return {"object": "whatsapp_business_account", "entry": [{"id": "1", "changes": [
+        {"field": "messages", "value": {"metadata": {"phone_number_id": number_id}, "messages": []}} for number_id in number_ids]}]}
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    for name in list(ENV) + ['WT_COMBOT_WA_NUMBER_ID', 'WT_COMBOT_TG_CHAT_ID']:
+        monkeypatch.delenv(name, raising=False)
+    (tmp_path / 'tenants.json').write_text(dumps(TENANTS))
+    env_file = tmp_path / 'test.env'
+    env_file.write_text(''.join(f"{name}={value}\n" for name, value in ENV.items()))
+    registry = TenantRegistry(str(env_file))
+    assert registry.check_env_variables()
+    return registry
+
+
+def relay(registry, monkeypatch, errors) -> list:
+    relayed = []
+
+    def wa_point(name):
+        def point(envelope):
+            relayed.append(name)
+            if(name in errors):
+                raise errors[name]
+        return point
+
+    for bot in registry.bots.values():
+        monkeypatch.setattr(bot, 'wa_point', wa_point(bot.name))
+    return relayed
+
+
+def test_every_tenant_is_tried_after_an_error(registry, monkeypatch):
+    error = ValueError('broken part')
+    relayed = relay(registry, monkeypatch, {'sales': error})
+    with pytest.raises(ValueError) as raised:
+        registry.wa_point(webhook('111', '222', '333'))
+    assert raised.value is error
+    assert relayed == ['sales', 'support', 'billing']
+
+
+def test_transient_error_is_raised_first(registry, monkeypatch):
+    transient = WTCombotTransientError('sending')
+    relayed = relay(registry, monkeypatch, {'sales': ValueError('broken part'), 'billing': transient})
+    with pytest.raises(WTCombotTransientError) as raised:
+        registry.wa_point(webhook('111', '222', '333'))
+    assert raised.value is transient
+    assert relayed == ['sales', 'support', 'billing']
+
+
+def test_unknown_number_is_skipped(registry, monkeypatch):
+    relayed = relay(registry, monkeypatch, {})
+    registry.wa_point(webhook('999', '222'))
+    assert relayed == ['support']
+
+
+def test_unreadable_record_goes_to_the_dead_letters(registry):
+    transport = LocalTransport()
+    producer = transport.producer()
+    for body in (b'{"entry": []}', b'{"entry": [', b'{"entry": []}'):
+        producer.send('whatsapp', value=body, key='79990000000')
+    consumer = transport.consumer()
+    consumer.subscribe(['whatsapp'])
+    dead_letters = Mock()
+    registry.default.resources = SimpleNamespace(dead_letters=dead_letters)
+    submitted = []
+    committer = OffsetCommitter(consumer, commit_every=1, async_commit=False)
+    registry.consumeData(consumer, SimpleNamespace(submit=lambda *args: submitted.append(args[2])), committer)
+    assert submitted == [0, 2]
+    (key, tp, offset, value, attempts, err), _ = dead_letters.send.call_args
+    assert (key, offset, value, attempts) == ('79990000000', 1, '{"entry": [', 1)
+    assert isinstance(err, ValueError)
+    # -- сообщения 0 и 2 ещё обрабатываются: зафиксировать можно только смещение 0 --
+    assert committer.tracker.committable() == {}
+    committer.done(tp, 0)
+    committer.done(tp, 2)
+    committer.commit()
+    assert transport.queue('whatsapp').committed == 3
+
+
+def test_expired_message_numbers_are_deleted_per_tenant(registry):
+    bot = registry.bots['sales']
+    bot.db = Mock()
+    bot.telegram_bot = Mock(get_sent_message_ids=Mock(return_value=[10, 11]))
+    bot.set_message_number(object(), '79990000000')
+    bot.set_message_number(object(), '79990000000')
+    assert bot.db.set_message_numbers.call_count == 2
+    # -- устаревшие связи удаляются один раз в час, только для своего клиента --
+    bot.db.delete_expired_message_numbers.assert_called_once_with(90 * 24 * 3600.0, 'sales')
+    assert bot.get_message_number(11, cached_only=True) == '79990000000'
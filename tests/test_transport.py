@@ -0,0 +1,69 @@
+from importlib import import_module
+from sys import modules
+
+import pytest
+
+from wttransport import LocalTransport, MalformedValue, QueueLockedError
+
+
+def test_queue_file_is_used_by_one_process(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    transport = LocalTransport(path=path)
+    try:
+        with pytest.raises(QueueLockedError):
+            LocalTransport(path=path)
+    finally:
+        transport.close()
+
+
+def test_queue_is_restored_after_restart(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    transport = LocalTransport(path=path)
+    producer = transport.producer()
+    for n in range(3):
+        producer.send('whatsapp', value=f'{{"n": {n}}}'.encode('utf-8'), key='79990000000')
+    transport.queue('whatsapp').commit(1)
+    transport.close()
+
+    transport = LocalTransport(path=path)
+    try:
+        consumer = transport.consumer()
+        consumer.subscribe(['whatsapp'])
+        records = next(iter(consumer.poll().values()))
+        assert [(record.offset, record.value) for record in records] == [(1, {'n': 1}), (2, {'n': 2})]
+        assert transport.producer().send('whatsapp', value=b'{"n": 3}') == 3
+    finally:
+        transport.close()
+
+
+def test_unreadable_record_does_not_lose_the_batch():
+    transport = LocalTransport()
+    producer = transport.producer()
+    for body in (b'{"n": 0}', b'{"n": ', b'\xff', b'{"n": 3}'):
+        producer.send('whatsapp', value=body)
+    consumer = transport.consumer()
+    consumer.subscribe(['whatsapp'])
+    records = next(iter(consumer.poll().values()))
+    assert [record.value for record in records if not isinstance(record.value, MalformedValue)] == [{'n': 0}, {'n': 3}]
+    assert [record.value.raw for record in records if isinstance(record.value, MalformedValue)] == [b'{"n": ', b'\xff']
+    assert consumer.position(None) == 4
+    assert consumer.poll() == {}
+    producer.send('whatsapp', value=b'{"n": 4}')
+    assert [record.value for record in next(iter(consumer.poll().values()))] == [{'n': 4}]
+
+
+def test_local_transport_does_not_need_kafka(monkeypatch):
+    for name in ('kafka', 'kafka.structs', 'wtconsumer'):
+        monkeypatch.setitem(modules, name, None)
+    monkeypatch.delitem(modules, 'wtconsumer')
+    wtconsumer = import_module('wtconsumer')
+    transport = LocalTransport()
+    consumer = transport.consumer()
+    committer = wtconsumer.OffsetCommitter(consumer, async_commit=False)
+    consumer.subscribe(['whatsapp'], listener=wtconsumer.DrainingRebalanceListener(committer))
+    transport.producer().send('whatsapp', value=b'{"n": 0}')
+    record = next(iter(consumer.poll().values()))[0]
+    committer.started(consumer.queue.tp, record.offset)
+    committer.done(consumer.queue.tp, record.offset)
+    committer.commit()
+    assert transport.queue('whatsapp').committed == 1
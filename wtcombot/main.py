@@ -1,134 +1,516 @@
-from sys import argv
-from json import dumps, loads
+from argparse import ArgumentParser
+from collections import deque
+from os import getenv, getpid, register_at_fork
+from re import compile as re_compile
+from weakref import ref
 import signal
-from logging import info as log_info, error as log_error, exception as log_exception  
-from flask import Flask, request, make_response, abort
-from telebot import types as tb_types
-from kafka import KafkaProducer, KafkaConsumer
-from kafka.structs import TopicPartition
-from threading import Thread, Event
-from kafka.errors import KafkaTimeoutError, KafkaError 
+from logging import info as log_info, error as log_error, exception as log_exception
+from flask import Flask, request, make_response, abort, jsonify
+from threading import Thread, Event, Lock
+from time import sleep, monotonic
+from dotenv import load_dotenv
 
-from wtcombot import TGWACOM
+# -- kafka, telebot, heyoo и psycopg2 здесь не импортируются: их загружают setup бота и транспорт в фоне, уже после запуска сервера --
+from wttenant import TenantRegistry
+from wtconfig import env_str, env_int, env_float, env_bool
+from wtmetrics import METRICS, CONSUMER_LAG, STARTUP_SECONDS, LANE_PENDING
+from wttransport import create_transport, QueueFullError
+from wtretry import RetryPolicy, DelayQueue, DeadLetterQueue
+from wtlog import configure_logging, stop_logging
 
-producer = KafkaProducer(value_serializer=lambda v: dumps(v).encode('utf-8'), api_version=(0,10,2), bootstrap_servers=['localhost:9092'])
+STARTED = monotonic()
 
-filename = argv[1] if len(argv) == 2 else '../WT_COMBOT_ENVFILE.env'
-log_info(f"File env: {filename}")
-tgwacombot = TGWACOM(filename)
+DEFAULT_ENVFILE = '../WT_COMBOT_ENVFILE.env'
+
+# -- роли процесса: web принимает вебхуки, consumer пересылает сообщения, all делает и то и другое --
+ROLES = ('all', 'web', 'consumer')
+
+# -- отставание потребителей обновляется не чаще раза в LAG_INTERVAL секунд --
+LAG_INTERVAL = 5.0
+
+# -- вебхуки, принятые до подключения продюсера; при переполнении отвечаем 503, и Meta или Telegram повторят вебхук позже --
+STARTUP_BUFFER = 1000
+WARMUP_BASE_DELAY = 1.0
+WARMUP_MAX_DELAY = 30.0
+# -- kafka может не отвечать до минуты: остановка процесса не ждёт запуск дольше --
+WARMUP_JOIN_TIMEOUT = 1.0
+
+# -- вебхук ватсапа и телеграма - JSON-объект: тело, которое начинается не с '{', отклоняется без разбора --
+JSON_OBJECT = re_compile(rb'\s*\{')
+
+
+class Bridge():
+
+    # Bridge - клиенты (tenants), транспорт и потоки-потребители одного процесса.
+    # Продюсер создаётся в процессе, который его использует: приложение можно создать до fork,
+    # и у каждого воркера gunicorn или uWSGI всё равно будет свой продюсер.
+    # Медленная часть запуска (setup бота, подключение продюсера, потребители) выполняется в фоне методом warm_up,
+    # а вебхуки, пришедшие раньше, ждут продюсер в буфере
+
+    def __init__(self, filename):
+        log_info(f"File env: {filename}")
+        self.tenants = TenantRegistry(filename)
+        # -- вебхуки передаются потребителям без разбора: тело запроса отправляется как есть, JSON разбирает только потребитель.
+        # Транспорт - kafka или очередь внутри процесса, выбирается переменной WT_COMBOT_TRANSPORT --
+        self.transport_name = env_str('WT_COMBOT_TRANSPORT', 'kafka')
+        self.transport = create_transport(self.transport_name,
+                                          bootstrap_servers=env_str('WT_COMBOT_KAFKA_SERVERS', 'localhost:9092'),
+                                          queue_size=env_int('WT_COMBOT_QUEUE_SIZE', 10000),
+                                          queue_path=env_str('WT_COMBOT_QUEUE_PATH', ''),
+                                          put_timeout=env_float('WT_COMBOT_QUEUE_PUT_TIMEOUT', 1.0))
+        self.consumers = []
+        self.dead_letters = None
+        self.components = {}
+        self.warmup_error = None
+        self.buffer_size = env_int('WT_COMBOT_STARTUP_BUFFER', STARTUP_BUFFER)
+        self.__producer = None
+        self.__producer_pid = None
+        self.__producer_lock = Lock()
+        self.__producer_ready = False
+        self.__buffer = deque()
+        self.__buffer_lock = Lock()
+        self.__warm = Event()
+        self.__stopping = Event()
+        self.__warmup_thread = None
+        self.__warmup_args = None
+        register_at_fork(after_in_child=lambda bridge=ref(self): _restart_bridge_after_fork(bridge))
+
+    def producer(self):
+        with self.__producer_lock:
+            if(self.__producer is None or self.__producer_pid != getpid()):
+                self.__producer = self.transport.producer()
+                self.__producer_pid = getpid()
+            return self.__producer
+
+    def producer_launch(self, request, topic, tenant='') -> int:
+
+        # producer_launch отправляет тело вебхука в топик, а до подключения продюсера кладёт его в буфер.
+        # tenant - клиент из пути вебхука телеграма, по нему ищется номер в кэше клиента.
+        # Возвращает код ответа: 400, если тело не JSON-объект, 503, если буфер переполнен и вебхук не принят
+
+        try:
+            data = request.get_data()
+            if(not JSON_OBJECT.match(data)):
+                log_error(f'Webhook to {topic} is not a JSON object: {data[:100]!r}')
+                return 400
+            key = self.tenants.get_raw_conversation_key(topic, data, tenant)
+            if(not self.__producer_ready):
+                with self.__buffer_lock:
+                    if(not self.__producer_ready):
+                        if(len(self.__buffer) >= self.buffer_size):
+                            log_error(f'Startup buffer is full: {self.buffer_size} webhooks are waiting for the producer')
+                            return 503
+                        self.__buffer.append((topic, data, key))
+                        return 200
+            self.producer().send(topic, value=data, key=key)
+        except QueueFullError as qfe:
+            log_error(f'Queue error: {qfe}')
+        except self.transport.errors as te:
+            log_error(f'Transport error sending webhook to {topic}: {te}')
+            log_exception('message')
+        except Exception as e:
+            log_error(f'WhatsApp Error: {e}')
+            log_exception('message')
+        return 200
+
+    def warm_up(self, setup=True, consumers=True, background=True) -> None:
+
+        # warm_up готовит путь пересылки: setup бота (роли web он не нужен), продюсер и потоки-потребители.
+        # С background=True всё это делается в отдельном потоке, и сервер начинает принимать вебхуки сразу
+
+        self.components = dict.fromkeys(['bot'] * setup + ['producer'] + ['consumers'] * consumers, False)
+        self.__warmup_args = (setup, consumers)
+        if(not background):
+            self.__warm_up(setup, consumers)
+            return
+        self.__warmup_thread = Thread(target=self.__warm_up, args=(setup, consumers), name='warm-up', daemon=True)
+        self.__warmup_thread.start()
+
+    def after_fork(self) -> None:
+
+        # after_fork выполняется в дочернем процессе после fork (gunicorn --preload). Потоков warm_up и потребителей
+        # в нём нет, а блокировки могли быть захвачены в момент fork, поэтому они создаются заново. Вебхуки из буфера
+        # отправит родитель. Если warm_up уже запускался, воркер запускает его снова: свои бот, продюсер и потребители
+
+        self.__producer_lock = Lock()
+        self.__buffer_lock = Lock()
+        self.__buffer = deque()
+        self.__producer_ready = False
+        self.__warm = Event()
+        self.__stopping = Event()
+        self.__warmup_thread = None
+        self.consumers = []
+        self.warmup_error = None
+        if(self.__warmup_args is not None):
+            self.warm_up(*self.__warmup_args)
+
+    def wait_ready(self, timeout=None) -> bool:
+        return self.__warm.wait(timeout)
+
+    def readiness(self) -> dict:
+
+        # readiness - состояние для /ready: путь пересылки готов, когда все компоненты запущены и потоки-потребители живы.
+        # media_budget - занятые и пиковые байты файлов в пути (см. wtbudget.py)
+
+        with self.__buffer_lock:
+            buffered = len(self.__buffer)
+        ready = self.__warm.is_set() and all(consumer.is_alive() for consumer in self.consumers)
+        resources = self.tenants.resources
+        return {'ready': ready, 'components': dict(self.components), 'buffered': buffered, 'error': self.warmup_error,
+                'media_budget': resources.media_budget.stats() if resources else None, 'uptime': round(monotonic() - STARTED, 3)}
+
+    def __warm_up(self, setup, consumers) -> None:
+
+        # если компонент не запустился (kafka недоступна, ошибка в настройках), запуск повторяется с растущей паузой,
+        # уже запущенные компоненты не пересоздаются
+
+        failures = 0
+        while not self.__stopping.is_set():
+            try:
+                if(setup and not self.components['bot']):
+                    self.tenants.setup()
+                    self.__component_ready('bot')
+                if(not self.components['producer']):
+                    self.__flush_buffer()
+                    self.__component_ready('producer')
+                if(self.__stopping.is_set()):
+                    return
+                if(consumers and not self.components['consumers']):
+                    self.start_consumers()
+                    self.__component_ready('consumers')
+                self.warmup_error = None
+                self.__warm.set()
+                log_info(f"Relay path is ready in {monotonic() - STARTED:.3f}s")
+                return
+            except Exception as err:
+                failures += 1
+                self.warmup_error = f"{type(err).__name__}: {err}"
+                log_error(f"Exception from warm_up: {err}")
+                log_exception("message")
+                self.__stopping.wait(min(WARMUP_MAX_DELAY, WARMUP_BASE_DELAY * 2 ** (failures - 1)))
+
+    def __flush_buffer(self) -> None:
+
+        # __flush_buffer подключает продюсер и отправляет накопленные вебхуки. Новые вебхуки ждут на той же блокировке,
+        # поэтому порядок сообщений сохраняется
+
+        producer = self.producer()
+        # -- метаданные топиков запрашиваются заранее, иначе первый send в kafka ждал бы их под блокировкой --
+        for topic in ('whatsapp', 'telegram'):
+            producer.partitions_for(topic)
+        with self.__buffer_lock:
+            if(self.__buffer):
+                log_info(f"{len(self.__buffer)} webhooks received during startup sent")
+            while self.__buffer:
+                topic, data, key = self.__buffer[0]
+                producer.send(topic, value=data, key=key)
+                self.__buffer.popleft()
+            self.__producer_ready = True
+
+    def __component_ready(self, name) -> None:
+        self.components[name] = True
+        STARTUP_SECONDS.set(monotonic() - STARTED, name)
+
+    def start_consumers(self, settings=None, targets=None) -> None:
+
+        # start_consumers запускает по потоку-потребителю на топик; targets заменяет wa_point и tg_point
+
+        settings = settings or consumer_settings()
+        targets = targets or {'whatsapp': self.tenants.wa_point, 'telegram': self.tenants.tg_point}
+        # -- сообщения, которые не удалось отправить после всех повторов, уходят в топики <topic>_dlq --
+        self.dead_letters = DeadLetterQueue(self.producer(), on_dead_letter=self.tenants.notify_dead_letter)
+        self.tenants.set_dead_letters(self.dead_letters)
+        self.consumers = [BackgroundThread(self, target=target, args=(topic,), **settings) for topic, target in targets.items()]
+        for consumer in self.consumers:
+            consumer.start()
+
+    def stop(self) -> None:
+        self.__stopping.set()
+        if(self.__warmup_thread is not None and self.__warmup_thread.is_alive()):
+            self.__warmup_thread.join(WARMUP_JOIN_TIMEOUT)
+        for consumer in self.consumers:
+            consumer.stop()
+        log_info("Threads stop")
+        for consumer in self.consumers:
+            if consumer.is_alive():
+                consumer.join()
+                log_info("Thread stop")
+        self.consumers = []
+        self.tenants.close()
+        with self.__producer_lock:
+            if(self.__producer is not None and self.__producer_pid == getpid()):
+                self.__producer.flush()
+                self.__producer.close()
+            self.__producer = None
+        with self.__buffer_lock:
+            if(self.__buffer):
+                log_error(f"{len(self.__buffer)} webhooks received during startup were not sent")
+        self.transport.close()
+        stop_logging()
+
+
+def _restart_bridge_after_fork(bridge) -> None:
+    bridge = bridge()
+    if(bridge is not None):
+        bridge.after_fork()
 
-app = Flask(__name__)
 
 class BackgroundThread(Thread):
-    def __init__(self, target, args):
+    def __init__(self, bridge, target, args, max_records=100, poll_timeout_ms=500, commit_every=100, commit_interval=5.0, async_commit=True,
+                 workers=4, max_in_flight=1000, media_workers=2, max_media_pending=100, retry_attempts=5, retry_base_delay=1.0,
+                 retry_max_delay=60.0):
         Thread.__init__(self)
-        
+
+        self.bridge = bridge
         self.topic = args[0]
         self.wt_point = target
-        self.consumer = KafkaConsumer(self.topic, value_deserializer=lambda v: loads(v.decode('utf-8')), auto_offset_reset='earliest',
-                                bootstrap_servers=['localhost:9092'], group_id="test-consumer-group", consumer_timeout_ms=500, enable_auto_commit=False, api_version=(0,10,2))
-        
-        partition = 0
-        meta = self.consumer.partitions_for_topic(self.topic)
-        tp = TopicPartition(self.topic, partition)
-        
-        self.options = (meta, tp)
+        self.max_records = max_records
+        self.poll_timeout_ms = poll_timeout_ms
+        self.max_in_flight = max_in_flight
+        self.commit_settings = {'commit_every': commit_every, 'commit_interval': commit_interval, 'async_commit': async_commit}
+        self.workers_count = workers
+        self.media_workers_count = media_workers
+        self.max_media_pending = max_media_pending
+        self.retry_policy = RetryPolicy(retry_attempts, retry_base_delay, retry_max_delay)
+        self.delay_queue = DelayQueue(name=f'{self.topic}-retry')
+        self.consumer = None
+        self.committer = None
+        self.workers = None
         self._stop_event = Event()
+        self._lag_reported = 0.0
 
     def stop(self) -> None:
         self._stop_event.set()
 
     def _stopped(self) -> bool:
         return self._stop_event.is_set()
-    
+
+    def connect(self) -> None:
+
+        # connect создаёт потребителя в потоке потребителя, а не в конструкторе: подключение к kafka
+        # и получение партиций не задерживают запуск процесса
+
+        from wtconsumer import OffsetCommitter, ConversationWorkerPool, LanedWorkerPool, DrainingRebalanceListener
+
+        self.consumer = self.bridge.transport.consumer(self.max_records)
+        self.committer = OffsetCommitter(self.consumer, **self.commit_settings)
+        self.consumer.subscribe([self.topic], listener=DrainingRebalanceListener(self.committer))
+        # -- сообщения с файлами обрабатываются своими потоками: пока они ждут бюджет байт, тексты пересылаются --
+        lanes = {'text': self.workers_count, 'media': self.media_workers_count}
+        self.workers = LanedWorkerPool({lane: ConversationWorkerPool(self.wt_point, self.committer, workers=count,
+                                                                     name=f'{self.topic}-{"worker" if lane == "text" else lane}',
+                                                                     retry_policy=self.retry_policy, delay_queue=self.delay_queue,
+                                                                     dead_letters=self.bridge.dead_letters)
+                                        for lane, count in lanes.items() if count > 0 or lane == 'text'}, self.bridge.tenants.get_lane)
+        self.workers.start()
+
     def handle(self) -> None:
-        tgwacombot.consumeData(self.consumer, self.wt_point, self.options)
+        self.backpressure()
+        self.bridge.tenants.consumeData(self.consumer, self.workers, self.committer, self.max_records, self.poll_timeout_ms)
+        self.report_lag()
+
+    def report_lag(self) -> None:
+
+        # highwater берётся из последних ответов брокера на fetch, поэтому отдельных запросов к kafka нет
+
+        if(monotonic() - self._lag_reported < LAG_INTERVAL):
+            return
+        self._lag_reported = monotonic()
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            if(highwater is not None):
+                CONSUMER_LAG.set(max(0, highwater - self.consumer.position(tp)), tp.topic, tp.partition)
+
+    def backpressure(self) -> None:
+
+        # пока обработчики не разобрали очередь, чтение партиций приостанавливается,
+        # но poll продолжает вызываться, чтобы потребитель оставался в группе. Сообщения с файлами, которые ждут
+        # бюджет байт, копятся в полосе media до max_media_pending; дальше чтение тоже приостанавливается,
+        # а уже полученные тексты обрабатываются
+
+        in_flight = self.committer.tracker.in_flight()
+        media_pending = self.workers.pending('media')
+        for lane in ('text', 'media'):
+            LANE_PENDING.set(self.workers.pending(lane), self.topic, lane)
+        if(in_flight < self.max_in_flight and media_pending < self.max_media_pending):
+            if(self.consumer.paused()):
+                self.consumer.resume(*self.consumer.paused())
+            return
+        if(not self.consumer.paused()):
+            reason = f"{self.max_in_flight} messages in flight" if in_flight >= self.max_in_flight else \
+                     f"{self.max_media_pending} media messages wait for the media budget"
+            log_info(f"Consumer '{self.topic}' paused: {reason}")
+            self.consumer.pause(*self.consumer.assignment())
+        sleep(0.01)
 
     def run(self) -> None:
         log_info('Running Consumer..')
+        self.delay_queue.start()
+        failures = 0
         try:
+            # -- ошибка чтения не останавливает поток: следующий poll выполняется после паузы, которая растёт с каждой ошибкой подряд --
             while not self._stopped():
-                self.handle()
-        except KafkaError as ke:
-            log_error(f'KafkaLogsConsumer error sending log to Kafka: {ke}')  
-            log_exception('message')  
-        except Exception as e:
-            log_error(f'Error in {self.topic}. KafkaLogsProducer exception sending log to Kafka: {e}')
-            log_exception('message')
+                try:
+                    if(self.consumer is None):
+                        self.connect()
+                    self.handle()
+                    failures = 0
+                except self.bridge.transport.errors as ke:
+                    log_error(f'KafkaLogsConsumer error sending log to Kafka: {ke}')
+                    log_exception('message')
+                    failures += 1
+                except Exception as e:
+                    log_error(f'Error in {self.topic}. KafkaLogsProducer exception sending log to Kafka: {e}')
+                    log_exception('message')
+                    failures += 1
+                if(failures):
+                    self._stop_event.wait(self.retry_policy.backoff(failures))
         finally:
-            self.consumer.close()
+            self.delay_queue.stop()
+            if(self.consumer is not None):
+                self.workers.stop()
+                self.committer.close()
+                self.consumer.close()
             log_info(f"consumer with topic '{self.topic}' closed")
 
-def producer_launch(request, topic) -> None:
-    try:
-        data = request.get_json()
-        producer.send(topic, data)
-    except KafkaTimeoutError as kte:
-        log_error(f'KafkaLogsConsumer timeout sending log to Kafka: {kte}')
-        log_exception('message')
-    except KafkaError as ke:
-        log_error(f'KafkaLogsConsumer error sending log to Kafka: {ke}')  
-        log_exception('message')  
-    except Exception as e:
-        log_error(f'WhatsApp Error: {e}')
-        log_exception('message')
-
-def launch_consumers() -> None:
-    whatsapp_consumer_thread = BackgroundThread(target=tgwacombot.wa_point, args=('whatsapp',))
-    telegram_consumer_thread = BackgroundThread(target=tgwacombot.tg_point, args=('telegram',))
-    whatsapp_consumer_thread.start()
-    telegram_consumer_thread.start()
-
-    original_handler = signal.getsignal(signal.SIGINT) 
-
-    def sigint_handler(signum, frame):
-        whatsapp_consumer_thread.stop()
-        telegram_consumer_thread.stop()
-        log_info("Threads stop")
+def consumer_settings() -> dict:
+    return {'max_records': env_int('WT_COMBOT_CONSUMER_MAX_RECORDS', 100),
+            'poll_timeout_ms': env_int('WT_COMBOT_CONSUMER_POLL_TIMEOUT_MS', 500),
+            'commit_every': env_int('WT_COMBOT_COMMIT_EVERY', 100),
+            'commit_interval': env_float('WT_COMBOT_COMMIT_INTERVAL', 5.0),
+            'async_commit': env_bool('WT_COMBOT_COMMIT_ASYNC', True),
+            'workers': env_int('WT_COMBOT_CONSUMER_WORKERS', 4),
+            'max_in_flight': env_int('WT_COMBOT_CONSUMER_MAX_IN_FLIGHT', 1000),
+            'media_workers': env_int('WT_COMBOT_CONSUMER_MEDIA_WORKERS', 2),
+            'max_media_pending': env_int('WT_COMBOT_CONSUMER_MAX_MEDIA_PENDING', 100),
+            'retry_attempts': env_int('WT_COMBOT_RETRY_ATTEMPTS', 5),
+            'retry_base_delay': env_float('WT_COMBOT_RETRY_BASE_DELAY', 1.0),
+            'retry_max_delay': env_float('WT_COMBOT_RETRY_MAX_DELAY', 60.0)}
+
+def create_app(filename=None, role=None, start_consumers=True) -> Flask:
+
+    # create_app создаёт бота и Flask-приложение с маршрутами, нужными роли процесса.
+    # Файл окружения и роль можно передать аргументами или переменными WT_COMBOT_ENVFILE и WT_COMBOT_ROLE.
+    # Для роли all и consumer запускаются потоки-потребители (если start_consumers=True)
+
+    filename = filename or getenv('WT_COMBOT_ENVFILE') or DEFAULT_ENVFILE
+    # -- журнал настраивается до создания ботов, чтобы их записи уже шли через очередь и вычистку секретов --
+    load_dotenv(filename)
+    configure_logging()
+    reload_on_signal(filename)
+    bridge = Bridge(filename)
+    role = role or env_str('WT_COMBOT_ROLE', 'all')
+    if(role not in ROLES):
+        raise ValueError(f"Unknown role: {role}, expected one of {', '.join(ROLES)}")
+    # -- локальная очередь живёт в памяти процесса, поэтому вебхуки и потребители должны быть в одном процессе --
+    if(bridge.transport_name == 'local' and role != 'all'):
+        raise ValueError(f"Role '{role}' needs WT_COMBOT_TRANSPORT=kafka: the local queue works only with role 'all'")
+    if(not bridge.tenants.check_env_variables()):
+        raise RuntimeError(f"Not all environment variables are declared correctly in the file: {filename}")
+
+    app = Flask(__name__)
+    app.extensions['wtcombot'] = bridge
+    app.config['WT_COMBOT_ROLE'] = role
+
+    if(role != 'consumer'):
+        # ВАТСАП
+        @app.route("/w", methods=["GET", "POST"])
+        def wa_webhook():
+            if request.method == "GET":
+                if bridge.tenants.is_wa_verify_token(request.args.get("hub.verify_token")):
+                    response = make_response(request.args.get("hub.challenge"), 200)
+                    response.mimetype = "text/plain"
+                    return response
+            return '', bridge.producer_launch(request, 'whatsapp')
+
+        # ТЕЛЕГРАМ: /t - клиент по умолчанию, /t/<tenant> - клиент из WT_COMBOT_TENANTS
+        @app.route("/t", methods=["POST"])
+        @app.route("/t/<tenant>", methods=["POST"])
+        def tg_webhook(tenant=''):
+            if request.headers.get('content-type') != 'application/json':
+                abort(403)
+            if(bridge.tenants.tenant(tenant) is None):
+                abort(404)
+            return '', bridge.producer_launch(request, 'telegram', tenant)
+
+    # МЕТРИКИ
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        response = make_response(METRICS.render(), 200)
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
+    # ГОТОВНОСТЬ
+    @app.route("/ready", methods=["GET"])
+    def ready():
+        state = bridge.readiness()
+        return jsonify(state), 200 if state['ready'] else 503
 
-        if whatsapp_consumer_thread.is_alive():
-            whatsapp_consumer_thread.join()
-            log_info("Thread stop")
-        if telegram_consumer_thread.is_alive():
-            telegram_consumer_thread.join()
-            log_info("Thread stop")
+    # -- ответ на hub.challenge не ждёт ни kafka, ни ботов: они подключаются в фоне --
+    STARTUP_SECONDS.set(monotonic() - STARTED, 'app')
+    bridge.warm_up(setup=role != 'web', consumers=role != 'web' and start_consumers)
+    return app
 
-        original_handler(signum, frame)
+def stop_on_signals(bridge) -> None:
+
+    # stop_on_signals останавливает потребителей и закрывает соединения по SIGINT и SIGTERM
+
+    def handler(signum, frame):
+        bridge.stop()
+        raise SystemExit(0)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            signal.signal(signum, handler)
+        except ValueError as e:
+            log_error(f'{e}. Continuing execution...')
+
+def reload_on_signal(filename) -> None:
+
+    # reload_on_signal перечитывает по SIGHUP файл окружения и применяет WT_COMBOT_LOG_LEVEL и WT_COMBOT_LOG_SAMPLE
+    # без перезапуска: например, чтобы на время записать все вебхуки
+
+    def handler(signum, frame):
+        load_dotenv(filename, override=True)
+        configure_logging()
+        log_info(f"Logging settings reloaded from {filename}")
 
     try:
-        signal.signal(signal.SIGINT, sigint_handler)
-    except ValueError as e:
+        signal.signal(signal.SIGHUP, handler)
+    except (ValueError, AttributeError) as e:
         log_error(f'{e}. Continuing execution...')
 
-# ВАТСАП
-@app.route("/w", methods=["GET", "POST"])
-def wa_webhook():
-    if request.method == "GET":
-        if request.args.get("hub.verify_token") == tgwacombot.get_wa_verify_token():
-            response = make_response(request.args.get("hub.challenge"), 200)
-            response.mimetype = "text/plain"
-            return response
-    producer_launch(request, 'whatsapp')
-    return ''
-
-
-# ТЕЛЕГРАМ
-@app.route("/t", methods=["POST"])
-def tg_webhook():
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = tb_types.Update.de_json(json_string)
-        tgwacombot.telegram_bot.process_new_updates([update])
-        producer_launch(request, 'telegram')
-    else:
-        abort(403)
-    return ''
+def parse_args():
+    parser = ArgumentParser(description='WhatsApp - Telegram bridge')
+    parser.add_argument('envfile', nargs='?', default=DEFAULT_ENVFILE, help='env file with the settings of the bot')
+    parser.add_argument('--role', choices=ROLES, default=None, help='all (default), web or consumer; WT_COMBOT_ROLE by default')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=0, help='web worker processes of the pre-fork server, 0 to serve from this process')
+    parser.add_argument('--debug', action='store_true', help='Flask development server with the interactive debugger, for local development only')
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    if tgwacombot.check_env_variables():
-        tgwacombot.setup()
-        launch_consumers()
-        app.run(port=5000, debug=True, use_reloader=False)
+    args = parse_args()
+    load_dotenv(args.envfile)
+    configure_logging(force=True)
+    if(args.workers > 0):
+        # -- каждый воркер создаёт приложение (и продюсер) сам, уже после fork; потребители запускаются отдельным процессом --
+        if(args.role not in (None, 'web')):
+            raise SystemExit("--workers runs only the web role, start the consumers with --role consumer")
+        from wtserve import PreforkServer
+        PreforkServer(lambda: create_app(args.envfile, 'web'), args.host, args.port, args.workers).serve()
     else:
-        log_error(f"Not all environment variables are declared correctly in the file: {filename}")
\ No newline at end of file
+        try:
+            app = create_app(args.envfile, args.role)
+        except (ValueError, RuntimeError) as err:
+            log_error(str(err))
+            raise SystemExit(1)
+        stop_on_signals(app.extensions['wtcombot'])
+        if(args.debug):
+            # -- отладчик werkzeug выполняет код из браузера: только для разработки и только на 127.0.0.1 --
+            app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
+        else:
+            from wtserve import serve_app
+            serve_app(app, args.host, args.port)
@@ -1,13 +1,79 @@
+from typing import BinaryIO
+from re import compile as re_compile
 from wterror import WTCombotError
-from telebot import TeleBot
+from wtmetrics import STAGE_SECONDS, MEDIA_BYTES
+from wtmedia import spool_response, SPOOL_SIZE
+from wthttp import create_session
+from wtratelimit import OutboundScheduler, PRIORITY_CUSTOMER
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
 from telebot import types
 
 MAX_MESSAGE_LENGTH = 4096
 MAX_CAPTION_LENGTH = 1024
+FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+MAX_ENTITY_LENGTH = 32
+HTML_ENTITY = re_compile(r'&#?[0-9A-Za-z]{1,30};')
+
+
+def stream_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+
+    # stream_request_sender отправляет файлы в телеграм через MultipartEncoder:
+    # тело запроса читается из файла по частям, а не собирается в памяти целиком, как в requests
+
+    session = apihelper._get_req_session()
+    if(not files):
+        return session.request(method, url, params=params, timeout=timeout, proxies=proxies)
+    fields = {key: value if isinstance(value, tuple) else (key, value) for key, value in files.items()}
+    form_data = MultipartEncoder(fields=fields)
+    MEDIA_BYTES.inc('tg_upload', amount=form_data.len)
+    return session.request(method, url, params=params, data=form_data, headers={'Content-Type': form_data.content_type},
+                           timeout=timeout, proxies=proxies)
+
+
+def _safe_end(text, start, end) -> int:
+
+    # _safe_end сдвигает конец части влево, если он попадает внутрь HTML-тега или HTML-сущности
+
+    tag_start = text.rfind('<', start, end)
+    if(tag_start > text.rfind('>', start, end)):
+        return tag_start if tag_start > start else end
+    entity_start = text.rfind('&', max(start, end - MAX_ENTITY_LENGTH), end)
+    if(entity_start != -1):
+        entity = HTML_ENTITY.match(text, entity_start)
+        if(entity and entity.end() > end and entity_start > start):
+            return entity_start
+    return end
+
+
+def _find_separator(text, start, end, separator) -> int:
+
+    # _find_separator ищет последний разделитель в text[start:end], пропуская разделители внутри тегов
+
+    position = text.rfind(separator, start, end)
+    while position != -1:
+        tag_start = text.rfind('<', start, position)
+        if(tag_start <= text.rfind('>', start, position)):
+            return position
+        position = text.rfind(separator, start, tag_start)
+    return position
+
 
 class TelegramBot(TeleBot):
-    def __init__(self, TG_API_TOKEN):
-        super().__init__(TG_API_TOKEN)
+    def __init__(self, TG_API_TOKEN, spool_size=SPOOL_SIZE, session=None, scheduler=None, sign_every_part=True):
+        # -- обновления приходят вебхуком в потребителей: пул потоков для обработчиков telebot не нужен --
+        super().__init__(TG_API_TOKEN, threaded=False)
+        # -- телеграм пропускает в группу около 20 сообщений в минуту --
+        self.scheduler = scheduler if scheduler else OutboundScheduler('telegram', rate=20 / 60, capacity=20)
+        # -- все запросы к Bot API идут через одну сессию с пулом постоянных соединений --
+        self.session = session if session else create_session('telegram')
+        apihelper.session = self.session
+        apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT = self.session.timeout
+        apihelper.CUSTOM_REQUEST_SENDER = stream_request_sender
+        self.spool_size = spool_size
+        # -- подпись с номером нужна в каждой части длинного сообщения, только если ответы ищут номер по тексту --
+        self.sign_every_part = sign_every_part
         self.telegram_content_types = ['text', 'document', 'audio', 'photo','video', 'video_note','voice', 'location']
         # -- сообщения о ошибках, которые ватсап-бот будет отправлять в чат --
         self.error_notifications = {"content": "This type of content cannot be forwarded to our operators", 
@@ -17,6 +83,19 @@ class TelegramBot(TeleBot):
         last_line = reply_message_text.split("\n")[-1]
         return last_line.split(" ")[-2]
 
+    def get_sent_message_ids(self, sent_message) -> list[int]:
+
+        # get_sent_message_ids возвращает id всех сообщений, которыми бот отправил одно сообщение из ватсапа
+
+        return getattr(sent_message, 'relay_message_ids', None) or [sent_message.message_id]
+
+    def get_relay_key(self, update) -> str|None:
+
+        # get_relay_key - ключ обновления для поиска повторов
+
+        update_id = update.get('update_id')
+        return f"tg:{update_id}" if update_id is not None else None
+
     def get_content_type(self, message) -> str:
         for type in self.telegram_content_types:
             if type in message:
@@ -44,46 +123,86 @@ class TelegramBot(TeleBot):
         photo_id = message['photo'][-1]['file_id']
         return photo_id
 
+    def get_file_unique_id(self, message, content_type) -> str|None:
+        if(content_type == 'photo'):
+            return message['photo'][-1].get('file_unique_id')
+        return message[content_type].get('file_unique_id')
+
     def get_filename(self, message, content_type) -> str:
         return message[content_type]['file_name'].rsplit(".",1)[0]
 
+    def download_file_stream(self, file_path, digest=None) -> BinaryIO:
+
+        # download_file_stream скачивает файл частями, не загружая его целиком в память
+
+        file_url = (apihelper.FILE_URL or FILE_URL).format(self.token, file_path)
+        with STAGE_SECONDS.time('tg_download'):
+            r = apihelper._get_req_session().get(file_url, stream=True, timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT),
+                                                 proxies=apihelper.proxy)
+            return spool_response(r, self.spool_size, digest=digest, stage='tg_download')
+
     def get_geodata(self, message) -> tuple[float, float]:
         return message['location']['latitude'], message['location']['longitude']
 
     def get_place(self, location) -> tuple[str, str]:
         return location.get('title', ''), location.get('address', '')
 
-    def send_message(self, chat_id, message, postscript, mode='HTML', reply_id=None) -> types.Message:
+    def send_message(self, chat_id, message, postscript, mode='HTML', reply_id=None, priority=PRIORITY_CUSTOMER) -> types.Message:
         send_message_args = {'chat_id':chat_id, 'parse_mode':mode,'disable_web_page_preview':True, 'reply_to_message_id':reply_id}
-        return self.send_multiply_message(super().send_message, message, postscript, is_text=True, **send_message_args)
+        return self.send_multiply_message(super().send_message, message, postscript, is_text=True, priority=priority, **send_message_args)
 
     def send_document(self, chat_id, document, document_file_name, postscript, mode='HTML', reply_id=None) -> types.Message:
-        return super().send_document(chat_id, document=document, caption=postscript, visible_file_name=document_file_name,  
-                                     parse_mode=mode, reply_to_message_id=reply_id, allow_sending_without_reply=True)
+        return self.__limited__(super().send_document, chat_id=chat_id, document=document, caption=postscript, visible_file_name=document_file_name,  
+                                parse_mode=mode, reply_to_message_id=reply_id, allow_sending_without_reply=True)
 
     def send_photo(self, chat_id, photo, message, postscript, mode='HTML', reply_id=None) -> types.Message:
         send_photo_args = {'chat_id':chat_id, 'photo':photo, 'parse_mode':mode, 'reply_to_message_id':reply_id}
         return self.send_multiply_message(super().send_photo, message, postscript, is_text=False, **send_photo_args)
 
     def send_audio(self, chat_id, audio, postscript, mode='HTML', reply_id=None) -> types.Message:
-        return super().send_audio(chat_id, audio=audio, caption=postscript, parse_mode=mode, reply_to_message_id = reply_id, 
-                                  allow_sending_without_reply=True)
+        return self.__limited__(super().send_audio, chat_id=chat_id, audio=audio, caption=postscript, parse_mode=mode, reply_to_message_id = reply_id, 
+                                allow_sending_without_reply=True)
 
     def send_video(self, chat_id, video, message, postscript, mode='HTML', reply_id=None) -> types.Message:
         send_video_args = {'chat_id':chat_id, 'video':video, 'parse_mode':mode, 'reply_to_message_id':reply_id}
         return self.send_multiply_message(super().send_video, message, postscript, is_text=False, **send_video_args)
 
+    def send_media_group(self, chat_id, items, postscript, mode='HTML', reply_id=None) -> types.Message:
+
+        # send_media_group отправляет фото и видео одним альбомом. items - тройки (тип сообщения ватсапа: image или video,
+        # файл, подпись). Подписи файлов объединяются в подпись первого файла с одной подписью пользователя;
+        # что не поместилось, отправляется ответом на альбом, как у send_multiply_message
+
+        caption = "\n".join(item_caption for _, _, item_caption in items if item_caption)
+        text_list = self.smart_split(caption, postscript, MAX_CAPTION_LENGTH, self.sign_every_part)
+        media = []
+        for index, (content_type, content, _) in enumerate(items):
+            input_media = types.InputMediaPhoto if content_type == 'image' else types.InputMediaVideo
+            media.append(input_media(content, caption=text_list[0] if index == 0 and text_list else None, parse_mode=mode))
+        messages = self.__limited__(super().send_media_group, chat_id=chat_id, media=media, reply_to_message_id=reply_id,
+                                    allow_sending_without_reply=True)
+        message_ids = [message.message_id for message in messages]
+        sent_message = messages[0]
+        for text in text_list[1:]:
+            sent_message = self.__limited__(super().send_message, chat_id=chat_id, text=text, parse_mode=mode, disable_web_page_preview=True,
+                                            reply_to_message_id=sent_message.message_id, allow_sending_without_reply=True)
+            message_ids.append(sent_message.message_id)
+        sent_message.relay_message_ids = message_ids
+        return sent_message
+
     def send_location(self, chat_id, latitude, longitude, title, address, postscript, mode='HTML', reply_id=None) -> types.Message:
-        location_message = super().send_venue(chat_id, latitude=latitude, longitude=longitude, title=title, address=address, 
-                                              reply_to_message_id=reply_id, allow_sending_without_reply=True)
+        location_message = self.__limited__(super().send_venue, chat_id=chat_id, latitude=latitude, longitude=longitude, title=title, address=address, 
+                                            reply_to_message_id=reply_id, allow_sending_without_reply=True)
         if(reply_id):
             return location_message
         if(location_message):
-            return super().send_message(chat_id, text=postscript, parse_mode=mode, disable_web_page_preview=True, 
-                                        reply_to_message_id=location_message.message_id, allow_sending_without_reply=True)
+            sent_message = self.__limited__(super().send_message, chat_id=chat_id, text=postscript, parse_mode=mode, disable_web_page_preview=True, 
+                                            reply_to_message_id=location_message.message_id, allow_sending_without_reply=True)
+            sent_message.relay_message_ids = [location_message.message_id, sent_message.message_id]
+            return sent_message
         raise WTCombotError(self.error_notifications['content'])
 
-    def send_multiply_message(self, sending_func, message, postscript, is_text, **kwargs) -> types.Message:
+    def send_multiply_message(self, sending_func, message, postscript, is_text, priority=PRIORITY_CUSTOMER, **kwargs) -> types.Message:
         if(is_text):
             type_text = 'text'
             message_length = MAX_MESSAGE_LENGTH
@@ -91,51 +210,86 @@ class TelegramBot(TeleBot):
             type_text = 'caption'
             message_length = MAX_CAPTION_LENGTH
 
-        text_list = self.smart_split(message, postscript, message_length)
+        text_list = self.smart_split(message, postscript, message_length, self.sign_every_part)
         if(len(text_list)>0):
             kwargs[type_text] = text_list[0]
         kwargs['allow_sending_without_reply'] = True
-        sent_message = sending_func(**kwargs)
+        sent_message = self.__limited__(sending_func, priority=priority, **kwargs)
+        message_ids = [sent_message.message_id]
 
         text_list = text_list[1:] if len(text_list) > 1 else []
         for text in text_list:
-            sent_message = super().send_message(chat_id=kwargs['chat_id'], text=text, parse_mode=kwargs['parse_mode'], 
-                                                disable_web_page_preview=True, reply_to_message_id=sent_message.message_id, 
-                                                allow_sending_without_reply=True)
+            sent_message = self.__limited__(super().send_message, priority=priority, chat_id=kwargs['chat_id'], text=text, parse_mode=kwargs['parse_mode'], 
+                                            disable_web_page_preview=True, reply_to_message_id=sent_message.message_id, 
+                                            allow_sending_without_reply=True)
+            message_ids.append(sent_message.message_id)
+        sent_message.relay_message_ids = message_ids
         return sent_message
 
-    def smart_split(self, text: str, postscript: str='', chars_per_string: int=MAX_MESSAGE_LENGTH) -> list[str]:
+    def __limited__(self, sending_func, priority=PRIORITY_CUSTOMER, **kwargs) -> types.Message:
+
+        # __limited__ отправляет сообщение через планировщик с лимитом на чат;
+        # при повторе после 429 файлы (и файлы альбома) перематываются в начало
+
+        def send():
+            for value in kwargs.values():
+                for file in (getattr(item, 'media', None) for item in value) if isinstance(value, list) else (value,):
+                    if(hasattr(file, 'seek')):
+                        file.seek(0)
+            with STAGE_SECONDS.time('tg_send'):
+                return sending_func(**kwargs)
+
+        return self.scheduler.call(kwargs['chat_id'], send, priority, self.__retry_after__)
+
+    def __retry_after__(self, err) -> float|None:
+        if(isinstance(err, ApiTelegramException) and err.error_code == 429):
+            return (err.result_json.get('parameters') or {}).get('retry_after', 0)
+        return None
+
+    def smart_split(self, text: str, postscript: str='', chars_per_string: int=MAX_MESSAGE_LENGTH, sign_every_part: bool=True) -> list[str]:
 
         """
         Данный метод взят из модуля util библиотеки telebot.
         Разбивает одно сообщение на несколько строк с максимальным количеством символов `chars_per_string` в строке.
         Разделяет на '\n', '. ' или ' ' именно в этом приоритете.
         В качестве дополнения метод smart_split подписывает `postscript` каждое сообщение.
+        Текст проходится один раз по индексам, без копирования остатка на каждом шаге;
+        сообщение никогда не разрезается внутри HTML-тега или HTML-сущности (&amp;, &#39; ...).
+        При sign_every_part=False подписывается только последняя часть.
         """
 
-        def _text_before_last(substr: str) -> str:
-            text_before = substr.join(part.split(substr)[:-1])
-            text_before += substr if(substr != '\n') else ' '
-            return text_before
-       
+        if(not sign_every_part):
+            parts = self.smart_split(text, '', chars_per_string)
+            if(parts and len(parts[-1]) + len(postscript) <= chars_per_string):
+                parts[-1] += postscript
+            elif(postscript):
+                parts.append(postscript.lstrip())
+            return parts
+
         chars_per_string -= len(postscript)
 
         parts = []
+        start = 0
         while chars_per_string > 0:
-            if len(text) < chars_per_string:
+            if len(text) - start < chars_per_string:
                 # if(len(text)>0):
-                parts.append(text + postscript)
+                parts.append(text[start:] + postscript)
                 return parts
 
-            part = text[:chars_per_string]
+            end = _safe_end(text, start, start + chars_per_string)
 
-            if "\n" in part: part = _text_before_last("\n")
-            elif ". " in part: part = _text_before_last(". ")
-            elif " " in part: part = _text_before_last(" ")
+            for separator in ('\n', '. ', ' '):
+                position = _find_separator(text, start, end, separator)
+                if(position != -1):
+                    if(separator == '\n'):
+                        part, start = text[start:position] + ' ', position + 1
+                    else:
+                        part, start = text[start:position + len(separator)], position + len(separator)
+                    break
+            else:
+                part, start = text[start:end], end
 
             if(part not in ['\n', '.', ' ']): 
                 parts.append(part + postscript)
-
-            text = text[len(part):]
             
-        return parts
\ No newline at end of file
+        return parts
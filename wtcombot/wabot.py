@@ -1,23 +1,37 @@
-import requests
 from logging import info as log_info, error as log_error
 
 from mimetypes import guess_type
+from typing import BinaryIO
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 from heyoo import WhatsApp
 
-from wterror import WTCombotError
+from wterror import WTCombotError, WTCombotRateLimitError, WTCombotTransientError
+from wtmedia import spool_response, SPOOL_SIZE
+from wtmetrics import STAGE_SECONDS, MEDIA_BYTES
+from wthttp import create_session
+from wtratelimit import OutboundScheduler, PRIORITY_CUSTOMER
+
+# -- коды ошибок Graph API, означающие превышение лимита --
+RATE_LIMIT_CODES = (4, 613, 80007, 130429, 131056)
 
 
 class WhatsAppBot(WhatsApp):
 
-    def __init__(self, WA_ACCESS_TOKEN, WA_NUMBER_ID):
+    def __init__(self, WA_ACCESS_TOKEN, WA_NUMBER_ID, spool_size=SPOOL_SIZE, session=None, scheduler=None):
         super().__init__(WA_ACCESS_TOKEN,  phone_number_id = WA_NUMBER_ID)
         self.base_url = "https://graph.facebook.com/v15.0"
+        self.url = f"{self.base_url}/{self.phone_number_id}/messages"
+        self.spool_size = spool_size
+        # -- все запросы к Graph API идут через одну сессию с пулом постоянных соединений --
+        self.session = session if session else create_session('whatsapp')
+        # -- лимит на пару "бизнес-номер - пользователь": в среднем одно сообщение в 6 секунд --
+        self.scheduler = scheduler if scheduler else OutboundScheduler('whatsapp', rate=1 / 6, capacity=45)
         # -- сообщения о ошибках, которые телеграм-бот будет отправлять в чат --
         self.error_notifications = {"uploading": "Error uploading media", 
                                     "sending":"Error sending message", 
                                     "content": "Content error", 
                                     "number": "Please, reply to the message that contains the phone number",
+                                    "too_large": "The file is too large for WhatsApp",
                                      131047 : "Message failed to send because more than 24 hours have passed since the customer last replied to this number."}
         self.file = None
         
@@ -30,6 +44,45 @@ class WhatsAppBot(WhatsApp):
         generated_message += f'<a href="https://wa.me/{number}">{username}</a>' + " +" + number + " #ID" + number
         return f'{generated_message}'
 
+    def split_envelope(self, json_data) -> list[dict]:
+
+        # split_envelope раскладывает вебхук на отдельные сообщения и статусы в порядке их следования.
+        # Каждый элемент устроен как value из вебхука с одним сообщением и его контактом или с одним статусом,
+        # поэтому к нему применимы get_mobile, get_name, get_status и остальные методы
+
+        items = []
+        for entry in json_data.get("entry", []):
+            for change in entry.get("changes", []):
+                if(change.get("field") != "messages"):
+                    continue
+                value = change.get("value", {})
+                common = {key: item for key, item in value.items() if key not in ("contacts", "messages", "statuses")}
+                contacts = {contact.get("wa_id"): contact for contact in value.get("contacts", [])}
+                for message in value.get("messages", []):
+                    contact = contacts.get(message.get("from")) or {"profile": {"name": ""}, "wa_id": message.get("from")}
+                    items.append({**common, "contacts": [contact], "messages": [message]})
+                for status in value.get("statuses", []):
+                    items.append({**common, "statuses": [status]})
+        return items
+
+    def join_envelope(self, items) -> dict:
+
+        # join_envelope - обратное split_envelope: вебхук с элементами items, который снова разберут wa_point и split_envelope
+
+        return {"object": "whatsapp_business_account", "entry": [{"changes": [{"field": "messages", "value": item} for item in items]}]}
+
+    def get_relay_key(self, prep_data) -> str|None:
+
+        # get_relay_key - ключ сообщения или статуса для поиска повторов: wamid, у статуса ещё и его тип
+
+        if(prep_data.get("messages")):
+            message_id = prep_data["messages"][0].get("id")
+            return f"wa:{message_id}" if message_id else None
+        status = self.get_status(prep_data)
+        if(status and status.get("id")):
+            return f"wa:{status['id']}:{status.get('status', '')}"
+        return None
+
     def get_name(self, prep_data) -> str:
         return prep_data["contacts"][0]["profile"]["name"]
         
@@ -55,16 +108,39 @@ class WhatsAppBot(WhatsApp):
     def get_message_type(self, prep_data) -> str:
         return prep_data["messages"][0]["type"]
 
-    def get_binary_file(self, file) -> bytes:
+    def get_binary_file(self, file, media_info=None) -> BinaryIO:
+
+        # get_binary_file скачивает файл сообщения; media_info - уже полученный ответ query_media_info
+
         file_id, mime_type = file["id"], file["mime_type"]
-        file_url = self.query_media_url(file_id)
-        content = self.get_content(file_url, mime_type)
+        with STAGE_SECONDS.time('wa_download'):
+            if(media_info is None):
+                media_info = self.query_media_info(file_id)
+            content = self.get_content(media_info["url"] if media_info else None, mime_type)
         return content
     
-    def get_content(self, media_url, mime_type) -> bytes:
-        r = requests.get(media_url, headers=self.headers)
-        content = r.content
-        return content
+    def get_content(self, media_url, mime_type) -> BinaryIO:
+
+        # get_content скачивает файл частями, не загружая его целиком в память
+
+        r = self.session.get(media_url, headers=self.headers, stream=True)
+        return spool_response(r, self.spool_size, stage='wa_download')
+
+    def query_media_url(self, media_id) -> str|None:
+        media_info = self.query_media_info(media_id)
+        return media_info["url"] if media_info else None
+
+    def query_media_info(self, media_id) -> dict|None:
+
+        # query_media_info возвращает url файла, его mime_type и размер file_size, не скачивая сам файл
+
+        r = self.session.get(f"{self.base_url}/{media_id}", headers=self.headers)
+        if r.status_code == 200:
+            return r.json()
+        log_error(f"Error querying media url {media_id}: {r.status_code}")
+        if r.status_code >= 500 or r.status_code == 429:
+            raise WTCombotTransientError(self.error_notifications["sending"])
+        return None
 
     def get_data(self, prep_data, content_type) -> dict:
         return prep_data["messages"][0][content_type]
@@ -91,28 +167,34 @@ class WhatsAppBot(WhatsApp):
     def get_message(self, prep_data) -> str:
         return prep_data.get('body', '')
 
-    def send_message(self, message, number):
-        response = super().send_message(message, number)
+    def send_message(self, message, number, priority=PRIORITY_CUSTOMER):
+        data = {"type": "text", "text": {"preview_url": True, "body": message}}
+        response = self.__send__(data, number, priority)
         return self.__check_message__(response, None, number)
        
     def send_document(self, media_id, number, filename, second_message):
-        response = super().send_document(document=media_id, recipient_id=number, caption=filename, link=False)
+        data = {"type": "document", "document": {"id": media_id, "caption": filename}}
+        response = self.__send__(data, number)
         return self.__check_message__(response, second_message, number)
 
     def send_image(self, media_id, number, caption_text):
-        response = super().send_image(image=media_id, recipient_id=number, caption=caption_text, link=False)
+        data = {"type": "image", "image": {"id": media_id, "caption": caption_text}}
+        response = self.__send__(data, number)
         return self.__check_message__(response, None, number)
 
     def send_audio(self, media_id, number, second_message):
-        response = super().send_audio(audio=media_id, recipient_id=number, link=False)
+        data = {"type": "audio", "audio": {"id": media_id}}
+        response = self.__send__(data, number)
         return self.__check_message__(response, second_message, number)
 
     def send_video(self, media_id, number, caption_text):
-        response = super().send_video(video=media_id, recipient_id=number, caption=caption_text, link=False)
+        data = {"type": "video", "video": {"id": media_id, "caption": caption_text}}
+        response = self.__send__(data, number)
         return self.__check_message__(response, None, number)
     
     def send_location(self, location_latitude, location_longitude, title, address, number):
-        response = super().send_location(lat=location_latitude, long=location_longitude, name=title, address=address, recipient_id=number)
+        data = {"type": "location", "location": {"latitude": location_latitude, "longitude": location_longitude, "name": title, "address": address}}
+        response = self.__send__(data, number)
         return self.__check_message__(response, None, number)
 
     def upload_media(self, content, media, content_type = None) -> dict:
@@ -131,24 +213,56 @@ class WhatsAppBot(WhatsApp):
         form_data = MultipartEncoder(fields=form_data)
         headers = self.headers.copy()
         headers["Content-Type"] = form_data.content_type
-        log_info(f"headers: {headers}")
-        log_info(f"Content-Type: {form_data.content_type}")
         log_info(f"Uploading media: {media}")
       
-        r = requests.post(
-            f"{self.base_url}/{self.phone_number_id}/media",
-            headers=headers,
-            data=form_data
-            )
+        with STAGE_SECONDS.time('wa_upload'):
+            r = self.session.post(
+                f"{self.base_url}/{self.phone_number_id}/media",
+                headers=headers,
+                data=form_data
+                )
 
         if r.status_code == 200:
             log_info(f"Media {media} uploaded")
+            MEDIA_BYTES.inc('wa_upload', amount=form_data.len)
             return r.json()
-        log_info(f"Error uploading media {media}")
-        log_info(f"Status code: {r.status_code}")
-        log_info(f"Response: {r.json()}")
+        if r.status_code >= 500 or r.status_code == 429:
+            log_error(f"Error uploading media {media}: {r.status_code}")
+            raise WTCombotTransientError(self.error_notifications["uploading"])
+        log_error(f"Error uploading media {media}: {r.status_code}, response: {r.text}")
         raise WTCombotError(self.error_notifications["uploading"])
 
+    def __send__(self, data, number, priority=PRIORITY_CUSTOMER) -> dict:
+
+        # __send__ отправляет сообщение через Graph API (вместо requests.post в heyoo) с учётом лимита на номер
+
+        data = {"messaging_product": "whatsapp", "recipient_type": "individual", "to": number, **data}
+
+        def send() -> dict:
+            with STAGE_SECONDS.time('wa_send'):
+                r = self.session.post(self.url, headers=self.headers, json=data)
+            if(r.status_code >= 500):
+                raise WTCombotTransientError(self.error_notifications["sending"])
+            response = r.json()
+            error = response.get("error") or {}
+            if(r.status_code == 429 or error.get("code") in RATE_LIMIT_CODES):
+                raise WTCombotRateLimitError(self.error_notifications["sending"], retry_after=r.headers.get("Retry-After"))
+            return response
+
+        try:
+            return self.scheduler.call(number, send, priority, self.__retry_after__)
+        except WTCombotRateLimitError as err:
+            log_error(f"Whatsapp rate limit for {number} exceeded after {self.scheduler.max_retries} retries")
+            raise WTCombotTransientError(err.get_message())
+
+    def __retry_after__(self, err) -> float|None:
+        if(isinstance(err, WTCombotRateLimitError)):
+            try:
+                return float(err.retry_after) if err.retry_after else 0
+            except ValueError:
+                return 0
+        return None
+
     def __check_message__(self, response, second_message, number) -> dict:
 
         # __check_message__  генерирует исключение, если запрос завершился с ошибкой.
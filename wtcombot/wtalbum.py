@@ -0,0 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from wtcoalesce import BatchCollector
+from wtmetrics import ALBUMS, ALBUM_ITEMS
+
+# -- больше файлов телеграм в один альбом не принимает --
+MAX_ALBUM_ITEMS = 10
+
+
+class AlbumCollector(BatchCollector):
+
+    # AlbumCollector собирает фото и видео, которые пользователь прислал подряд, и передаёт их в send(number, items, name)
+    # одним альбомом, не больше max_items файлов. Отправка, повторы и on_failure - как у TextCoalescer (см. BatchCollector).
+    # run_parallel скачивает файлы альбома одновременно в отдельном пуле из downloads потоков
+
+    name = 'album'
+
+    def __init__(self, send, window=1.0, max_items=MAX_ALBUM_ITEMS, workers=4, downloads=MAX_ALBUM_ITEMS, retry_policy=None, on_failure=None):
+        super().__init__(self.__send, window, min(max(1, max_items), MAX_ALBUM_ITEMS), workers, retry_policy, on_failure)
+        self.send_album = send
+        self.__downloads = ThreadPoolExecutor(max(1, downloads), thread_name_prefix='album-download')
+
+    def run_parallel(self, function, items) -> list:
+
+        # run_parallel вызывает function для каждого элемента в пуле скачивания и возвращает результаты по порядку.
+        # Ошибка поднимается, только когда завершились все вызовы: их результаты (открытые файлы) не теряются
+
+        futures = [self.__downloads.submit(function, item) for item in items]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def stop(self) -> None:
+        super().stop()
+        self.__downloads.shutdown(wait=True)
+
+    def __send(self, number, items, name) -> None:
+        self.send_album(number, items, name)
+        if(len(items) > 1):
+            ALBUMS.inc()
+            ALBUM_ITEMS.inc(amount=len(items))
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+from threading import Condition
+
+from wtmetrics import STAGE_SECONDS, MEDIA_BUDGET_BYTES, MEDIA_BUDGET_WAITING
+from wtlog import log_sampled
+
+# -- сумма размеров файлов, которые процесс одновременно скачивает, держит и загружает, байты --
+MEDIA_BUDGET = 256 * 1024 * 1024
+# -- столько занимает файл, размер которого API не сообщил --
+UNKNOWN_SIZE = 16 * 1024 * 1024
+BUDGET_WAIT = 60.0
+
+
+class BudgetTimeoutError(Exception):
+    pass
+
+
+class Reservation():
+
+    # Reservation - байты, занятые одним файлом. resize поправляет их по фактическому размеру скачанного файла:
+    # файл уже в памяти или на диске, поэтому рост не ждёт свободного бюджета
+
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.size = size
+
+    def resize(self, size) -> None:
+        self.budget._resize(self, size)
+
+
+class ByteBudget():
+
+    # ByteBudget - семафор, взвешенный размером файла: перед скачиванием файл занимает столько байт, сколько заявлено
+    # в file_size (телеграм) или в ответе Graph API (ватсап), и освобождает их после отправки. Пока бюджет занят,
+    # поток ждёт, а не скачивает ещё один файл. Файл больше всего бюджета ждёт, пока бюджет не освободится целиком,
+    # и идёт один. limit=0 отключает ограничение, но использование всё равно считается
+
+    def __init__(self, limit=MEDIA_BUDGET, unknown_size=UNKNOWN_SIZE, timeout=BUDGET_WAIT):
+        self.limit = limit
+        self.unknown_size = unknown_size
+        self.timeout = timeout
+        self.in_use = 0
+        self.peak = 0
+        self.waiting = 0
+        self.__condition = Condition()
+        MEDIA_BUDGET_BYTES.set(limit, 'limit')
+        self.__report()
+
+    @contextmanager
+    def hold(self, size, direction=''):
+
+        # hold занимает size байт на время блока; BudgetTimeoutError, если бюджет не освободился за timeout секунд
+
+        reservation = self.acquire(size, direction)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    def acquire(self, size, direction='') -> Reservation:
+        size = self.unknown_size if size is None else max(0, int(size))
+        # -- файл больше бюджета иначе не дождался бы своей очереди --
+        needed = min(size, self.limit) if self.limit > 0 else 0
+        with self.__condition:
+            if(self.limit > 0 and self.in_use + needed > self.limit):
+                self.waiting += 1
+                self.__report()
+                log_sampled('budget', f"Media budget is exhausted: {self.in_use} of {self.limit} bytes in use, {direction} file of {size} bytes waits")
+                try:
+                    with STAGE_SECONDS.time('media_budget_wait'):
+                        ready = self.__condition.wait_for(lambda: self.in_use + needed <= self.limit, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if(not ready):
+                    self.__report()
+                    raise BudgetTimeoutError(f"Media budget is busy for {self.timeout} s: {self.in_use} of {self.limit} bytes in use")
+            self.in_use += size
+            self.__report()
+        return Reservation(self, size)
+
+    def try_acquire(self, size) -> Reservation|None:
+
+        # try_acquire занимает size байт, только если они свободны сейчас; None, если пришлось бы ждать
+
+        size = max(0, int(size))
+        with self.__condition:
+            if(self.limit > 0 and self.in_use + size > self.limit):
+                return None
+            self.in_use += size
+            self.__report()
+        return Reservation(self, size)
+
+    def release(self, reservation) -> None:
+        with self.__condition:
+            self.in_use -= reservation.size
+            reservation.size = 0
+            self.__report()
+            self.__condition.notify_all()
+
+    def stats(self) -> dict:
+        return {'limit': self.limit, 'in_use': self.in_use, 'peak': self.peak, 'waiting': self.waiting}
+
+    def _resize(self, reservation, size) -> None:
+        with self.__condition:
+            self.in_use += size - reservation.size
+            reservation.size = size
+            self.__report()
+            self.__condition.notify_all()
+
+    def __report(self) -> None:
+        self.peak = max(self.peak, self.in_use)
+        MEDIA_BUDGET_BYTES.set(self.in_use, 'in_use')
+        MEDIA_BUDGET_BYTES.set(self.peak, 'peak')
+        MEDIA_BUDGET_WAITING.set(self.waiting)
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from wtmetrics import CACHE_REQUESTS, CACHE_EVICTIONS
+
+
+class LRUCache():
+
+    # LRUCache - ограниченный по размеру кэш с вытеснением давно неиспользуемых записей и временем жизни записей.
+    # Попадания, промахи и вытеснения считаются в метриках wtcombot_cache_* с меткой cache=name
+
+    def __init__(self, maxsize=1024, ttl=300.0, name='cache'):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__data = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key, default=None, stale=False):
+
+        # при stale=True возвращает и просроченную запись - она нужна, когда база недоступна
+
+        with self.__lock:
+            item = self.__data.get(key)
+            if(item is None):
+                if(not stale):
+                    self.misses += 1
+                    CACHE_REQUESTS.inc(self.name, 'miss')
+                return default
+            value, expires = item
+            if(not stale):
+                if(expires < monotonic()):
+                    self.misses += 1
+                    CACHE_REQUESTS.inc(self.name, 'miss')
+                    return default
+                self.hits += 1
+                CACHE_REQUESTS.inc(self.name, 'hit')
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None) -> None:
+        if(self.maxsize <= 0):
+            return
+        with self.__lock:
+            self.__data[key] = (value, monotonic() + (self.ttl if ttl is None else ttl))
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+                self.evictions += 1
+                CACHE_EVICTIONS.inc(self.name)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            item = self.__data.pop(key, None)
+            return item[0] if item else default
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__data.clear()
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'size': len(self.__data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
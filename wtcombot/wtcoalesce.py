@@ -0,0 +1,208 @@
+from logging import info as log_info, error as log_error, exception as log_exception
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
+from time import monotonic
+from zlib import crc32
+
+from wtmetrics import COALESCED, RETRIES
+
+SEND_LOCKS = 64
+
+
+class PendingBatch():
+    def __init__(self, name, deadline):
+        self.items = []
+        self.keys = []
+        self.releases = []
+        self.name = name
+        self.deadline = deadline
+        self.attempt = 0
+
+
+class BatchCollector():
+
+    # BatchCollector собирает сообщения, которые пользователь прислал подряд, и через window секунд
+    # после первого из них передаёт их в send(number, items, name) одним вызовом, не больше max_items за раз.
+    # Один сборщик обслуживает всех клиентов процесса, поэтому number - пара (клиент, номер пользователя).
+    # Пачки, закрытые по времени, отправляются в пуле из workers потоков: медленный чат не задерживает остальные;
+    # пачки одного номера уходят по порядку. Пачка с временной ошибкой повторяется по retry_policy, следующие пачки
+    # номера ждут её. После всех попыток или при другой ошибке пачка передаётся в on_failure(number, items, attempts, err).
+    # Сообщение с ключом (wamid), которое уже ждёт отправки в сборщике, второй раз не добавляется.
+    # release сообщения вызывается, когда его пачка отправлена или передана в on_failure: до этого смещение
+    # сообщения в очереди не фиксируется, и после падения процесса оно будет прочитано снова
+
+    name = 'batch'
+
+    def __init__(self, send, window=1.0, max_items=20, workers=4, retry_policy=None, on_failure=None, topic='whatsapp'):
+        self.send = send
+        self.window = window
+        self.max_items = max(1, max_items)
+        self.retry_policy = retry_policy
+        self.on_failure = on_failure
+        self.topic = topic
+        self.__pending = {}
+        # -- пачки, закрытые по времени или по размеру и ещё не отправленные, по порядку для каждого номера --
+        self.__closed = {}
+        # -- номер -> время повтора его первой пачки; пока номер здесь, его пачки не отправляются --
+        self.__parked = {}
+        # -- ключи сообщений, собранных и ещё не отправленных (или не переданных в on_failure) --
+        self.__collected = set()
+        self.__condition = Condition()
+        # -- пока пачка одного номера отправляется, следующая отправка этого номера ждёт --
+        self.__send_locks = [Lock() for _ in range(SEND_LOCKS)]
+        self.__stopped = False
+        self.__senders = ThreadPoolExecutor(max(1, workers), thread_name_prefix=f'{self.name}-sender')
+        self.__thread = Thread(target=self.__run, name=f'{self.name}-collector', daemon=True)
+
+    def start(self) -> 'BatchCollector':
+        self.__thread.start()
+        return self
+
+    def add(self, number, item, name, key=None, release=None) -> int:
+
+        # add возвращает, сколько сообщений стало в пачке номера, или 0, если сообщение с ключом key уже собрано
+        # (вебхук доставлен повторно или повторяется после временной ошибки до отправки пачки)
+
+        with self.__condition:
+            duplicate = key is not None and key in self.__collected
+            if(not duplicate):
+                batch = self.__pending.get(number)
+                if(batch is None):
+                    batch = self.__pending[number] = PendingBatch(name, monotonic() + self.window)
+                    self.__condition.notify()
+                batch.items.append(item)
+                if(key is not None):
+                    batch.keys.append(key)
+                    self.__collected.add(key)
+                if(release is not None):
+                    batch.releases.append(release)
+                batch.name = name
+                size = len(batch.items)
+        if(duplicate):
+            # -- смещение повтора не держится: оно зафиксируется вместе со смещением первой доставки --
+            if(release is not None):
+                release()
+            return 0
+        if(size >= self.max_items):
+            self.flush(number)
+        return size
+
+    def flush(self, number) -> None:
+
+        # flush отправляет накопленную пачку номера сразу, в вызывающем потоке. Если пачка номера ждёт повтора,
+        # новая пачка становится за ней, и сообщение, ради которого вызван flush, может её обогнать
+
+        with self.__condition:
+            self.__close(number)
+        self.__send_closed(number)
+
+    def stop(self) -> None:
+
+        # stop отправляет всё, что ещё не отправлено; пачки, ждущие повтора, получают последнюю попытку
+
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if(self.__thread.is_alive()):
+            self.__thread.join()
+        self.__senders.shutdown(wait=True)
+        with self.__condition:
+            for number in list(self.__pending):
+                self.__close(number)
+            self.__parked.clear()
+            numbers = list(self.__closed)
+        for number in numbers:
+            self.__send_closed(number)
+
+    def __close(self, number) -> None:
+        batch = self.__pending.pop(number, None)
+        if(batch is not None):
+            self.__closed.setdefault(number, deque()).append(batch)
+
+    def __send_closed(self, number) -> None:
+        with self.__send_locks[crc32(str(number).encode('utf-8')) % SEND_LOCKS]:
+            while True:
+                with self.__condition:
+                    batches = self.__closed.get(number)
+                    if(number in self.__parked):
+                        return
+                    if(not batches):
+                        self.__closed.pop(number, None)
+                        return
+                    batch = batches.popleft()
+                try:
+                    self.send(number, batch.items, batch.name)
+                except Exception as err:
+                    self.__failed(number, batch, err)
+                else:
+                    self.__finish(batch)
+
+    def __failed(self, number, batch, err) -> None:
+        log_error(f"Exception while sending the {self.name} of {number}: {err}")
+        log_exception("message")
+        if(self.retry_policy and not self.__stopped and self.retry_policy.should_retry(err, batch.attempt)):
+            delay = self.retry_policy.backoff(batch.attempt)
+            batch.attempt += 1
+            log_info(f"The {self.name} of {number} will be retried in {delay:.1f} s (attempt {batch.attempt})")
+            RETRIES.inc(self.topic)
+            with self.__condition:
+                self.__closed.setdefault(number, deque()).appendleft(batch)
+                self.__parked[number] = monotonic() + delay
+                self.__condition.notify()
+            return
+        try:
+            if(self.on_failure):
+                self.on_failure(number, batch.items, batch.attempt + 1, err)
+        except Exception as failure_err:
+            log_error(f"Exception from on_failure: {failure_err}")
+            log_exception("message")
+        finally:
+            self.__finish(batch)
+
+    def __finish(self, batch) -> None:
+        with self.__condition:
+            self.__collected.difference_update(batch.keys)
+        for release in batch.releases:
+            try:
+                release()
+            except Exception as err:
+                log_error(f"Exception from release of the {self.name}: {err}")
+                log_exception("message")
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while True:
+                    if(self.__stopped):
+                        return
+                    now = monotonic()
+                    due = [number for number, batch in self.__pending.items() if batch.deadline <= now]
+                    retries = [number for number, retry_at in self.__parked.items() if retry_at <= now]
+                    if(due or retries):
+                        break
+                    deadline = min([batch.deadline for batch in self.__pending.values()] + list(self.__parked.values()), default=None)
+                    self.__condition.wait(deadline - now if deadline is not None else None)
+                for number in due:
+                    self.__close(number)
+                for number in retries:
+                    del self.__parked[number]
+            for number in dict.fromkeys(due + retries):
+                self.__senders.submit(self.__send_closed, number)
+
+
+class TextCoalescer(BatchCollector):
+
+    # TextCoalescer собирает тексты пользователя в одно сообщение телеграма.
+    # Перед пересылкой медиа накопленные тексты отправляются сразу (flush), чтобы не нарушить порядок
+
+    name = 'texts'
+
+    def __init__(self, send, window=2.0, max_messages=20, workers=4, retry_policy=None, on_failure=None):
+        super().__init__(send, window, max_messages, workers, retry_policy, on_failure)
+
+    def add(self, number, item, name, key=None, release=None) -> int:
+        size = super().add(number, item, name, key, release)
+        if(size > 1):
+            COALESCED.inc()
+        return size
@@ -1,19 +1,85 @@
 from logging import info as log_info, error as log_error, exception as log_exception  
-from psycopg2 import connect as ps_connect
-from re import fullmatch
-from os import getenv, strerror
+from re import fullmatch, compile as re_compile
+from hashlib import sha256
+from contextlib import contextmanager, ExitStack
+from time import time, monotonic
+from os import getenv, strerror, SEEK_END
 from errno import ENOENT
 from dotenv import load_dotenv
-from kafka.structs import OffsetAndMetadata
 
-from wterror import WTCombotError
-from tgbot import TelegramBot
-from wabot import WhatsAppBot
+from wterror import WTCombotError, WTCombotTransientError
+from wtconfig import env_str, env_int, env_float, env_bool
+from wtcache import LRUCache
+from wtmedia import MediaCache, MEDIA_ID_TTL
+from wtdedup import Deduplicator, DEDUP_TTL
+from wtretry import is_transient, RetryPolicy
+from wtmetrics import STAGE_SECONDS, ERRORS, DUPLICATES
+from wtlog import log_sampled, add_secret
+from wtratelimit import OutboundScheduler, PRIORITY_NOTICE
+from wtcoalesce import TextCoalescer
+from wtalbum import AlbumCollector, MAX_ALBUM_ITEMS
+from wtprepare import MediaPreparer, MediaTooLargeError, MediaPreparationError, PREPARED_CACHE_BYTES
+from wtbudget import ByteBudget, BudgetTimeoutError, MEDIA_BUDGET, UNKNOWN_SIZE, BUDGET_WAIT
+from wttransport import MalformedValue
+from wtconsumer import hold_offset
+
+# -- ключ диалога ищется в теле вебхука без разбора JSON --
+WA_RAW_NUMBER = re_compile(rb'"(?:wa_id|recipient_id)"\s*:\s*"(\d+)"')
+TG_RAW_REPLY_ID = re_compile(rb'"reply_to_message"\s*:\s*\{\s*"message_id"\s*:\s*(\d+)')
+TG_RAW_NUMBER = re_compile(rb'#ID(\d+)')
+TG_RAW_CHAT_ID = re_compile(rb'"chat"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+
+# -- типы сообщений, для пересылки которых скачивается файл: они обрабатываются в полосе media --
+WA_MEDIA_TYPES = ('document', 'audio', 'video', 'image')
+TG_MEDIA_TYPES = ('document', 'audio', 'photo', 'video', 'video_note', 'voice')
+# -- срок хранения связи сообщения бота с номером пользователя в tg_message_numbers, секунды --
+MESSAGE_NUMBERS_TTL = 90 * 24 * 3600.0
+MESSAGE_NUMBERS_CLEANUP_INTERVAL = 3600.0
+# -- типы сообщений ватсапа, которые собираются в альбом --
+WA_ALBUM_TYPES = ('image', 'video')
+
+
+class SharedResources():
+
+    # SharedResources - то, что все клиенты процесса используют вместе: HTTP-сессии с пулами соединений,
+    # пул базы, кэш media_id, пул процессов подготовки файлов, бюджет байт файлов в пути,
+    # память о пересланных сообщениях, объединение текстов и сборка альбомов.
+    # dead_letters задаёт Bridge, когда запускает потребителей: туда уходят пачки, которые не удалось отправить
+
+    def __init__(self, sessions, db, media_cache, dedup, coalescer=None, media_preparer=None, media_budget=None, albums=None):
+        self.sessions = sessions
+        self.db = db
+        self.media_cache = media_cache
+        self.dedup = dedup
+        self.coalescer = coalescer
+        self.media_preparer = media_preparer or MediaPreparer(workers=0)
+        self.media_budget = media_budget or ByteBudget(0)
+        self.albums = albums
+        self.dead_letters = None
+
+    def get_http_stats(self) -> dict:
+        return {name: session.stats.stats() for name, session in self.sessions.items()}
+
+    def close(self) -> None:
+        if(self.coalescer):
+            self.coalescer.stop()
+        if(self.albums):
+            self.albums.stop()
+        self.media_preparer.close()
+        self.db.close()
+        log_info(f"HTTP connections: {self.get_http_stats()}")
+        log_info(f"Media budget: {self.media_budget.stats()}")
+        for session in self.sessions.values():
+            session.close()
 
 
 class TGWACOM():
-    def __init__(self, filename):
-        log_info("Create TGWACOM")
+
+    # TGWACOM пересылает сообщения одного клиента (tenant): его бизнес-номера в ватсапе и его чата в телеграме.
+    # Без tenant номер, чат и токены берутся из файла окружения; клиенты из WT_COMBOT_TENANTS см. в wttenant.py
+
+    def __init__(self, filename, tenant=None):
+        log_info(f"Create TGWACOM {tenant.name if tenant else ''}".rstrip())
         self.__ENV_FILE = filename
         if(not load_dotenv(self.__ENV_FILE)):
             raise FileNotFoundError(ENOENT, strerror(ENOENT), self.__ENV_FILE)
@@ -29,17 +95,154 @@ class TGWACOM():
         self.__DB_NAME = getenv('WT_COMBOT_DB_NAME')
         self.__DB_USER = getenv('WT_COMBOT_DB_USER')
         self.__DB_PASSWORD = getenv('WT_COMBOT_DB_PASSWORD')
-
-        print('WA_NUMBER_ID = ', self.__WA_NUMBER_ID)
-        print('WA_ACCESS_TOKEN = ', self.__WA_ACCESS_TOKEN)
-        print('WA_VERIFY_TOKEN = ', self.__WA_VERIFY_TOKEN)
-        print('TG_CHAT_ID = ', self.__TG_CHAT_ID)
-        print('TG_BOT_ID = ', self.__TG_BOT_ID)
-        print('TG_API_TOKEN = ', self.__TG_API_TOKEN)
-
-    def setup(self) -> None:
-        self.whatsapp_bot = WhatsAppBot(self.__WA_ACCESS_TOKEN, self.__WA_NUMBER_ID)
-        self.telegram_bot = TelegramBot(self.__TG_API_TOKEN) 
+        self.__DB_HOST = env_str('WT_COMBOT_DB_HOST', 'localhost')
+        self.__DB_PORT = env_int('WT_COMBOT_DB_PORT', 5432)
+        self.__DB_POOL_MIN = env_int('WT_COMBOT_DB_POOL_MIN', 1)
+        self.__DB_POOL_MAX = env_int('WT_COMBOT_DB_POOL_MAX', 4)
+        self.__DB_HEALTH_CHECK = env_float('WT_COMBOT_DB_HEALTH_CHECK', 30.0)
+
+        self.__MEDIA_SPOOL_SIZE = env_int('WT_COMBOT_MEDIA_SPOOL_SIZE', 1024 * 1024)
+        self.__MEDIA_CACHE_SIZE = env_int('WT_COMBOT_MEDIA_CACHE_SIZE', 1000)
+        self.__MEDIA_CACHE_TTL = env_float('WT_COMBOT_MEDIA_CACHE_TTL', MEDIA_ID_TTL)
+        self.__MEDIA_CACHE_PERSIST = env_bool('WT_COMBOT_MEDIA_CACHE_PERSIST', False)
+        self.__MEDIA_WORKERS = env_int('WT_COMBOT_MEDIA_WORKERS', 1)
+        self.__MEDIA_PREPARED_CACHE_BYTES = env_int('WT_COMBOT_MEDIA_PREPARED_CACHE_BYTES', PREPARED_CACHE_BYTES)
+        self.__MEDIA_BUDGET = env_int('WT_COMBOT_MEDIA_BUDGET', MEDIA_BUDGET)
+        self.__MEDIA_UNKNOWN_SIZE = env_int('WT_COMBOT_MEDIA_UNKNOWN_SIZE', UNKNOWN_SIZE)
+        self.__MEDIA_BUDGET_WAIT = env_float('WT_COMBOT_MEDIA_BUDGET_WAIT', BUDGET_WAIT)
+
+        self.__HTTP_POOL_CONNECTIONS = env_int('WT_COMBOT_HTTP_POOL_CONNECTIONS', 10)
+        self.__HTTP_POOL_MAXSIZE = env_int('WT_COMBOT_HTTP_POOL_MAXSIZE', 10)
+        self.__HTTP_CONNECT_TIMEOUT = env_float('WT_COMBOT_HTTP_CONNECT_TIMEOUT', 5.0)
+        self.__HTTP_READ_TIMEOUT = env_float('WT_COMBOT_HTTP_READ_TIMEOUT', 60.0)
+
+        self.__TG_CHAT_RATE = env_float('WT_COMBOT_TG_CHAT_RATE', 20)
+        self.__TG_CHAT_BURST = env_int('WT_COMBOT_TG_CHAT_BURST', 20)
+        self.__WA_NUMBER_RATE = env_float('WT_COMBOT_WA_NUMBER_RATE', 10)
+        self.__WA_NUMBER_BURST = env_int('WT_COMBOT_WA_NUMBER_BURST', 45)
+        self.__RATE_LIMIT_RETRIES = env_int('WT_COMBOT_RATE_LIMIT_RETRIES', 3)
+
+        self.__DEDUP_SIZE = env_int('WT_COMBOT_DEDUP_SIZE', 100000)
+        self.__DEDUP_TTL = env_float('WT_COMBOT_DEDUP_TTL', DEDUP_TTL)
+        self.__DEDUP_PERSIST = env_bool('WT_COMBOT_DEDUP_PERSIST', True)
+
+        self.__COALESCE_WINDOW = env_float('WT_COMBOT_COALESCE_WINDOW', 0.0)
+        self.__COALESCE_MAX_MESSAGES = env_int('WT_COMBOT_COALESCE_MAX_MESSAGES', 20)
+        self.__COALESCE_WORKERS = env_int('WT_COMBOT_COALESCE_WORKERS', 4)
+        # -- пачки сообщений повторяются с теми же настройками, что и сообщения из очереди --
+        self.__RETRY_ATTEMPTS = env_int('WT_COMBOT_RETRY_ATTEMPTS', 5)
+        self.__RETRY_BASE_DELAY = env_float('WT_COMBOT_RETRY_BASE_DELAY', 1.0)
+        self.__RETRY_MAX_DELAY = env_float('WT_COMBOT_RETRY_MAX_DELAY', 60.0)
+
+        self.__ALBUM_WINDOW = env_float('WT_COMBOT_ALBUM_WINDOW', 0.0)
+        self.__ALBUM_MAX_ITEMS = env_int('WT_COMBOT_ALBUM_MAX_ITEMS', MAX_ALBUM_ITEMS)
+        self.__ALBUM_WORKERS = env_int('WT_COMBOT_ALBUM_WORKERS', 4)
+
+        self.__CACHE_SIZE = env_int('WT_COMBOT_CACHE_SIZE', 1024)
+        self.__CACHE_TTL = env_float('WT_COMBOT_CACHE_TTL', 300.0)
+        self.__NUMBER_CACHE_SIZE = env_int('WT_COMBOT_NUMBER_CACHE_SIZE', 10000)
+        self.__NUMBER_TTL = env_float('WT_COMBOT_NUMBER_TTL', MESSAGE_NUMBERS_TTL)
+        self.__TG_SIGN_EVERY_PART = env_bool('WT_COMBOT_TG_SIGN_EVERY_PART', True)
+
+        # -- у клиента свои номер, чат и боты; имя клиента отделяет его записи в базе и в общих кэшах --
+        self.name = ''
+        if(tenant):
+            self.name = tenant.name
+            self.__WA_NUMBER_ID, self.__WA_ACCESS_TOKEN, self.__WA_VERIFY_TOKEN = tenant.wa_number_id, tenant.wa_access_token, tenant.wa_verify_token
+            self.__TG_CHAT_ID, self.__TG_BOT_ID, self.__TG_API_TOKEN = tenant.tg_chat_id, tenant.tg_bot_id, tenant.tg_api_token
+
+        # -- id сообщения бота в телеграме -> номер в ватсапе; связь не меняется, поэтому срок жизни записей не ограничен.
+        # Кэш читают и вебхуки (get_raw_conversation_key), поэтому он создаётся до setup --
+        self.number_cache = LRUCache(self.__NUMBER_CACHE_SIZE, float('inf'), 'message_numbers')
+        self.__last_number_cleanup = 0.0
+        self.resources = None
+        self.__owns_resources = False
+
+        # -- токены и пароль не попадают в журнал, даже если окажутся в ответе API или в тексте исключения --
+        for secret in (self.__WA_ACCESS_TOKEN, self.__WA_VERIFY_TOKEN, self.__TG_API_TOKEN, self.__DB_PASSWORD):
+            add_secret(secret)
+        log_info(f"WhatsApp number {self.__WA_NUMBER_ID}, Telegram chat {self.__TG_CHAT_ID}, bot {self.__TG_BOT_ID}")
+
+    def create_resources(self, send_texts=None, send_album=None, on_failure=None) -> SharedResources:
+
+        # create_resources создаёт общие ресурсы по настройкам из файла окружения. psycopg2 и requests
+        # импортируются только здесь: процессу с ролью web они не нужны, а остальные вызывают setup в фоне.
+        # send_texts(key, items, name) получает сообщения с текстами, собранные TextCoalescer, key - пара (клиент, номер);
+        # send_album(key, items, name) - фото и видео, собранные AlbumCollector; on_failure(key, items, attempts, err) -
+        # пачки, которые не удалось отправить
+
+        from wtdb import WTCombotDB
+        from wthttp import create_session
+
+        session_settings = {'pool_connections': self.__HTTP_POOL_CONNECTIONS, 'pool_maxsize': self.__HTTP_POOL_MAXSIZE,
+                            'connect_timeout': self.__HTTP_CONNECT_TIMEOUT, 'read_timeout': self.__HTTP_READ_TIMEOUT}
+        sessions = {'whatsapp': create_session('whatsapp', **session_settings), 'telegram': create_session('telegram', **session_settings)}
+        db = WTCombotDB(self.__DB_NAME, self.__DB_USER, self.__DB_PASSWORD, host=self.__DB_HOST, port=self.__DB_PORT,
+                        minconn=self.__DB_POOL_MIN, maxconn=self.__DB_POOL_MAX, health_check_interval=self.__DB_HEALTH_CHECK)
+        # -- файл из телеграма -> media_id уже загруженного в ватсап файла --
+        media_cache = MediaCache(db, maxsize=self.__MEDIA_CACHE_SIZE, ttl=self.__MEDIA_CACHE_TTL, persist=self.__MEDIA_CACHE_PERSIST)
+        # -- wamid и update_id уже пересланных сообщений: повторно доставленные вебхуки пропускаются --
+        dedup = Deduplicator(db, maxsize=self.__DEDUP_SIZE, ttl=self.__DEDUP_TTL, persist=self.__DEDUP_PERSIST)
+        # -- тексты, присланные пользователем подряд, пересылаются в телеграм одним сообщением --
+        coalescer = None
+        if(self.__COALESCE_WINDOW > 0):
+            coalescer = TextCoalescer(send_texts or self.send_texts, window=self.__COALESCE_WINDOW,
+                                      max_messages=self.__COALESCE_MAX_MESSAGES, workers=self.__COALESCE_WORKERS,
+                                      retry_policy=self.retry_policy(), on_failure=on_failure or self.dead_letter_batch).start()
+        # -- файлы в пути (в обе стороны) занимают не больше WT_COMBOT_MEDIA_BUDGET байт памяти и временных файлов --
+        media_budget = ByteBudget(self.__MEDIA_BUDGET, unknown_size=self.__MEDIA_UNKNOWN_SIZE, timeout=self.__MEDIA_BUDGET_WAIT)
+        # -- фото, которые ватсап не примет, перекодируются в отдельных процессах; готовые картинки занимают тот же бюджет --
+        media_preparer = MediaPreparer(workers=self.__MEDIA_WORKERS, cache_bytes=self.__MEDIA_PREPARED_CACHE_BYTES, budget=media_budget)
+        # -- фото и видео, присланные пользователем подряд, пересылаются в телеграм одним альбомом --
+        albums = None
+        if(self.__ALBUM_WINDOW > 0):
+            albums = AlbumCollector(send_album or self.send_album, window=self.__ALBUM_WINDOW, max_items=self.__ALBUM_MAX_ITEMS,
+                                    workers=self.__ALBUM_WORKERS, retry_policy=self.retry_policy(),
+                                    on_failure=on_failure or self.dead_letter_batch).start()
+        return SharedResources(sessions, db, media_cache, dedup, coalescer, media_preparer, media_budget, albums)
+
+    def retry_policy(self) -> RetryPolicy:
+
+        # retry_policy - повторы пачек сообщений с теми же настройками, что и у сообщений из очереди
+
+        return RetryPolicy(self.__RETRY_ATTEMPTS, self.__RETRY_BASE_DELAY, self.__RETRY_MAX_DELAY)
+
+    def setup(self, resources=None) -> None:
+
+        # setup создаёт ботов клиента. Без resources клиент создаёт себе общие ресурсы сам и закрывает их в close.
+        # telebot и heyoo импортируются только здесь
+
+        from tgbot import TelegramBot
+        from wabot import WhatsAppBot
+
+        self.__owns_resources = resources is None
+        self.resources = resources or self.create_resources()
+        # -- лимиты заданы в сообщениях в минуту --
+        whatsapp_scheduler = OutboundScheduler('whatsapp', rate=self.__WA_NUMBER_RATE / 60, capacity=self.__WA_NUMBER_BURST,
+                                               max_retries=self.__RATE_LIMIT_RETRIES)
+        telegram_scheduler = OutboundScheduler('telegram', rate=self.__TG_CHAT_RATE / 60, capacity=self.__TG_CHAT_BURST,
+                                               max_retries=self.__RATE_LIMIT_RETRIES)
+        self.whatsapp_bot = WhatsAppBot(self.__WA_ACCESS_TOKEN, self.__WA_NUMBER_ID, spool_size=self.__MEDIA_SPOOL_SIZE,
+                                        session=self.resources.sessions['whatsapp'], scheduler=whatsapp_scheduler)
+        self.telegram_bot = TelegramBot(self.__TG_API_TOKEN, spool_size=self.__MEDIA_SPOOL_SIZE,
+                                        session=self.resources.sessions['telegram'], scheduler=telegram_scheduler,
+                                        sign_every_part=self.__TG_SIGN_EVERY_PART)
+        self.db = self.resources.db
+        self.media_cache = self.resources.media_cache
+        self.media_preparer = self.resources.media_preparer
+        self.media_budget = self.resources.media_budget
+        self.dedup = self.resources.dedup
+        self.coalescer = self.resources.coalescer
+        self.albums = self.resources.albums
+        # -- номер в ватсапе -> id последнего сообщения пользователя в телеграме --
+        self.reply_cache = LRUCache(self.__CACHE_SIZE, self.__CACHE_TTL, 'replies')
+
+    def close(self) -> None:
+        if(self.__owns_resources):
+            self.resources.close()
+
+    def get_http_stats(self) -> dict:
+        return self.resources.get_http_stats()
 
     def check_env_variables(self) -> bool:
 
@@ -58,125 +261,353 @@ class TGWACOM():
 
         return self.__WA_NUMBER_ID and self.__WA_ACCESS_TOKEN and self.__WA_VERIFY_TOKEN and self.__TG_CHAT_ID and self.__TG_BOT_ID and self.__TG_API_TOKEN
 
+    def tenant_key(self, key) -> str|None:
+
+        # tenant_key - ключ в общих для клиентов кэшах: у клиента по умолчанию ключи те же, что были до появления клиентов
+
+        return f"{self.name}/{key}" if self.name and key else key
+
     def wa_point(self, json_data) -> None:
 
         # wa_point вызывается из app request (wa_webhook)
 
-        log_info("Received whatsapp webhook data: %s", json_data)
-        changed_field = self.whatsapp_bot.changed_field(json_data)
-
-        if changed_field == "messages":
-            phone_number = None
-            old_message_id = None
-            new_message_id = None
-            status_connection = self.open_connection()
+        with STAGE_SECONDS.time('wa_point'):
+            self.__wa_point__(json_data)
+
+    def __wa_point__(self, json_data) -> None:
+        log_sampled('webhook', "Received whatsapp webhook data:", json_data)
+
+        # в одном вебхуке может прийти несколько сообщений и статусов: id сообщений для всех номеров
+        # берутся из базы одним запросом, затем сообщения пересылаются по порядку
+
+        items = [(self.tenant_key(self.whatsapp_bot.get_relay_key(prep_data)), prep_data) for prep_data in self.whatsapp_bot.split_envelope(json_data)]
+        # -- повторы отсекаются до запросов к базе, скачивания и загрузки файлов --
+        duplicates = self.dedup.duplicates([key for key, _ in items])
+        if(duplicates):
+            log_sampled('duplicate', "Skipped already relayed whatsapp messages:", sorted(duplicates))
+            DUPLICATES.inc('whatsapp', amount=len(duplicates))
+            items = [(key, prep_data) for key, prep_data in items if key not in duplicates]
+        if(not items):
+            return
+        phone_numbers = {self.whatsapp_bot.get_mobile(prep_data) or self.whatsapp_bot.get_recipient_id(self.whatsapp_bot.get_status(prep_data) or {})
+                         for _, prep_data in items}
+        reply_ids = self.get_reply_to_message_ids([number for number in phone_numbers if number])
+        # -- сообщение с временной ошибкой не запоминается: при повторе вебхука пересылаются только такие сообщения.
+        # Сообщение, отданное в пачку, запоминается после отправки пачки --
+        transient_error = None
+        for key, prep_data in items:
+            collected = False
+            try:
+                collected = self.__wa_relay__(prep_data, reply_ids, key)
+            except Exception as err:
+                log_error(f"Exception from wa_point: {err}")
+                log_exception("message")
+                if(is_transient(err)):
+                    transient_error = transient_error or err
+                    continue
+            if(not collected):
+                self.dedup.remember(key)
+        if(transient_error):
+            raise transient_error
+
+    def __wa_relay__(self, prep_data, reply_ids, key=None) -> bool:
+
+        # __wa_relay__ пересылает в телеграм одно сообщение из вебхука или обрабатывает статус.
+        # Возвращает True, если сообщение отдано в пачку и будет отправлено позже. key - ключ дедупликации сообщения:
+        # сообщение, которое уже ждёт в пачке, второй раз в неё не попадает
+
+        phone_number = None
+        old_message_id = None
+        sent_message = None
+        
+        try:
+            phone_number = self.whatsapp_bot.get_mobile(prep_data)
+
+            if not phone_number:
+                self.__tg_send_error_status_wa_message__(prep_data, reply_ids)
+                return
+
+            if(self.coalescer):
+                if(self.whatsapp_bot.get_message_type(prep_data) == "text"):
+                    self.__collect__(self.coalescer, phone_number, prep_data, key)
+                    return True
+                self.coalescer.flush((self.name, phone_number))
+
+            if(self.albums):
+                # -- альбом уходит раньше любого другого сообщения пользователя; склеиваемые тексты идут своей полосой и его не ждут --
+                if(self.whatsapp_bot.get_message_type(prep_data) in WA_ALBUM_TYPES):
+                    self.__collect__(self.albums, phone_number, prep_data, key)
+                    return True
+                self.albums.flush((self.name, phone_number))
             
+            old_message_id = reply_ids.get(phone_number) #
+            modified_phone_number = self.__modify_rus_number__(phone_number)
+
+            content_type = self.whatsapp_bot.get_message_type(prep_data) #
+
+            name = self.whatsapp_bot.get_name(prep_data)
+            postscipt = self.whatsapp_bot.generate_user_info(phone_number, name) #
+
             try:
-                prep_data = self.whatsapp_bot.preprocess(json_data)
-                phone_number = self.whatsapp_bot.get_mobile(prep_data)
+                data = self.whatsapp_bot.get_data(prep_data, content_type)
+                sent_message = self.__whatsapp_to_telegram_sender__(data, postscipt, content_type, old_message_id)
+                log_sampled('sent', "Sending_status from telegram:", sent_message)
 
-                if not phone_number:
-                    self.__tg_send_error_status_wa_message__(prep_data)
-                    return
-                
-                old_message_id = self.get_reply_to_message_id(phone_number) #
-                modified_phone_number = self.__modify_rus_number__(phone_number)
-
-                content_type = self.whatsapp_bot.get_message_type(prep_data) #
-
-                name = self.whatsapp_bot.get_name(prep_data)
-                postscipt = self.whatsapp_bot.generate_user_info(phone_number, name) #
-
-                try:
-                    data = self.whatsapp_bot.get_data(prep_data, content_type)
-                    sent_message = self.__whatsapp_to_telegram_sender__(data, postscipt, content_type, old_message_id)
-                    log_info(f"Sending_status from telegram: {sent_message}")
-                    new_message_id = sent_message.message_id
-
-                except KeyError as ke:
-                    log_error(f"KeyError from whatsapp: {ke}")
-                    log_exception("message")
-                    self.__wa_send_error__(self.telegram_bot.error_notifications['content'], modified_phone_number)
-                
-                except WTCombotError as error_from_telegram:
-                    self.__wa_send_error__(error_from_telegram.get_message(), modified_phone_number)
-        
-            finally:            
-                if(status_connection):
-                    if(phone_number and new_message_id):
-                        self.set_reply_to_message_id(phone_number, old_message_id, new_message_id)
-                    self.close_connection()
+            except KeyError as ke:
+                log_error(f"KeyError from whatsapp: {ke}")
+                log_exception("message")
+                ERRORS.inc('whatsapp', self.telegram_bot.error_notifications['content'])
+                self.__wa_send_error__(self.telegram_bot.error_notifications['content'], modified_phone_number)
+            
+            except WTCombotTransientError:
+                raise
+
+            except WTCombotError as error_from_telegram:
+                ERRORS.inc('whatsapp', error_from_telegram.get_message())
+                self.__wa_send_error__(error_from_telegram.get_message(), modified_phone_number)
+    
+        finally:            
+            if(phone_number and sent_message):
+                reply_ids[phone_number] = sent_message.message_id
+                self.set_reply_to_message_id(phone_number, old_message_id, sent_message.message_id)
+                self.set_message_number(sent_message, phone_number)
+        return False
+
+    def __collect__(self, collector, phone_number, prep_data, key) -> None:
+
+        # __collect__ отдаёт сообщение в пачку; смещение вебхука не фиксируется, пока пачка не отправлена
+
+        if(not collector.add((self.name, phone_number), prep_data, self.whatsapp_bot.get_name(prep_data), key, hold_offset())):
+            log_sampled('duplicate', f"Skipped whatsapp message already waiting in the {collector.name}:", key)
+            DUPLICATES.inc('whatsapp')
 
     def tg_point(self, data) -> None:
 
         # tg_point вызывается из app request (tg_webhook)
 
-        log_info(f"Received telegram webhook data: {data}")
+        with STAGE_SECONDS.time('tg_point'):
+            relay_key = self.tenant_key(self.telegram_bot.get_relay_key(data))
+            if(relay_key and self.dedup.duplicates([relay_key])):
+                log_sampled('duplicate', "Skipped already relayed telegram update:", relay_key)
+                DUPLICATES.inc('telegram')
+                return
+            try:
+                self.__tg_point__(data)
+            except Exception as err:
+                if(not is_transient(err)):
+                    self.dedup.remember(relay_key)
+                raise
+            self.dedup.remember(relay_key)
+
+    def __tg_point__(self, data) -> None:
+        log_sampled('webhook', "Received telegram webhook data:", data)
         message = data.get('message')
 
         if message:
             try:
                 message_id = self.telegram_bot.get_message_id(message)
-                message_for_bot = self.__tg_check_reply_message_to_bot__(message)
+                reply_message = self.__tg_check_reply_message_to_bot__(message)
 
             # -- бот отправляет сообщение из чата группы пользователю --
-                log_info(f"Message for bot:{message_for_bot}")
-                if(message_for_bot):
+                log_sampled('webhook', "Message for bot:", reply_message)
+                if(reply_message):
                     content_type = self.telegram_bot.get_content_type(message)
-                    phone_number = self.telegram_bot.get_phone_number(message_for_bot)
-                    sent_message = self.__telegram_to_whatsapp_sender__(message, self.__modify_rus_number__(phone_number[1:]), content_type)
-                    log_info(f"Sending_status from whatsapp: {sent_message}")
+                    phone_number = self.__tg_get_reply_number__(reply_message)
+                    sent_message = self.__telegram_to_whatsapp_sender__(message, self.__modify_rus_number__(phone_number), content_type)
+                    log_sampled('sent', "Sending_status from whatsapp:", sent_message)
+
+            except WTCombotTransientError:
+                raise
 
             except WTCombotError as error_from_whatsapp:
+                ERRORS.inc('telegram', error_from_whatsapp.get_message())
                 self.__tg_send_error__(message_id, error_from_whatsapp.get_message())
 
             except Exception as err:
+                if(is_transient(err)):
+                    raise
                 log_error(f"Exception from tg_point :{err}")
                 log_exception("message")
+                ERRORS.inc('telegram', self.whatsapp_bot.error_notifications['sending'])
                 self.__tg_send_error__(message_id, self.whatsapp_bot.error_notifications['sending'])
 
-    def open_connection(self) -> bool:
+    def notify_dead_letter(self, topic, data, reason) -> None:
+
+        # notify_dead_letter вызывается, когда сообщение не удалось отправить после всех повторов:
+        # участнику телеграм-группы отвечают той же ошибкой, что и без повторов
+
+        if(topic != 'telegram'):
+            return
+        message = data.get('message')
+        if(message):
+            ERRORS.inc('telegram', self.whatsapp_bot.error_notifications['sending'])
+            self.__tg_send_error__(self.telegram_bot.get_message_id(message), self.whatsapp_bot.error_notifications['sending'])
+
+    def send_texts(self, key, items, name) -> None:
+        self.__wa_send_texts__(key[1], items, name)
+
+    def __wa_send_texts__(self, phone_number, items, name) -> None:
+
+        # __wa_send_texts__ пересылает накопленные тексты пользователя в телеграм одним сообщением
+        # с одной подписью и одной записью в базу. Временная ошибка поднимается в TextCoalescer, который повторит пачку
+
+        texts = [self.whatsapp_bot.get_message(self.whatsapp_bot.get_data(prep_data, "text")) for prep_data in items]
+        old_message_id = self.get_reply_to_message_id(phone_number)
+        postscipt = self.whatsapp_bot.generate_user_info(phone_number, name)
         try:
-            self.conn = ps_connect(dbname=self.__DB_NAME, user=self.__DB_USER, password=self.__DB_PASSWORD, host='localhost')
-            self.cursor = self.conn.cursor()
-            return True
-        except Exception as err:
-            log_error(f"Exception from open_connection: {err}")
-            log_exception("message")
-        return False
+            sent_message = self.telegram_bot.send_message(self.__TG_CHAT_ID, "\n".join(texts), postscipt, reply_id=old_message_id)
+            log_sampled('sent', "Sending_status from telegram:", sent_message)
+            self.set_reply_to_message_id(phone_number, old_message_id, sent_message.message_id)
+            self.set_message_number(sent_message, phone_number)
+        except WTCombotTransientError:
+            raise
+        except WTCombotError as error_from_telegram:
+            ERRORS.inc('whatsapp', error_from_telegram.get_message())
+            self.__wa_send_error__(error_from_telegram.get_message(), self.__modify_rus_number__(phone_number))
+        self.__remember_batch__(items)
+
+    def dead_letter_batch(self, key, items, attempts, err) -> None:
+
+        # dead_letter_batch отправляет пачку, которую не удалось переслать, в whatsapp_dlq одним вебхуком:
+        # wtreplay.py вернёт его в очередь, и сообщения пачки пройдут обычный путь
+
+        dead_letters = self.resources.dead_letters
+        if(dead_letters is None):
+            log_error(f"{len(items)} whatsapp messages of {key[1]} are lost: no dead-letter topic, {type(err).__name__}: {err}")
+            return
+        dead_letters.send_value('whatsapp', key[1], self.whatsapp_bot.join_envelope(items), attempts, err)
+
+    def __remember_batch__(self, items) -> None:
+        for prep_data in items:
+            self.dedup.remember(self.tenant_key(self.whatsapp_bot.get_relay_key(prep_data)))
+
+    def send_album(self, key, items, name) -> None:
+        self.__wa_send_album__(key[1], items, name)
+
+    def __wa_send_album__(self, phone_number, items, name) -> None:
+
+        # __wa_send_album__ пересылает фото и видео пользователя в телеграм одним альбомом с одной подписью
+        # и одной записью в базу. Один файл отправляется как обычное сообщение. Временная ошибка
+        # (в том числе не дождавшийся бюджета файл) поднимается в AlbumCollector, который повторит альбом
+
+        media = [(content_type, self.whatsapp_bot.get_data(prep_data, content_type))
+                 for content_type, prep_data in ((self.whatsapp_bot.get_message_type(prep_data), prep_data) for prep_data in items)]
+        old_message_id = self.get_reply_to_message_id(phone_number)
+        postscipt = self.whatsapp_bot.generate_user_info(phone_number, name)
+        try:
+            if(len(media) == 1):
+                content_type, data = media[0]
+                sent_message = self.__whatsapp_to_telegram_sender__(data, postscipt, content_type, old_message_id)
+            else:
+                sent_message = self.__whatsapp_to_telegram_album__(media, postscipt, old_message_id)
+            log_sampled('sent', "Sending_status from telegram:", sent_message)
+            self.set_reply_to_message_id(phone_number, old_message_id, sent_message.message_id)
+            self.set_message_number(sent_message, phone_number)
+        except WTCombotTransientError:
+            raise
+        except WTCombotError as error_from_telegram:
+            ERRORS.inc('whatsapp', error_from_telegram.get_message())
+            self.__wa_send_error__(error_from_telegram.get_message(), self.__modify_rus_number__(phone_number))
+        self.__remember_batch__(items)
+
+    def get_reply_to_message_id(self, phone_number) -> int|None:
+
+        # get_reply_to_message_id сначала ищет id в кэше; если база недоступна, возвращает устаревшее значение из кэша
 
-    def close_connection(self) -> None:
+        message_id = self.reply_cache.get(phone_number)
+        if(message_id is not None):
+            return message_id
         try:
-            if(hasattr(self, 'conn')):
-                self.conn.close()
-            if(hasattr(self, 'cursor')):
-                self.cursor.close()
+            with STAGE_SECONDS.time('db_get_message_id'):
+                message_id = self.db.get_message_id(phone_number, self.name)
+            if(message_id is not None):
+                self.reply_cache.set(phone_number, message_id)
+            return message_id
         except Exception as err:
-            log_error(f"Exception from close_connection: {err}")
+            log_error(f"Exception from get_reply_to_message_id: {err}")
             log_exception("message")
+        return self.reply_cache.get(phone_number, stale=True)
 
-    def get_reply_to_message_id(self, phone_number) -> int|None:
+    def get_reply_to_message_ids(self, phone_numbers) -> dict:
+
+        # get_reply_to_message_ids - то же, что get_reply_to_message_id, но для нескольких номеров:
+        # номера, которых нет в кэше, ищутся в базе одним запросом
+
+        message_ids = {}
+        missing = []
+        for phone_number in phone_numbers:
+            message_id = self.reply_cache.get(phone_number)
+            if(message_id is not None):
+                message_ids[phone_number] = message_id
+            else:
+                missing.append(phone_number)
+        if(not missing):
+            return message_ids
         try:
-            self.cursor.execute(f'SELECT message_id FROM tg_user_messages WHERE user_number={phone_number};')
-            response = self.cursor.fetchone()
-            return response[0] if response else None
+            with STAGE_SECONDS.time('db_get_message_ids'):
+                found = self.db.get_message_ids(missing, self.name)
+            for phone_number in missing:
+                message_id = found.get(int(phone_number))
+                if(message_id is not None):
+                    self.reply_cache.set(phone_number, message_id)
+                    message_ids[phone_number] = message_id
         except Exception as err:
-            log_error(f"Exception from get_reply_to_message_id: {err}")
+            log_error(f"Exception from get_reply_to_message_ids: {err}")
             log_exception("message")
-        return None
+            for phone_number in missing:
+                message_id = self.reply_cache.get(phone_number, stale=True)
+                if(message_id is not None):
+                    message_ids[phone_number] = message_id
+        return message_ids
 
     def set_reply_to_message_id(self, phone_number, old_message_id, new_message_id) -> None:
+        self.reply_cache.set(phone_number, new_message_id)
         try:
-            if(old_message_id):
-                self.cursor.execute(f'UPDATE tg_user_messages SET message_id={new_message_id} WHERE user_number={phone_number};')
-            else:
-                self.cursor.execute(f'INSERT INTO tg_user_messages VALUES ({phone_number}, {new_message_id});')
-            self.conn.commit()
+            with STAGE_SECONDS.time('db_set_message_id'):
+                self.db.set_message_id(phone_number, new_message_id, self.name)
         except Exception as err:
             log_error(f"Exception from set_reply_to_message_id: {err}")
             log_exception("message")
 
 
+    def get_message_number(self, message_id, cached_only=False) -> str|None:
+
+        # get_message_number возвращает номер в ватсапе, которому бот переслал сообщение с id message_id.
+        # При cached_only=True база не опрашивается
+
+        phone_number = self.number_cache.get(message_id)
+        if(phone_number is not None or cached_only):
+            return phone_number
+        try:
+            with STAGE_SECONDS.time('db_get_message_number'):
+                phone_number = self.db.get_message_number(message_id, self.name)
+            if(phone_number is not None):
+                phone_number = str(phone_number)
+                self.number_cache.set(message_id, phone_number)
+            return phone_number
+        except Exception as err:
+            log_error(f"Exception from get_message_number: {err}")
+            log_exception("message")
+        return None
+
+    def set_message_number(self, sent_message, phone_number) -> None:
+
+        # set_message_number запоминает номер пользователя для всех сообщений, которыми бот переслал его сообщение.
+        # Раз в час из базы удаляются связи клиента старше WT_COMBOT_NUMBER_TTL (0 - хранить без срока)
+
+        message_ids = self.telegram_bot.get_sent_message_ids(sent_message)
+        for message_id in message_ids:
+            self.number_cache.set(message_id, phone_number)
+        try:
+            with STAGE_SECONDS.time('db_set_message_number'):
+                self.db.set_message_numbers(message_ids, phone_number, self.name)
+            if(self.__NUMBER_TTL > 0 and monotonic() - self.__last_number_cleanup > MESSAGE_NUMBERS_CLEANUP_INTERVAL):
+                self.__last_number_cleanup = monotonic()
+                self.db.delete_expired_message_numbers(self.__NUMBER_TTL, self.name)
+        except Exception as err:
+            log_error(f"Exception from set_message_number: {err}")
+            log_exception("message")
+
     def __whatsapp_to_telegram_sender__(self, data, postscipt, content_type, message_id): 
 
         # __whatsapp_to_telegram_sender__ пересылает сообщение из ватсапа в телеграм
@@ -186,23 +617,23 @@ class TGWACOM():
             return self.telegram_bot.send_message(self.__TG_CHAT_ID, message, postscipt, reply_id=message_id)
 
         if content_type == "document":
-            content = self.whatsapp_bot.get_binary_file(data)
-            filename = self.whatsapp_bot.get_filename(data)
-            return self.telegram_bot.send_document(self.__TG_CHAT_ID, content, filename, postscipt, reply_id=message_id)
+            with self.__wa_binary_file__(data) as content:
+                filename = self.whatsapp_bot.get_filename(data)
+                return self.telegram_bot.send_document(self.__TG_CHAT_ID, content, filename, postscipt, reply_id=message_id)
 
         if content_type == 'audio':
-            content = self.whatsapp_bot.get_binary_file(data)
-            return self.telegram_bot.send_audio(self.__TG_CHAT_ID, content, postscipt, reply_id=message_id)
+            with self.__wa_binary_file__(data) as content:
+                return self.telegram_bot.send_audio(self.__TG_CHAT_ID, content, postscipt, reply_id=message_id)
 
         if content_type == 'video':
-            content = self.whatsapp_bot.get_binary_file(data)
-            caption = self.whatsapp_bot.get_caption(data)
-            return self.telegram_bot.send_video(self.__TG_CHAT_ID, content, caption, postscipt, reply_id=message_id)
+            with self.__wa_binary_file__(data) as content:
+                caption = self.whatsapp_bot.get_caption(data)
+                return self.telegram_bot.send_video(self.__TG_CHAT_ID, content, caption, postscipt, reply_id=message_id)
 
         if content_type == "image":
-            content = self.whatsapp_bot.get_binary_file(data)
-            caption = self.whatsapp_bot.get_caption(data)
-            return self.telegram_bot.send_photo(self.__TG_CHAT_ID, content, caption, postscipt, reply_id=message_id)
+            with self.__wa_binary_file__(data) as content:
+                caption = self.whatsapp_bot.get_caption(data)
+                return self.telegram_bot.send_photo(self.__TG_CHAT_ID, content, caption, postscipt, reply_id=message_id)
 
         if content_type == "location":
             if(data):
@@ -217,6 +648,21 @@ class TGWACOM():
 
         raise WTCombotError(self.telegram_bot.error_notifications['content'])
 
+    def __whatsapp_to_telegram_album__(self, items, postscipt, message_id):
+
+        # __whatsapp_to_telegram_album__ скачивает файлы альбома одновременно и отправляет их одним send_media_group.
+        # Место в бюджете занимается сразу под весь альбом: частично скачанные альбомы не ждут друг друга
+
+        with STAGE_SECONDS.time('wa_album'):
+            media_infos = self.albums.run_parallel(lambda item: self.whatsapp_bot.query_media_info(item[1]['id']) or {}, items)
+            size = sum(self.media_budget.unknown_size if info.get('file_size') is None else int(info['file_size']) for info in media_infos)
+            with self.__hold_media__(size, 'whatsapp') as reservation, ExitStack() as files:
+                contents = self.albums.run_parallel(lambda pair: files.enter_context(self.whatsapp_bot.get_binary_file(*pair)),
+                                                    [(data, info) for (_, data), info in zip(items, media_infos)])
+                reservation.resize(sum(self.__file_size__(content) for content in contents))
+                media = [(content_type, content, self.whatsapp_bot.get_caption(data)) for (content_type, data), content in zip(items, contents)]
+                return self.telegram_bot.send_media_group(self.__TG_CHAT_ID, media, postscipt, reply_id=message_id)
+
     # @tg_check_errors
     def __telegram_to_whatsapp_sender__(self, message, number, content_type):
 
@@ -228,12 +674,12 @@ class TGWACOM():
         elif content_type == 'document': # работает
             file_id = self.telegram_bot.get_file_id(message, content_type)
             filename = self.telegram_bot.get_filename(message, content_type)
-            media_id = self.__wa_upload_media__(file_id)
+            media_id = self.__wa_upload_media__(file_id, 'document', file_unique_id=self.telegram_bot.get_file_unique_id(message, content_type))
             return self.whatsapp_bot.send_document(media_id, number, filename, message.get('caption'))
 
         elif content_type == 'photo': # работает
             file_id = self.telegram_bot.get_photo_id(message)
-            media_id = self.__wa_upload_media__(file_id)
+            media_id = self.__wa_upload_media__(file_id, 'image', file_unique_id=self.telegram_bot.get_file_unique_id(message, content_type))
             return self.whatsapp_bot.send_image(media_id, number, message.get('caption'))
 
         elif content_type in ['audio', 'voice']: # работает
@@ -244,12 +690,12 @@ class TGWACOM():
                 type = "audio/ogg; codecs=opus"
                 type = "audio/opus"
 
-            media_id = self.__wa_upload_media__(file_id, content_type=type)
+            media_id = self.__wa_upload_media__(file_id, 'audio', content_type=type, file_unique_id=self.telegram_bot.get_file_unique_id(message, content_type))
             return self.whatsapp_bot.send_audio(media_id, number, message.get('caption'))
 
         elif content_type in ['video', 'video_note']: # работает
             file_id = self.telegram_bot.get_file_id(message, content_type)
-            media_id = self.__wa_upload_media__(file_id)
+            media_id = self.__wa_upload_media__(file_id, 'video', file_unique_id=self.telegram_bot.get_file_unique_id(message, content_type))
             return self.whatsapp_bot.send_video(media_id, number, message.get('caption'))
 
         elif content_type == 'location': # работает
@@ -260,9 +706,9 @@ class TGWACOM():
 
         raise WTCombotError(self.whatsapp_bot.error_notifications['content'])
 
-    def __tg_check_reply_message_to_bot__(self, message) -> str:
+    def __tg_check_reply_message_to_bot__(self, message) -> dict|None:
 
-        # __tg_check_reply_message_to_bot__ возвращает текст сообщения от участника телеграм-группы, если он ответил на сообщение бота
+        # __tg_check_reply_message_to_bot__ возвращает сообщение бота, на которое ответил участник телеграм-группы
 
         reply_message = message.get('reply_to_message')
         reply_message_from_id = None
@@ -274,38 +720,109 @@ class TGWACOM():
             reply_message_text = self.telegram_bot.get_reply_message_text(reply_message)
 
         if(reply_message_from_id != self.__TG_BOT_ID):
-            return ''
+            return None
         if(chat_id != self.__TG_CHAT_ID):
-            return ''
-        if(reply_message_text in self.whatsapp_bot.error_notifications.values()):
-            return ''
-        if(not reply_message_text):
-            raise WTCombotError(self.whatsapp_bot.error_notifications['number'])
+            return None
+        if(reply_message_text and reply_message_text in self.whatsapp_bot.error_notifications.values()):
+            return None
+
+        return reply_message
+
+    def __tg_get_reply_number__(self, reply_message) -> str:
 
-        return reply_message_text
+        # __tg_get_reply_number__ возвращает номер пользователя по id сообщения бота, на которое ответили.
+        # Номер из подписи в тексте используется только для сообщений, отправленных до появления индекса
 
-    def __wa_upload_media__(self, file_id, content_type=None) -> str:
+        phone_number = self.get_message_number(self.telegram_bot.get_message_id(reply_message))
+        if(phone_number):
+            return phone_number
+        reply_message_text = self.telegram_bot.get_reply_message_text(reply_message)
+        if(reply_message_text and '#ID' in reply_message_text):
+            return self.telegram_bot.get_phone_number(reply_message_text).lstrip('+')
+        raise WTCombotError(self.whatsapp_bot.error_notifications['number'])
 
-        # __wa_upload_media__ скачивает файл по url из телеграма и загружает в ватсап
+    def __wa_upload_media__(self, file_id, kind, content_type=None, file_unique_id=None) -> str:
+
+        # __wa_upload_media__ скачивает файл по url из телеграма, готовит его к лимитам ватсапа для сообщения типа kind
+        # (image, video, audio, document) и загружает. Если этот файл (или файл с тем же содержимым) уже загружался,
+        # повторно использует его media_id
        
-        file_info = self.telegram_bot.get_file(file_id)
-        # file_url = self.telegram_bot.get_file_url(file_id)
-        downloaded_file = self.telegram_bot.download_file(file_info.file_path)
-        media_id = self.whatsapp_bot.upload_media(downloaded_file, file_info.file_path, content_type)
-        return media_id['id'] if media_id else media_id
+        with STAGE_SECONDS.time('tg_to_wa_media'):
+            # -- media_id действует только для номера, который загрузил файл, поэтому ключи у каждого клиента свои --
+            unique_key = self.tenant_key(f"tg:{file_unique_id}:{content_type or ''}") if file_unique_id else None
+            media_id = self.media_cache.get(unique_key) if unique_key else None
+            if(media_id):
+                return media_id
+
+            file_info = self.telegram_bot.get_file(file_id)
+            digest = sha256()
+            with self.__hold_media__(file_info.file_size, 'telegram') as reservation, \
+                 self.telegram_bot.download_file_stream(file_info.file_path, digest=digest) as downloaded_file:
+                reservation.resize(self.__file_size__(downloaded_file))
+                hash_key = self.tenant_key(f"sha256:{digest.hexdigest()}:{content_type or ''}")
+                media_id = self.media_cache.get(hash_key)
+                if(not media_id):
+                    try:
+                        prepared = self.media_preparer.prepare(downloaded_file, file_info.file_path, kind, content_type, key=hash_key)
+                    except MediaTooLargeError as err:
+                        log_error(f"Media {file_info.file_path} is not sent: {err}")
+                        raise WTCombotError(self.whatsapp_bot.error_notifications['too_large'])
+                    except MediaPreparationError as err:
+                        log_error(f"Media {file_info.file_path} is not prepared: {err}")
+                        raise WTCombotError(self.whatsapp_bot.error_notifications['uploading'])
+                    response = self.whatsapp_bot.upload_media(prepared.content, prepared.filename, prepared.mime_type)
+                    media_id = response['id'] if response else response
+                    if(media_id):
+                        self.media_cache.set(hash_key, media_id)
+
+            if(unique_key and media_id):
+                self.media_cache.set(unique_key, media_id)
+            return media_id
     
-    def __tg_send_error_status_wa_message__(self, prep_data) -> None:
+    @contextmanager
+    def __wa_binary_file__(self, data):
+
+        # __wa_binary_file__ скачивает файл из ватсапа, когда для него есть место в бюджете;
+        # место занято, пока файл не отправлен в телеграм
+
+        media_info = self.whatsapp_bot.query_media_info(data['id']) or {}
+        with self.__hold_media__(media_info.get('file_size'), 'whatsapp') as reservation:
+            with self.whatsapp_bot.get_binary_file(data, media_info) as content:
+                reservation.resize(self.__file_size__(content))
+                yield content
+
+    @contextmanager
+    def __hold_media__(self, size, direction):
+
+        # __hold_media__ занимает место в бюджете файлов; если его не дождаться, сообщение повторяется позже
+
+        try:
+            with self.media_budget.hold(size, direction) as reservation:
+                yield reservation
+        except BudgetTimeoutError as err:
+            log_error(f"Media from {direction} is postponed: {err}")
+            raise WTCombotTransientError(self.whatsapp_bot.error_notifications['sending'])
+
+    @staticmethod
+    def __file_size__(content) -> int:
+        size = content.seek(0, SEEK_END)
+        content.seek(0)
+        return size
+
+    def __tg_send_error_status_wa_message__(self, prep_data, reply_ids) -> None:
         try:
             status = self.whatsapp_bot.get_status(prep_data)
             phone_number = self.whatsapp_bot.get_recipient_id(status)
-            message_id = self.get_reply_to_message_id(phone_number)
+            message_id = reply_ids.get(phone_number)
             error = self.whatsapp_bot.get_errors(status)
             if(error):
                 error_code = error.get('code')
                 if(error_code == 131047):
-                    self.__tg_send_error__(message_id, self.whatsapp_bot.error_notifications[error_code])
+                    notification = self.whatsapp_bot.error_notifications[error_code]
                 else:
-                    self.__tg_send_error__(message_id, self.whatsapp_bot.error_notifications['sending'])
+                    notification = self.whatsapp_bot.error_notifications['sending']
+                ERRORS.inc('whatsapp', notification)
+                self.__tg_send_error__(message_id, notification)
         except Exception as err:
             log_error(f"Exception from __tg_send_error_status_wa_message__ : {err}")
             log_exception("message")
@@ -314,13 +831,13 @@ class TGWACOM():
 
         # __tg_send_error__ телеграм-бот печатает ошибку в групповой чат
 
-        return self.telegram_bot.send_message(self.__TG_CHAT_ID, message=message_text, postscript="", reply_id = message_id)
+        return self.telegram_bot.send_message(self.__TG_CHAT_ID, message=message_text, postscript="", reply_id = message_id, priority=PRIORITY_NOTICE)
 
     def __wa_send_error__(self, message_text, number):
 
         # __wa_send_error__ ватсап-бот печатает ошибку в чат с пользователем
 
-        return self.whatsapp_bot.send_message(message_text, number)
+        return self.whatsapp_bot.send_message(message_text, number, priority=PRIORITY_NOTICE)
 
     def __modify_rus_number__(self, number) -> str:
 
@@ -334,15 +851,96 @@ class TGWACOM():
     def get_wa_verify_token(self) -> str:
         return self.__WA_VERIFY_TOKEN
 
+    def get_wa_number_id(self) -> str:
+        return self.__WA_NUMBER_ID
+
     def get_tg_chat_id(self) -> int:
         return self.__TG_CHAT_ID
 
-    def consumeData(self, consumer, wt_point, args) -> None:
-        meta = args[0]
-        tp = args[1]
-    
-        for msg in consumer:
-            data = msg.value
-            wt_point(data)
-            options = {tp: OffsetAndMetadata(msg.offset+1, meta)}
-            consumer.commit(options)
\ No newline at end of file
+    def get_conversation_key(self, topic, data) -> str|None:
+
+        # get_conversation_key возвращает ключ диалога: номер пользователя в ватсапе,
+        # для сообщений из телеграма - номер сообщения, на которое ответили (из кэша или подписи), иначе id чата
+
+        try:
+            if(topic == 'whatsapp'):
+                prep_data = self.whatsapp_bot.preprocess(data)
+                phone_number = self.whatsapp_bot.get_mobile(prep_data)
+                if(not phone_number):
+                    phone_number = self.whatsapp_bot.get_recipient_id(self.whatsapp_bot.get_status(prep_data) or {})
+                return phone_number or None
+
+            message = data.get('message')
+            if(not message):
+                return None
+            reply_message = message.get('reply_to_message')
+            if(reply_message):
+                phone_number = self.get_message_number(self.telegram_bot.get_message_id(reply_message), cached_only=True)
+                if(phone_number):
+                    return phone_number
+                reply_message_text = self.telegram_bot.get_reply_message_text(reply_message)
+                if(reply_message_text and '#ID' in reply_message_text):
+                    return self.telegram_bot.get_phone_number(reply_message_text).lstrip('+')
+            return str(self.telegram_bot.get_chat_id(message))
+        except Exception:
+            return None
+
+    def get_raw_conversation_key(self, topic, body) -> str|None:
+
+        # get_raw_conversation_key - то же, что get_conversation_key, но по сырому телу вебхука
+
+        if(topic == 'whatsapp'):
+            match = WA_RAW_NUMBER.search(body)
+        else:
+            reply_id = TG_RAW_REPLY_ID.search(body)
+            phone_number = self.get_message_number(int(reply_id.group(1)), cached_only=True) if reply_id else None
+            if(phone_number):
+                return phone_number
+            match = TG_RAW_NUMBER.search(body) or TG_RAW_CHAT_ID.search(body)
+        return match.group(1).decode('ascii') if match else None
+
+    @staticmethod
+    def get_lane(topic, data) -> str:
+
+        # get_lane - полоса обработчиков для сообщения: media, если для него нужно скачать файл, иначе text
+
+        try:
+            if(topic == 'whatsapp'):
+                for entry in data.get('entry', []):
+                    for change in entry.get('changes', []):
+                        if(any(message.get('type') in WA_MEDIA_TYPES for message in change.get('value', {}).get('messages', []))):
+                            return 'media'
+                return 'text'
+            message = data.get('message') or {}
+            return 'media' if any(content_type in message for content_type in TG_MEDIA_TYPES) else 'text'
+        except (AttributeError, TypeError):
+            return 'text'
+
+    def consumeData(self, consumer, workers, committer, max_records=100, timeout_ms=500, get_key=None) -> None:
+
+        # consumeData забирает из kafka пачку сообщений и раздаёт их потокам-обработчикам по ключу диалога.
+        # Ключ сообщения без ключа вычисляет get_key (по умолчанию get_conversation_key).
+        # Сообщение, которое не разобралось как JSON, сразу уходит в DLQ
+
+        records = consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+        for tp, messages in records.items():
+            for msg in messages:
+                committer.started(tp, msg.offset)
+                if(isinstance(msg.value, MalformedValue)):
+                    self.dead_letter_malformed(tp, msg)
+                    committer.done(tp, msg.offset)
+                    continue
+                key = msg.key.decode('utf-8') if msg.key else (get_key or self.get_conversation_key)(tp.topic, msg.value)
+                if(msg.timestamp and msg.timestamp > 0):
+                    STAGE_SECONDS.observe(max(0.0, time() - msg.timestamp / 1000), f'{tp.topic}_queue')
+                workers.submit(key, tp, msg.offset, msg.value)
+        committer.maybe_commit()
+
+    def dead_letter_malformed(self, tp, msg) -> None:
+        key = msg.key.decode('utf-8', 'replace') if msg.key else None
+        err = ValueError(msg.value.error)
+        dead_letters = self.resources.dead_letters
+        if(dead_letters is None):
+            log_error(f"{tp.topic}[{tp.partition}]@{msg.offset} is skipped: {err}")
+            return
+        dead_letters.send(key, tp, msg.offset, msg.value.raw.decode('utf-8', 'replace'), 1, err)
@@ -0,0 +1,33 @@
+from os import getenv
+from logging import error as log_error
+
+
+def env_str(name, default=None) -> str|None:
+    value = getenv(name)
+    return value if value else default
+
+def env_int(name, default) -> int:
+    value = getenv(name)
+    if(not value):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        log_error(f"Environment variable {name} must be an integer, got '{value}'. Using {default}")
+        return default
+
+def env_float(name, default) -> float:
+    value = getenv(name)
+    if(not value):
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        log_error(f"Environment variable {name} must be a number, got '{value}'. Using {default}")
+        return default
+
+def env_bool(name, default) -> bool:
+    value = getenv(name)
+    if(not value):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
@@ -0,0 +1,356 @@
+from logging import info as log_info, error as log_error, exception as log_exception
+from collections import deque, namedtuple
+from threading import Thread, Lock, local
+from queue import Queue
+from time import monotonic, sleep
+from zlib import crc32
+
+from wtmetrics import RETRIES
+
+# -- смещение для LocalConsumer.commit, когда kafka-python не установлен --
+LocalOffsetAndMetadata = namedtuple('LocalOffsetAndMetadata', 'offset metadata')
+
+
+def offset_and_metadata(offset):
+
+    # kafka импортируется здесь, а не при загрузке модуля: локальной очереди kafka-python не нужен.
+    # В kafka-python 2.1+ у OffsetAndMetadata появилось поле leader_epoch
+
+    try:
+        from kafka.structs import OffsetAndMetadata
+    except ImportError:
+        return LocalOffsetAndMetadata(offset, '')
+    if('leader_epoch' in OffsetAndMetadata._fields):
+        return OffsetAndMetadata(offset, '', -1)
+    return OffsetAndMetadata(offset, '')
+
+
+# -- Completion сообщения, которое обрабатывает текущий поток пула --
+_current = local()
+
+
+def hold_offset():
+
+    # hold_offset вызывает обработчик, который отложил часть сообщения (например, текст в TextCoalescer):
+    # смещение сообщения не отмечается обработанным, пока не вызвана возвращённая функция. Её нужно вызвать
+    # ровно один раз - после отправки или отправки в DLQ. Вне потоков пула возвращает None
+
+    completion = getattr(_current, 'completion', None)
+    return completion.hold() if completion else None
+
+
+class Completion():
+
+    # Completion - окончание обработки одного сообщения: on_done вызывается, когда закончилась последняя попытка
+    # обработчика и отпущены все части сообщения, отложенные через hold_offset
+
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self.__holds = 1
+        self.__lock = Lock()
+
+    def hold(self):
+        with self.__lock:
+            self.__holds += 1
+        return self.release
+
+    def release(self) -> None:
+        with self.__lock:
+            self.__holds -= 1
+            done = self.__holds == 0
+        if(done):
+            self.on_done()
+
+
+class OffsetTracker():
+
+    # OffsetTracker хранит для каждой партиции начатые и обработанные смещения
+    # и считает наибольшее смещение, до которого все сообщения уже обработаны
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__in_flight = {}
+        self.__next = {}
+        self.__committed = {}
+
+    def started(self, tp, offset) -> None:
+        with self.__lock:
+            self.__in_flight.setdefault(tp, set()).add(offset)
+            self.__next[tp] = max(self.__next.get(tp, 0), offset + 1)
+
+    def done(self, tp, offset) -> None:
+        with self.__lock:
+            self.__in_flight.get(tp, set()).discard(offset)
+
+    def in_flight(self, tp=None) -> int:
+        with self.__lock:
+            if(tp is not None):
+                return len(self.__in_flight.get(tp, ()))
+            return sum(len(offsets) for offsets in self.__in_flight.values())
+
+    def committable(self) -> dict:
+
+        # committable возвращает смещения, которые можно фиксировать, не теряя необработанных сообщений
+
+        with self.__lock:
+            offsets = {}
+            for tp, next_offset in self.__next.items():
+                in_flight = self.__in_flight.get(tp)
+                offset = min(in_flight) if in_flight else next_offset
+                if(offset > self.__committed.get(tp, -1)):
+                    offsets[tp] = offset
+            return offsets
+
+    def committed(self, offsets) -> None:
+        with self.__lock:
+            for tp, offset in offsets.items():
+                self.__committed[tp] = max(self.__committed.get(tp, -1), offset)
+
+    def forget(self, partitions) -> None:
+        with self.__lock:
+            for tp in partitions:
+                self.__in_flight.pop(tp, None)
+                self.__next.pop(tp, None)
+                self.__committed.pop(tp, None)
+
+
+class OffsetCommitter():
+
+    # OffsetCommitter фиксирует смещения не после каждого сообщения, а раз в commit_every сообщений
+    # или раз в commit_interval секунд
+
+    def __init__(self, consumer, commit_every=100, commit_interval=5.0, async_commit=True):
+        self.consumer = consumer
+        self.tracker = OffsetTracker()
+        self.commit_every = max(1, commit_every)
+        self.commit_interval = commit_interval
+        self.async_commit = async_commit
+        self.__processed = 0
+        self.__processed_lock = Lock()
+        self.__last_commit = monotonic()
+
+    def started(self, tp, offset) -> None:
+        self.tracker.started(tp, offset)
+
+    def done(self, tp, offset) -> None:
+        self.tracker.done(tp, offset)
+        with self.__processed_lock:
+            self.__processed += 1
+
+    def maybe_commit(self) -> None:
+        with self.__processed_lock:
+            due = self.__processed >= self.commit_every or monotonic() - self.__last_commit >= self.commit_interval
+        if(due):
+            self.commit(sync=not self.async_commit)
+
+    def commit(self, sync=True) -> None:
+        with self.__processed_lock:
+            self.__processed = 0
+            self.__last_commit = monotonic()
+        offsets = self.tracker.committable()
+        if(not offsets):
+            return
+        commit_offsets = {tp: offset_and_metadata(offset) for tp, offset in offsets.items()}
+        if(sync):
+            self.consumer.commit(commit_offsets)
+            self.tracker.committed(offsets)
+            return
+
+        def on_commit(committed_offsets, response):
+            if(isinstance(response, Exception)):
+                log_error(f"Async offset commit failed: {response}")
+            else:
+                self.tracker.committed(offsets)
+
+        self.consumer.commit_async(commit_offsets, callback=on_commit)
+
+    def close(self) -> None:
+        try:
+            self.commit(sync=True)
+            log_info("Final offsets committed")
+        except Exception as err:
+            log_error(f"Exception from OffsetCommitter.close: {err}")
+
+
+class ConversationWorkerPool():
+
+    # ConversationWorkerPool обрабатывает сообщения в нескольких потоках.
+    # Сообщения одного диалога (одного ключа) всегда попадают в один поток и обрабатываются по порядку,
+    # разные диалоги обрабатываются параллельно.
+    # Сообщение с временной ошибкой возвращается в очередь своего потока через delay_queue, не задерживая остальные
+    # диалоги; пока оно ждёт повтора, его смещение не фиксируется, а следующие сообщения его диалога откладываются
+    # и обрабатываются по порядку после него. После retry_policy.attempts повторов или при другой ошибке
+    # сообщение отправляется в dead_letters. Смещение сообщения, часть которого обработчик отложил (hold_offset),
+    # отмечается обработанным только после того, как отложенные части отправлены
+
+    def __init__(self, target, committer, workers=4, name='worker', retry_policy=None, delay_queue=None, dead_letters=None):
+        self.target = target
+        self.committer = committer
+        self.retry_policy = retry_policy
+        self.delay_queue = delay_queue
+        self.dead_letters = dead_letters
+        self.__queues = [Queue() for _ in range(max(1, workers))]
+        self.__threads = [Thread(target=self.__run, args=(queue,), name=f'{name}-{index}', daemon=True)
+                          for index, queue in enumerate(self.__queues)]
+        # -- сообщения, полученные пулом и ещё не обработанные, включая ждущие повтора --
+        self.__pending = 0
+        self.__pending_lock = Lock()
+        # -- ключ диалога, сообщение которого ждёт повтора -> отложенные следующие сообщения диалога --
+        self.__parked = {}
+        self.__parked_lock = Lock()
+
+    def start(self) -> None:
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, key, tp, offset, value) -> None:
+        if(key):
+            index = crc32(key.encode('utf-8')) % len(self.__queues)
+        else:
+            index = offset % len(self.__queues)
+        with self.__pending_lock:
+            self.__pending += 1
+        self.__queues[index].put((key, tp, offset, value, 0, Completion(lambda: self.__done(tp, offset))))
+
+    def pending(self) -> int:
+        return self.__pending
+
+    def stop(self) -> None:
+
+        # stop дожидается обработки уже полученных сообщений
+
+        for queue in self.__queues:
+            queue.put(None)
+        for thread in self.__threads:
+            if(thread.is_alive()):
+                thread.join()
+
+    def __run(self, queue) -> None:
+        while True:
+            item = queue.get()
+            if(item is None):
+                return
+            key, attempt = item[0], item[4]
+            # -- новое сообщение диалога, сообщение которого ждёт повтора, встаёт за ним --
+            with self.__parked_lock:
+                if(attempt == 0 and key in self.__parked):
+                    self.__parked[key].append(item)
+                    continue
+            while item is not None and self.__process(queue, item):
+                item = self.__release(key)
+
+    def __process(self, queue, item) -> bool:
+
+        # __process возвращает False, если сообщение ждёт повтора
+
+        key, tp, offset, value, attempt, completion = item
+        done = True
+        _current.completion = completion
+        try:
+            self.target(value)
+        except Exception as err:
+            log_error(f"Exception in worker while processing {tp.topic}[{tp.partition}]@{offset}: {err}")
+            log_exception("message")
+            done = not self.__retry_later(queue, item, err)
+        finally:
+            _current.completion = None
+            if(done):
+                completion.release()
+        return done
+
+    def __done(self, tp, offset) -> None:
+        with self.__pending_lock:
+            self.__pending -= 1
+        self.committer.done(tp, offset)
+
+    def __release(self, key):
+
+        # __release возвращает следующее отложенное сообщение диалога или None, снимая с диалога ожидание
+
+        with self.__parked_lock:
+            held = self.__parked.get(key)
+            if(held is None):
+                return None
+            if(held):
+                return held.popleft()
+            del self.__parked[key]
+            return None
+
+    def __retry_later(self, queue, item, err) -> bool:
+
+        # __retry_later откладывает повтор сообщения; возвращает False, если повторов больше не будет
+
+        key, tp, offset, value, attempt, completion = item
+        if(self.retry_policy and self.delay_queue and self.retry_policy.should_retry(err, attempt)):
+            delay = self.retry_policy.backoff(attempt)
+            log_info(f"{tp.topic}[{tp.partition}]@{offset} will be retried in {delay:.1f} s (attempt {attempt + 1})")
+            RETRIES.inc(tp.topic)
+            if(key):
+                with self.__parked_lock:
+                    self.__parked.setdefault(key, deque())
+            self.delay_queue.schedule(delay, queue.put, (key, tp, offset, value, attempt + 1, completion))
+            return True
+        if(self.dead_letters):
+            self.dead_letters.send(key, tp, offset, value, attempt + 1, err)
+        return False
+
+
+class LanedWorkerPool():
+
+    # LanedWorkerPool раздаёт сообщения по нескольким ConversationWorkerPool - полосам. Полосу сообщения
+    # выбирает get_lane(topic, value); неизвестная полоса заменяется первой. Сообщения с файлами ждут
+    # бюджет байт (см. wtbudget.py) в своих потоках и не задерживают тексты. Порядок сообщений диалога
+    # сохраняется внутри полосы, но текст, отправленный после фото, может дойти раньше фото
+
+    def __init__(self, lanes, get_lane):
+        self.lanes = lanes
+        self.get_lane = get_lane
+        self.default = next(iter(lanes))
+
+    def start(self) -> None:
+        for pool in self.lanes.values():
+            pool.start()
+
+    def submit(self, key, tp, offset, value) -> None:
+        lane = self.get_lane(tp.topic, value) if len(self.lanes) > 1 else self.default
+        self.lanes.get(lane, self.lanes[self.default]).submit(key, tp, offset, value)
+
+    def pending(self, lane) -> int:
+        pool = self.lanes.get(lane)
+        return pool.pending() if pool else 0
+
+    def stop(self) -> None:
+        for pool in self.lanes.values():
+            pool.stop()
+
+
+class DrainingRebalanceListener():
+
+    # перед тем как отдать партиции другому потребителю, дожидается обработки полученных из них сообщений
+    # и фиксирует смещения, чтобы новый владелец не повторял уже отправленные сообщения
+
+    def __init__(self, committer, drain_timeout=30.0):
+        self.committer = committer
+        self.drain_timeout = drain_timeout
+        # -- KafkaConsumer.subscribe принимает только ConsumerRebalanceListener; без kafka-python слушатель - обычный класс --
+        try:
+            from kafka import ConsumerRebalanceListener
+        except ImportError:
+            return
+        ConsumerRebalanceListener.register(DrainingRebalanceListener)
+
+    def on_partitions_revoked(self, revoked) -> None:
+        if(not revoked):
+            return
+        deadline = monotonic() + self.drain_timeout
+        while any(self.committer.tracker.in_flight(tp) for tp in revoked) and monotonic() < deadline:
+            sleep(0.05)
+        try:
+            self.committer.commit(sync=True)
+        except Exception as err:
+            log_error(f"Exception while committing revoked partitions: {err}")
+        self.committer.tracker.forget(revoked)
+        log_info(f"Partitions revoked: {sorted(tp.partition for tp in revoked)}")
+
+    def on_partitions_assigned(self, assigned) -> None:
+        log_info(f"Partitions assigned: {sorted(tp.partition for tp in assigned)}")
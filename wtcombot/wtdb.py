@@ -0,0 +1,261 @@
+from logging import info as log_info, error as log_error
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# -- таблицы создаются при первом подключении, если их ещё нет --
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS tg_user_messages (tenant text NOT NULL DEFAULT '', user_number bigint NOT NULL, "
+    "message_id bigint NOT NULL, PRIMARY KEY (tenant, user_number))",
+    'CREATE TABLE IF NOT EXISTS wa_media_cache (media_key text PRIMARY KEY, media_id text NOT NULL, '
+    'uploaded_at timestamptz NOT NULL DEFAULT now())',
+    "CREATE TABLE IF NOT EXISTS tg_message_numbers (tenant text NOT NULL DEFAULT '', message_id bigint NOT NULL, "
+    "user_number bigint NOT NULL, created_at timestamptz NOT NULL DEFAULT now(), PRIMARY KEY (tenant, message_id))",
+    'CREATE INDEX IF NOT EXISTS tg_message_numbers_created_at ON tg_message_numbers (created_at)',
+    'CREATE TABLE IF NOT EXISTS relay_dedup (relay_hash bigint PRIMARY KEY, seen_at timestamptz NOT NULL DEFAULT now())',
+]
+
+
+def tenant_migration(table, column) -> str:
+
+    # tenant_migration - перевод таблицы, созданной до появления клиентов (tenant), на ключ (tenant, column):
+    # строки старой таблицы принадлежат клиенту по умолчанию ''. Миграция выполняется, только если в первичном ключе
+    # ещё нет tenant; имя старого ключа берётся из pg_constraint, таблица без ключа тоже получает новый.
+    # В таблице без ключа могут быть повторы и пустые column: перед созданием ключа они удаляются
+    # (из повторов остаётся последняя записанная строка), иначе ключ не создастся и запросы к таблице не пройдут.
+    # Проверка повторяется под блокировкой таблицы, чтобы два процесса не переводили её одновременно
+
+    keyed = (f"EXISTS (SELECT 1 FROM pg_constraint c JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) "
+             f"WHERE c.conrelid = '{table}'::regclass AND c.contype = 'p' AND a.attname = 'tenant')")
+    return (f"DO $$ DECLARE pkey name; BEGIN IF NOT {keyed} THEN LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE; IF NOT {keyed} THEN "
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS tenant text NOT NULL DEFAULT ''; "
+            f"SELECT conname INTO pkey FROM pg_constraint WHERE conrelid = '{table}'::regclass AND contype = 'p'; "
+            f"IF pkey IS NOT NULL THEN EXECUTE format('ALTER TABLE {table} DROP CONSTRAINT IF EXISTS %I', pkey); END IF; "
+            f"DELETE FROM {table} WHERE {column} IS NULL; "
+            f"DELETE FROM {table} a USING {table} b WHERE a.tenant = b.tenant AND a.{column} = b.{column} AND a.ctid < b.ctid; "
+            f"ALTER TABLE {table} ADD PRIMARY KEY (tenant, {column}); END IF; END IF; END $$")
+
+
+MIGRATIONS = [tenant_migration('tg_user_messages', 'user_number'), tenant_migration('tg_message_numbers', 'message_id')]
+
+# -- серверные подготовленные запросы, создаются один раз на каждое соединение --
+PREPARED_STATEMENTS = {
+    'wt_get_message_id': 'PREPARE wt_get_message_id (bigint, text) AS '
+                         'SELECT message_id FROM tg_user_messages WHERE user_number = $1 AND tenant = $2',
+    'wt_get_message_ids': 'PREPARE wt_get_message_ids (bigint[], text) AS '
+                          'SELECT user_number, message_id FROM tg_user_messages WHERE user_number = ANY($1) AND tenant = $2',
+    'wt_set_message_id': 'PREPARE wt_set_message_id (bigint, bigint, text) AS '
+                         'INSERT INTO tg_user_messages (user_number, message_id, tenant) VALUES ($1, $2, $3) '
+                         'ON CONFLICT (tenant, user_number) DO UPDATE SET message_id = EXCLUDED.message_id',
+    'wt_get_message_number': 'PREPARE wt_get_message_number (bigint, text) AS '
+                             'SELECT user_number FROM tg_message_numbers WHERE message_id = $1 AND tenant = $2',
+    'wt_set_message_numbers': 'PREPARE wt_set_message_numbers (bigint[], bigint, text) AS '
+                              'INSERT INTO tg_message_numbers (message_id, user_number, tenant) SELECT unnest($1), $2, $3 '
+                              'ON CONFLICT (tenant, message_id) DO UPDATE SET user_number = EXCLUDED.user_number, created_at = now()',
+    'wt_delete_expired_message_numbers': 'PREPARE wt_delete_expired_message_numbers (double precision, text) AS '
+                                         'DELETE FROM tg_message_numbers WHERE tenant = $2 AND created_at < now() - make_interval(secs => $1)',
+    'wt_get_media_id': 'PREPARE wt_get_media_id (text, double precision) AS '
+                       'SELECT media_id, extract(epoch FROM now() - uploaded_at) FROM wa_media_cache '
+                       'WHERE media_key = $1 AND uploaded_at > now() - make_interval(secs => $2)',
+    'wt_set_media_id': 'PREPARE wt_set_media_id (text, text) AS '
+                       'INSERT INTO wa_media_cache (media_key, media_id) VALUES ($1, $2) '
+                       'ON CONFLICT (media_key) DO UPDATE SET media_id = EXCLUDED.media_id, uploaded_at = now()',
+    'wt_delete_expired_media': 'PREPARE wt_delete_expired_media (double precision) AS '
+                               'DELETE FROM wa_media_cache WHERE uploaded_at < now() - make_interval(secs => $1)',
+    'wt_get_seen': 'PREPARE wt_get_seen (bigint[], double precision) AS '
+                   'SELECT relay_hash FROM relay_dedup WHERE relay_hash = ANY($1) AND seen_at > now() - make_interval(secs => $2)',
+    'wt_set_seen': 'PREPARE wt_set_seen (bigint) AS '
+                   'INSERT INTO relay_dedup (relay_hash) VALUES ($1) ON CONFLICT (relay_hash) DO UPDATE SET seen_at = now()',
+    'wt_delete_expired_seen': 'PREPARE wt_delete_expired_seen (double precision) AS '
+                              'DELETE FROM relay_dedup WHERE seen_at < now() - make_interval(secs => $1)',
+}
+
+
+class WTCombotDB():
+
+    # WTCombotDB - пул соединений с PostgreSQL, общий для всех потоков-потребителей и всех клиентов.
+    # Связи сообщений хранятся по клиенту (tenant); клиент по умолчанию - пустая строка
+
+    def __init__(self, dbname, user, password, host='localhost', port=5432, minconn=1, maxconn=4, health_check_interval=30.0):
+        self.__dsn = {'dbname': dbname, 'user': user, 'password': password, 'host': host, 'port': port}
+        self.__minconn = minconn
+        self.__maxconn = max(minconn, maxconn)
+        self.__health_check_interval = health_check_interval
+
+        self.__pool = None
+        self.__pool_lock = Lock()
+        # ThreadedConnectionPool не ждёт свободного соединения, а сразу бросает PoolError
+        self.__slots = BoundedSemaphore(self.__maxconn)
+        self.__prepared = set()
+        self.__schema_ready = False
+        self.__last_used = {}
+
+    def get_message_id(self, phone_number, tenant='') -> int|None:
+        response = self.__execute('EXECUTE wt_get_message_id (%s, %s)', (phone_number, tenant), fetch=True)
+        return response[0] if response else None
+
+    def get_message_ids(self, phone_numbers, tenant='') -> dict[int, int]:
+
+        # get_message_ids ищет id сообщений сразу для нескольких номеров одним запросом
+
+        rows = self.__execute('EXECUTE wt_get_message_ids (%s, %s)', ([int(number) for number in phone_numbers], tenant), fetch='all')
+        return dict(rows)
+
+    def set_message_id(self, phone_number, message_id, tenant='') -> None:
+        self.__execute('EXECUTE wt_set_message_id (%s, %s, %s)', (phone_number, message_id, tenant))
+
+    def get_message_number(self, message_id, tenant='') -> int|None:
+
+        # get_message_number возвращает номер в ватсапе, которому принадлежит сообщение бота в телеграме
+
+        response = self.__execute('EXECUTE wt_get_message_number (%s, %s)', (message_id, tenant), fetch=True)
+        return response[0] if response else None
+
+    def set_message_numbers(self, message_ids, phone_number, tenant='') -> None:
+        self.__execute('EXECUTE wt_set_message_numbers (%s, %s, %s)', ([int(message_id) for message_id in message_ids], phone_number, tenant))
+
+    def delete_expired_message_numbers(self, max_age, tenant='') -> int:
+        return self.__execute('EXECUTE wt_delete_expired_message_numbers (%s, %s)', (max_age, tenant))
+
+    def get_media_id(self, media_key, max_age) -> tuple[str, float]|None:
+
+        # возвращает media_id и возраст записи в секундах, если запись моложе max_age
+
+        return self.__execute('EXECUTE wt_get_media_id (%s, %s)', (media_key, max_age), fetch=True)
+
+    def set_media_id(self, media_key, media_id) -> None:
+        self.__execute('EXECUTE wt_set_media_id (%s, %s)', (media_key, media_id))
+
+    def delete_expired_media(self, max_age) -> int:
+        return self.__execute('EXECUTE wt_delete_expired_media (%s)', (max_age,))
+
+    def get_seen(self, relay_hashes, max_age) -> list[int]:
+
+        # get_seen возвращает хэши уже пересланных сообщений, которые моложе max_age
+
+        rows = self.__execute('EXECUTE wt_get_seen (%s, %s)', (list(relay_hashes), max_age), fetch='all')
+        return [row[0] for row in rows]
+
+    def set_seen(self, relay_hash) -> None:
+        self.__execute('EXECUTE wt_set_seen (%s)', (relay_hash,))
+
+    def delete_expired_seen(self, max_age) -> int:
+        return self.__execute('EXECUTE wt_delete_expired_seen (%s)', (max_age,))
+
+    def close(self) -> None:
+        with self.__pool_lock:
+            if(self.__pool is not None):
+                self.__pool.closeall()
+                self.__pool = None
+            self.__prepared.clear()
+            self.__last_used.clear()
+        log_info("Database pool closed")
+
+    def __execute(self, statement, params, fetch=False):
+
+        # __execute выполняет запрос; если соединение оборвалось, переподключается и повторяет запрос один раз
+
+        attempts = 2
+        for attempt in range(1, attempts + 1):
+            with self.__slots:
+                conn = None
+                broken = False
+                try:
+                    conn = self.__checkout()
+                    self.__prepare(conn)
+                    with conn.cursor() as cursor:
+                        cursor.execute(statement, params)
+                        if(fetch == 'all'):
+                            result = cursor.fetchall()
+                        else:
+                            result = cursor.fetchone() if fetch else cursor.rowcount
+                    conn.commit()
+                    return result
+                except (OperationalError, InterfaceError) as err:
+                    broken = True
+                    log_error(f"Database connection error (attempt {attempt}/{attempts}): {err}")
+                    if(attempt == attempts):
+                        raise
+                except Exception:
+                    if(conn is not None and not conn.closed):
+                        conn.rollback()
+                    raise
+                finally:
+                    if(conn is not None):
+                        self.__checkin(conn, broken)
+
+    def __get_pool(self) -> ThreadedConnectionPool:
+
+        # пул создаётся при первом запросе, чтобы недоступная база не мешала запуску бота
+
+        with self.__pool_lock:
+            if(self.__pool is None):
+                self.__pool = ThreadedConnectionPool(self.__minconn, self.__maxconn, **self.__dsn)
+                log_info(f"Database pool created: min={self.__minconn}, max={self.__maxconn}")
+            return self.__pool
+
+    def __checkout(self):
+        pool = self.__get_pool()
+        conn = pool.getconn()
+        if(self.__is_alive(conn)):
+            return conn
+        log_info("Database connection is dead, reconnecting")
+        self.__discard(pool, conn)
+        return pool.getconn()
+
+    def __checkin(self, conn, broken) -> None:
+        with self.__pool_lock:
+            pool = self.__pool
+        if(pool is None):
+            conn.close()
+            return
+        if(broken or conn.closed):
+            self.__discard(pool, conn)
+            return
+        self.__last_used[conn] = monotonic()
+        pool.putconn(conn)
+
+    def __discard(self, pool, conn) -> None:
+        self.__prepared.discard(conn)
+        self.__last_used.pop(conn, None)
+        try:
+            pool.putconn(conn, close=True)
+        except Exception as err:
+            log_error(f"Exception from __discard: {err}")
+
+    def __is_alive(self, conn) -> bool:
+
+        # __is_alive проверяет соединение, которое простаивало дольше health_check_interval
+
+        if(conn.closed):
+            return False
+        last_used = self.__last_used.get(conn)
+        if(last_used is None or monotonic() - last_used < self.__health_check_interval):
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def __prepare(self, conn) -> None:
+        if(conn in self.__prepared):
+            return
+        with conn.cursor() as cursor:
+            if(not self.__schema_ready):
+                try:
+                    for statement in SCHEMA + MIGRATIONS:
+                        cursor.execute(statement)
+                except Exception as err:
+                    # -- схема повторно создаётся при следующем запросе; до тех пор запросы к базе не проходят --
+                    log_error(f"Database schema migration failed: {err}")
+                    raise
+                self.__schema_ready = True
+            for statement in PREPARED_STATEMENTS.values():
+                cursor.execute(statement)
+        conn.commit()
+        self.__prepared.add(conn)
@@ -0,0 +1,60 @@
+from logging import error as log_error
+from hashlib import blake2b
+from time import monotonic
+
+from wtcache import LRUCache
+
+# -- ватсап повторяет недоставленные вебхуки до 7 дней --
+DEDUP_TTL = 7 * 24 * 3600
+
+
+def relay_hash(key) -> int:
+
+    # relay_hash - 8-байтовый хэш ключа, в базе хранится bigint вместо длинного wamid
+
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+class Deduplicator():
+
+    # Deduplicator помнит уже пересланные сообщения (wamid ватсапа, update_id телеграма),
+    # чтобы повторно доставленный вебхук не пересылался второй раз.
+    # Последние ключи хранятся в памяти, при persist=True ещё и в базе - так они переживают перезапуск
+
+    def __init__(self, db=None, maxsize=100000, ttl=DEDUP_TTL, persist=True, cleanup_interval=3600.0):
+        self.db = db if persist else None
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize, ttl, 'dedup')
+        self.cleanup_interval = cleanup_interval
+        self.__last_cleanup = 0.0
+
+    def duplicates(self, keys) -> set[str]:
+
+        # duplicates возвращает ключи, которые уже встречались; ключи, которых нет в памяти, ищутся в базе одним запросом
+
+        found = {key for key in keys if key and self.memory.get(key)}
+        missing = {relay_hash(key): key for key in keys if key and key not in found}
+        if(not missing or self.db is None):
+            return found
+        try:
+            for hashed in self.db.get_seen(list(missing), self.ttl):
+                key = missing[hashed]
+                self.memory.set(key, True)
+                found.add(key)
+        except Exception as err:
+            log_error(f"Exception from Deduplicator.duplicates: {err}")
+        return found
+
+    def remember(self, key) -> None:
+        if(not key):
+            return
+        self.memory.set(key, True)
+        if(self.db is None):
+            return
+        try:
+            self.db.set_seen(relay_hash(key))
+            if(monotonic() - self.__last_cleanup > self.cleanup_interval):
+                self.__last_cleanup = monotonic()
+                self.db.delete_expired_seen(self.ttl)
+        except Exception as err:
+            log_error(f"Exception from Deduplicator.remember: {err}")
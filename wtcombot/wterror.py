@@ -2,4 +2,12 @@ class WTCombotError(Exception):
     def __init__(self, error_message):
         self.__error_message = error_message
     def get_message(self):
-        return self.__error_message
\ No newline at end of file
+        return self.__error_message
+
+class WTCombotTransientError(WTCombotError):
+    pass
+
+class WTCombotRateLimitError(WTCombotError):
+    def __init__(self, error_message, retry_after=None):
+        super().__init__(error_message)
+        self.retry_after = retry_after
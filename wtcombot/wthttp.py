@@ -0,0 +1,86 @@
+from socket import SOL_SOCKET, SO_KEEPALIVE
+from threading import Lock
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 60.0
+
+
+class HTTPStats():
+
+    # HTTPStats считает запросы и новые соединения: reused = requests - opened
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.opened = 0
+        self.__lock = Lock()
+
+    def request(self) -> None:
+        with self.__lock:
+            self.requests += 1
+
+    def connection(self) -> None:
+        with self.__lock:
+            self.opened += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {'requests': self.requests, 'opened': self.opened, 'reused': max(0, self.requests - self.opened)}
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+
+    # CountingHTTPAdapter - адаптер с пулом постоянных соединений, который считает открытые соединения
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', HTTPConnection.default_socket_options + [(SOL_SOCKET, SO_KEEPALIVE, 1)])
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        stats = self.stats
+
+        def new_conn(pool_class):
+            def _new_conn(pool):
+                stats.connection()
+                return pool_class._new_conn(pool)
+            return _new_conn
+
+        # pool_classes_by_scheme в urllib3 - общий словарь модуля, поэтому подменяем его копией
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('CountingHTTPConnectionPool', (HTTPConnectionPool,), {'_new_conn': new_conn(HTTPConnectionPool)}),
+            'https': type('CountingHTTPSConnectionPool', (HTTPSConnectionPool,), {'_new_conn': new_conn(HTTPSConnectionPool)}),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.request()
+        return super().send(request, **kwargs)
+
+
+class WTSession(Session):
+
+    # WTSession - долгоживущая сессия с таймаутами по умолчанию
+
+    def __init__(self, stats, pool_connections=10, pool_maxsize=10, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        super().__init__()
+        self.stats = stats
+        self.timeout = (connect_timeout, read_timeout)
+        self.headers['Connection'] = 'keep-alive'
+        adapter = CountingHTTPAdapter(stats, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if(kwargs.get('timeout') is None):
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def create_session(name, pool_connections=10, pool_maxsize=10, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT) -> WTSession:
+    return WTSession(HTTPStats(name), pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                     connect_timeout=connect_timeout, read_timeout=read_timeout)
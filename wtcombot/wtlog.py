@@ -0,0 +1,237 @@
+import logging
+from logging import Formatter, StreamHandler, FileHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener
+from json import dumps
+from os import register_at_fork
+from queue import Queue, Full
+from random import random
+from re import compile as re_compile, escape, IGNORECASE
+from threading import Lock
+
+from wtconfig import env_str, env_int, env_bool
+from wtmetrics import LOG_DROPPED
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'
+LOG_QUEUE_SIZE = 10000
+# -- длиннее обрезаются и сообщение, и тело вебхука в записи журнала --
+MAX_PAYLOAD = 2048
+
+# -- доля записей категории, которая попадает в журнал; категории без доли пишутся всегда --
+DEFAULT_SAMPLING = {'webhook': 0.01, 'sent': 0.01}
+
+# -- токены, которые могут оказаться в записи: заголовок Authorization, токен бота телеграма (в том числе в URL файлов),
+# параметры запроса. Токены из настроек клиентов добавляет add_secret --
+SECRET_PATTERNS = (r'bearer\s+[A-Za-z0-9._~+/=-]+', r'\d{6,}:[A-Za-z0-9_-]{30,}', r'(?<=access_token=)[^&\s"\']+', r'(?<=password=)[^&\s"\']+')
+REDACTED = '[redacted]'
+# -- короткие значения (например, тестовые токены) совпадали бы с обычными словами --
+MIN_SECRET_LENGTH = 8
+
+
+class Sampler():
+
+    # Sampler решает, писать ли запись категории. Доли можно поменять на ходу (configure):
+    # словарь заменяется целиком, поэтому потокам-потребителям не нужна блокировка
+
+    def __init__(self, rates=None):
+        self.rates = dict(DEFAULT_SAMPLING if rates is None else rates)
+
+    def keep(self, category) -> bool:
+        rate = self.rates.get(category, 1.0)
+        return rate >= 1.0 or (rate > 0.0 and random() < rate)
+
+    def configure(self, spec) -> None:
+
+        # configure принимает строку вида "webhook=0.01,sent=0,duplicate=1"; неуказанные категории берутся по умолчанию
+
+        rates = dict(DEFAULT_SAMPLING)
+        for item in (spec or '').split(','):
+            if(not item.strip()):
+                continue
+            category, _, value = item.partition('=')
+            try:
+                rates[category.strip()] = min(1.0, max(0.0, float(value)))
+            except ValueError:
+                logging.error(f"WT_COMBOT_LOG_SAMPLE: '{item}' must be category=share, skipped")
+        self.rates = rates
+
+
+class Redactor():
+
+    # Redactor заменяет в готовой записи токены и пароли на [redacted]
+
+    def __init__(self):
+        self.__secrets = set()
+        self.__lock = Lock()
+        self.__pattern = self.__compile()
+
+    def add(self, value) -> None:
+        if(not value or len(str(value)) < MIN_SECRET_LENGTH):
+            return
+        with self.__lock:
+            self.__secrets.add(str(value))
+            self.__pattern = self.__compile()
+
+    def redact(self, text) -> str:
+        return self.__pattern.sub(REDACTED, text)
+
+    def __compile(self):
+        values = sorted(self.__secrets, key=len, reverse=True)
+        return re_compile('|'.join(list(SECRET_PATTERNS) + [escape(value) for value in values]), IGNORECASE)
+
+
+class RecordFormatter(Formatter):
+
+    # RecordFormatter превращает запись в строку уже в фоновом потоке: тело вебхука (extra payload)
+    # сериализуется здесь, из сообщения и тела вычищаются секреты, затем они обрезаются до max_payload символов
+    # (в обратном порядке от обрезанного токена осталось бы начало).
+    # structured=True пишет каждую запись одной строкой JSON
+
+    def __init__(self, redactor, structured=False, max_payload=MAX_PAYLOAD):
+        super().__init__(LOG_FORMAT)
+        self.redactor = redactor
+        self.structured = structured
+        self.max_payload = max_payload
+
+    def format(self, record) -> str:
+        message = self.truncate(self.redactor.redact(record.getMessage()))
+        payload = getattr(record, 'payload', None)
+        if(payload is not None):
+            payload = payload if isinstance(payload, str) else dumps(payload, ensure_ascii=False, default=str)
+            payload = self.truncate(self.redactor.redact(payload))
+        if(record.exc_info and not record.exc_text):
+            record.exc_text = self.redactor.redact(self.formatException(record.exc_info))
+        if(self.structured):
+            entry = {'time': self.formatTime(record), 'level': record.levelname, 'thread': record.threadName, 'message': message}
+            if(getattr(record, 'category', None)):
+                entry['category'] = record.category
+            if(payload is not None):
+                entry['payload'] = payload
+            if(record.exc_text):
+                entry['exception'] = record.exc_text
+            text = dumps(entry, ensure_ascii=False)
+        else:
+            record.message = message if payload is None else f"{message} {payload}"
+            record.asctime = self.formatTime(record)
+            text = self.formatMessage(record)
+            if(record.exc_text):
+                text = f"{text}\n{record.exc_text}"
+        return text
+
+    def truncate(self, text) -> str:
+        if(len(text) <= self.max_payload):
+            return text
+        return f"{text[:self.max_payload]}... [{len(text) - self.max_payload} more chars]"
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    # DroppingQueueHandler кладёт записи в ограниченную очередь и ничего не форматирует: это делает фоновый поток.
+    # Если фоновый поток не успевает, запись отбрасывается и считается в wtcombot_log_dropped_total,
+    # а поток-потребитель не ждёт диск
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            LOG_DROPPED.inc()
+
+
+SAMPLER = Sampler()
+REDACTOR = Redactor()
+_root = getLogger()
+_state_lock = Lock()
+# -- обработчик, который пишет записи, очередь перед ним и фоновый поток; None, пока журнал не настроен --
+_target = None
+_queue_handler = None
+_listener = None
+
+
+def log_sampled(category, message, payload=None) -> None:
+
+    # log_sampled пишет запись INFO категории category с долей из WT_COMBOT_LOG_SAMPLE.
+    # payload (тело вебхука, ответ API) не форматируется в вызывающем потоке, поэтому после вызова его нельзя менять
+
+    if(_root.isEnabledFor(logging.INFO) and SAMPLER.keep(category)):
+        _root.info(message, extra={'category': category, 'payload': payload})
+
+
+def add_secret(value) -> None:
+    REDACTOR.add(value)
+
+
+def configure_logging(force=False) -> None:
+
+    # configure_logging настраивает журнал процесса по WT_COMBOT_LOG_*. Записи идут в очередь, а в stderr
+    # (или в WT_COMBOT_LOG_FILE) их пишет фоновый поток. Если корневой логгер уже настроен снаружи
+    # (например, gunicorn --log-config), его обработчики остаются, меняются только уровень и доли;
+    # force=True их убирает (main.py запущен сам и logging.info мог успеть вызвать basicConfig).
+    # Повторный вызов перечитывает уровень и доли: так они меняются на ходу (см. reload_on_signal в main.py)
+
+    global _target, _queue_handler
+    SAMPLER.configure(env_str('WT_COMBOT_LOG_SAMPLE', ''))
+    level = env_str('WT_COMBOT_LOG_LEVEL', 'INFO').upper()
+    if(isinstance(logging.getLevelName(level), int)):
+        _root.setLevel(level)
+    else:
+        logging.error(f"WT_COMBOT_LOG_LEVEL: unknown level '{level}', keeping {logging.getLevelName(_root.level)}")
+    # -- клиент kafka подробно пишет о каждом переподключении --
+    getLogger('kafka').setLevel(max(_root.level, logging.WARNING))
+    with _state_lock:
+        if(_target is None):
+            if(force):
+                for handler in list(_root.handlers):
+                    _root.removeHandler(handler)
+            if(_root.handlers):
+                return
+            filename = env_str('WT_COMBOT_LOG_FILE')
+            _target = FileHandler(filename, encoding='utf-8') if filename else StreamHandler()
+            _target.setFormatter(RecordFormatter(REDACTOR, structured=env_str('WT_COMBOT_LOG_FORMAT', 'text') == 'json',
+                                                 max_payload=env_int('WT_COMBOT_LOG_MAX_PAYLOAD', MAX_PAYLOAD)))
+            if(not env_bool('WT_COMBOT_LOG_ASYNC', True)):
+                _root.addHandler(_target)
+                return
+            _queue_handler = DroppingQueueHandler(Queue(env_int('WT_COMBOT_LOG_QUEUE_SIZE', LOG_QUEUE_SIZE)))
+            _root.addHandler(_queue_handler)
+        elif(_queue_handler is None or _listener is not None):
+            return
+        else:
+            # -- после stop_logging записи писались напрямую: возвращаем очередь --
+            _root.removeHandler(_target)
+            _root.addHandler(_queue_handler)
+        _start_listener()
+
+
+def stop_logging() -> None:
+
+    # stop_logging дописывает записи из очереди и останавливает фоновый поток;
+    # записи, сделанные после остановки, пишутся сразу, без очереди
+
+    global _listener
+    with _state_lock:
+        if(_listener is None):
+            return
+        _root.removeHandler(_queue_handler)
+        _root.addHandler(_target)
+        _listener.stop()
+        _listener = None
+
+
+def _start_listener() -> None:
+    global _listener
+    _listener = QueueListener(_queue_handler.queue, _target, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork() -> None:
+
+    # после fork (gunicorn --preload) фонового потока в дочернем процессе нет: он запускается заново с пустой очередью
+
+    if(_listener is not None):
+        _queue_handler.queue = Queue(_queue_handler.queue.maxsize)
+        _start_listener()
+
+
+register_at_fork(after_in_child=_restart_after_fork)
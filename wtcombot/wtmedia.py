@@ -0,0 +1,80 @@
+from logging import error as log_error
+from io import BytesIO
+from tempfile import TemporaryFile
+from time import monotonic
+
+from wtcache import LRUCache
+from wtmetrics import MEDIA_BYTES
+
+SPOOL_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# -- media_id из ватсапа действует 30 дней после загрузки, берём с запасом --
+MEDIA_ID_TTL = 29 * 24 * 3600
+
+
+def spool_response(response, spool_size=SPOOL_SIZE, chunk_size=CHUNK_SIZE, digest=None, stage=None):
+
+    # spool_response читает ответ с файлом частями: небольшие файлы остаются в памяти (BytesIO),
+    # файлы больше spool_size записываются во временный файл на диске.
+    # SpooledTemporaryFile здесь не подходит: MultipartEncoder вызывает fileno() и сбрасывает его на диск
+
+    response.raise_for_status()
+    spool = BytesIO()
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            spool.write(chunk)
+            if(digest is not None):
+                digest.update(chunk)
+            if(isinstance(spool, BytesIO) and spool.tell() > spool_size):
+                file = TemporaryFile()
+                file.write(spool.getbuffer())
+                spool = file
+        if(stage):
+            MEDIA_BYTES.inc(stage, amount=spool.tell())
+        spool.seek(0)
+        return spool
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        response.close()
+
+
+class MediaCache():
+
+    # MediaCache запоминает media_id уже загруженных в ватсап файлов по file_unique_id из телеграма
+    # или по хэшу содержимого; при persist=True записи хранятся ещё и в базе и переживают перезапуск
+
+    def __init__(self, db=None, maxsize=1000, ttl=MEDIA_ID_TTL, persist=False, cleanup_interval=3600.0):
+        self.db = db if persist else None
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize, ttl, 'media_ids')
+        self.cleanup_interval = cleanup_interval
+        self.__last_cleanup = 0.0
+
+    def get(self, key) -> str|None:
+        media_id = self.memory.get(key)
+        if(media_id or self.db is None):
+            return media_id
+        try:
+            row = self.db.get_media_id(key, self.ttl)
+        except Exception as err:
+            log_error(f"Exception from MediaCache.get: {err}")
+            return None
+        if(not row):
+            return None
+        media_id, age = row
+        self.memory.set(key, media_id, ttl=self.ttl - float(age))
+        return media_id
+
+    def set(self, key, media_id) -> None:
+        self.memory.set(key, media_id)
+        if(self.db is None):
+            return
+        try:
+            self.db.set_media_id(key, media_id)
+            if(monotonic() - self.__last_cleanup > self.cleanup_interval):
+                self.__last_cleanup = monotonic()
+                self.db.delete_expired_media(self.ttl)
+        except Exception as err:
+            log_error(f"Exception from MediaCache.set: {err}")
@@ -0,0 +1,155 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+# -- границы корзин гистограммы задержек, секунды --
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if(extra):
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    if(value == float('inf')):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+
+    # Metric - набор значений одной метрики по сочетаниям меток
+
+    type = ''
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+
+    # Histogram хранит для каждого набора меток счётчики по корзинам, сумму и количество наблюдений
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if(counts is None):
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+        for label_values, counts in items:
+            total = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                total += bucket_count
+                le = _format_labels(self.labels, label_values, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class MetricsRegistry():
+
+    # MetricsRegistry собирает метрики и отдаёт их в текстовом формате Prometheus
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+# -- метрики пересылки сообщений --
+STAGE_SECONDS = METRICS.histogram('wtcombot_stage_seconds', 'Time spent in a relay stage', ['stage'])
+MEDIA_BYTES = METRICS.counter('wtcombot_media_bytes_total', 'Bytes of media downloaded and uploaded', ['stage'])
+ERRORS = METRICS.counter('wtcombot_errors_total', 'Relay errors by the message reported to the chat', ['topic', 'error'])
+CONSUMER_LAG = METRICS.gauge('wtcombot_consumer_lag', 'Messages in a partition not yet read by the consumer', ['topic', 'partition'])
+RETRIES = METRICS.counter('wtcombot_retries_total', 'Messages scheduled for another attempt after a transient error', ['topic'])
+DEAD_LETTERS = METRICS.counter('wtcombot_dead_letters_total', 'Messages sent to the dead-letter topic', ['topic'])
+DUPLICATES = METRICS.counter('wtcombot_duplicates_total', 'Webhooks skipped because they were already relayed', ['topic'])
+COALESCED = METRICS.counter('wtcombot_coalesced_texts_total', 'WhatsApp texts merged into the previous text of the same user')
+ALBUMS = METRICS.counter('wtcombot_albums_total', 'WhatsApp photos and videos of one user sent to Telegram as one media group')
+ALBUM_ITEMS = METRICS.counter('wtcombot_album_items_total', 'WhatsApp photos and videos sent to Telegram inside a media group')
+STARTUP_SECONDS = METRICS.gauge('wtcombot_startup_seconds', 'Seconds from the import of main.py until a component was ready', ['component'])
+MEDIA_PREPARED = METRICS.counter('wtcombot_media_prepared_total', 'Files prepared for upload to WhatsApp by result', ['result'])
+MEDIA_BUDGET_BYTES = METRICS.gauge('wtcombot_media_budget_bytes', 'Bytes of media in flight (in_use), the highest value since start (peak) and the budget (limit)', ['state'])
+MEDIA_BUDGET_WAITING = METRICS.gauge('wtcombot_media_budget_waiting', 'Media transfers waiting for the byte budget')
+LANE_PENDING = METRICS.gauge('wtcombot_lane_pending', 'Messages received by the consumer and not yet processed, by lane', ['topic', 'lane'])
+CACHE_REQUESTS = METRICS.counter('wtcombot_cache_requests_total', 'Lookups in the in-memory caches by cache and result (hit or miss)', ['cache', 'result'])
+CACHE_EVICTIONS = METRICS.counter('wtcombot_cache_evictions_total', 'Entries pushed out of a full in-memory cache', ['cache'])
+LOG_DROPPED = METRICS.counter('wtcombot_log_dropped_total', 'Log records dropped because the log queue was full')
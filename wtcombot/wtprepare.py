@@ -0,0 +1,278 @@
+from logging import info as log_info, error as log_error
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from importlib.util import find_spec
+from io import BytesIO
+from mimetypes import guess_type
+from multiprocessing import get_context
+from os import SEEK_END
+from pathlib import PurePosixPath
+from threading import Lock
+from time import monotonic
+
+from wtbudget import ByteBudget
+from wtmetrics import STAGE_SECONDS, MEDIA_PREPARED
+
+# -- лимиты Cloud API на размер загружаемого файла, байты --
+WHATSAPP_LIMITS = {'image': 5 * 1024 * 1024, 'video': 16 * 1024 * 1024, 'audio': 16 * 1024 * 1024, 'document': 100 * 1024 * 1024}
+# -- форматы изображений, которые ватсап показывает как фото; остальные (webp, gif, bmp, tiff) перекодируются в JPEG --
+WHATSAPP_IMAGE_TYPES = ('image/jpeg', 'image/png')
+
+# -- сигнатуры форматов: (смещение, байты, MIME); для ftyp (MP4 и родственные) бренд разбирается отдельно --
+SIGNATURES = (
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'#!AMR', 'audio/amr'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+)
+FTYP_BRANDS = {b'3gp': 'video/3gpp', b'3g2': 'video/3gpp2', b'M4A': 'audio/mp4', b'qt ': 'video/quicktime', b'hei': 'image/heic',
+               b'avi': 'image/avif'}
+SNIFF_SIZE = 32
+
+# -- качество JPEG по очереди; если и при последнем файл больше лимита, картинка уменьшается --
+JPEG_QUALITIES = (85, 75, 60)
+MIN_IMAGE_SIDE = 320
+PREPARE_TIMEOUT = 60.0
+# -- сколько байт перекодированных картинок хранится для повторной загрузки --
+PREPARED_CACHE_BYTES = 16 * 1024 * 1024
+
+PreparedMedia = namedtuple('PreparedMedia', 'content filename mime_type size')
+
+
+class MediaTooLargeError(Exception):
+
+    # все поля передаются в Exception: исключение должно пережить pickle на пути из процесса пула
+
+    def __init__(self, kind, size, limit):
+        super().__init__(kind, size, limit)
+        self.kind = kind
+        self.size = size
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return f"{self.kind} of {self.size} bytes is larger than the WhatsApp limit of {self.limit} bytes"
+
+
+class MediaPreparationError(Exception):
+    pass
+
+
+def sniff_mime(head) -> str|None:
+
+    # sniff_mime определяет MIME по первым байтам файла; None, если формат не распознан
+
+    for offset, signature, mime_type in SIGNATURES:
+        if(head[offset:offset + len(signature)] == signature):
+            return mime_type
+    if(head[:4] == b'RIFF' and head[8:12] in (b'WEBP', b'WAVE', b'AVI ')):
+        return {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}[head[8:12]]
+    if(head[4:8] == b'ftyp'):
+        brand = head[8:12]
+        return FTYP_BRANDS.get(brand) or FTYP_BRANDS.get(brand[:3]) or 'video/mp4'
+    if(len(head) > 1 and head[0] == 0xff and head[1] & 0xf6 == 0xf0):
+        return 'audio/aac'
+    if(len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0):
+        return 'audio/mpeg'
+    return None
+
+
+def recompress_image(data, limit) -> bytes:
+
+    # recompress_image перекодирует изображение в JPEG не больше limit байт: сначала снижает качество,
+    # затем уменьшает картинку пропорционально превышению. Выполняется в процессе пула, Pillow импортируется здесь
+
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if(image.mode in ('RGBA', 'LA', 'P')):
+            # -- у JPEG нет прозрачности: прозрачные области становятся белыми --
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif(image.mode != 'RGB'):
+            image = image.convert('RGB')
+        while True:
+            for quality in JPEG_QUALITIES:
+                output = BytesIO()
+                image.save(output, 'JPEG', quality=quality)
+                if(output.tell() <= limit):
+                    return output.getvalue()
+            scale = min(0.9, (limit / output.tell()) ** 0.5)
+            width, height = int(image.width * scale), int(image.height * scale)
+            if(min(width, height) < MIN_IMAGE_SIDE):
+                raise MediaTooLargeError('image', len(data), limit)
+            image = image.resize((width, height), Image.LANCZOS)
+
+
+class PreparedCache():
+
+    # PreparedCache хранит перекодированные картинки по ключу исходного файла, не больше maxbytes байт.
+    # Хранимые байты занимают бюджет файлов (см. wtbudget.py): кэш не ждёт бюджет, а вытесняет свои старые записи,
+    # и если места всё равно нет, картинка не сохраняется
+
+    def __init__(self, maxbytes=PREPARED_CACHE_BYTES, ttl=600.0, budget=None):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.budget = budget or ByteBudget(0)
+        self.size = 0
+        # -- ключ -> (картинка, время истечения, байты бюджета) --
+        self.__data = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key) -> bytes|None:
+        with self.__lock:
+            item = self.__data.get(key)
+            if(item is None):
+                return None
+            if(item[1] < monotonic()):
+                self.__evict(key)
+                return None
+            self.__data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, data) -> None:
+        if(len(data) > self.maxbytes):
+            return
+        with self.__lock:
+            if(key in self.__data):
+                self.__evict(key)
+            while self.__data and self.size + len(data) > self.maxbytes:
+                self.__evict(next(iter(self.__data)))
+            reservation = self.budget.try_acquire(len(data))
+            while reservation is None and self.__data:
+                self.__evict(next(iter(self.__data)))
+                reservation = self.budget.try_acquire(len(data))
+            if(reservation is None):
+                return
+            self.__data[key] = (data, monotonic() + self.ttl, reservation)
+            self.size += len(data)
+
+    def clear(self) -> None:
+        with self.__lock:
+            for key in list(self.__data):
+                self.__evict(key)
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def __evict(self, key) -> None:
+        data, _, reservation = self.__data.pop(key)
+        self.size -= len(data)
+        self.budget.release(reservation)
+
+
+class MediaPreparer():
+
+    # MediaPreparer готовит файл из телеграма к загрузке в ватсап: определяет MIME по содержимому, а не по пути,
+    # проверяет лимит размера для типа сообщения и перекодирует фото, которые ватсап не примет (больше 5 МБ или
+    # не JPEG/PNG). Перекодирование идёт в пуле процессов: потоки-потребители не держат GIL, пока Pillow сжимает картинку.
+    # Пул создаётся при первом таком фото; workers=0 перекодирует в вызывающем потоке. Готовые картинки хранятся
+    # в кэше по хэшу исходного файла (PreparedCache, в пределах бюджета файлов): повтор после временной ошибки
+    # загрузки не перекодирует заново.
+    # Pillow необязателен: без него фото загружаются как есть, а больше лимита - не пересылаются
+
+    def __init__(self, workers=1, limits=None, cache_bytes=PREPARED_CACHE_BYTES, cache_ttl=600.0, timeout=PREPARE_TIMEOUT, budget=None):
+        self.workers = workers
+        self.limits = dict(WHATSAPP_LIMITS, **(limits or {}))
+        self.timeout = timeout
+        self.cache = PreparedCache(cache_bytes, cache_ttl, budget)
+        self.can_recompress = find_spec('PIL') is not None
+        if(not self.can_recompress):
+            log_info("Pillow is not installed: photos for WhatsApp are uploaded without recompression")
+        self.__pool = None
+        self.__lock = Lock()
+
+    def prepare(self, content, filename, kind, mime_type=None, key=None) -> PreparedMedia:
+
+        # prepare возвращает файл, его имя и MIME для upload_media. kind - тип сообщения ватсапа
+        # (image, video, audio, document); mime_type, заданный вызывающим, важнее определённого по содержимому
+
+        head = content.read(SNIFF_SIZE)
+        size = content.seek(0, SEEK_END)
+        content.seek(0)
+        detected = sniff_mime(head) or guess_type(filename)[0] or 'application/octet-stream'
+        mime_type = mime_type or detected
+        limit = self.limits.get(kind)
+        if(kind == 'image' and self.can_recompress and detected.startswith('image/') and
+           (size > limit or detected not in WHATSAPP_IMAGE_TYPES)):
+            return self.__recompress(content, filename, limit, key)
+        if(limit and size > limit):
+            MEDIA_PREPARED.inc('too_large')
+            raise MediaTooLargeError(kind, size, limit)
+        MEDIA_PREPARED.inc('as_is')
+        return PreparedMedia(content, filename, mime_type, size)
+
+    def close(self) -> None:
+        self.cache.clear()
+        with self.__lock:
+            if(self.__pool is not None):
+                self.__pool.shutdown(cancel_futures=True)
+                self.__pool = None
+
+    def __recompress(self, content, filename, limit, key) -> PreparedMedia:
+        data = self.cache.get(key) if key else None
+        if(data is None):
+            with STAGE_SECONDS.time('media_prepare'):
+                try:
+                    data = self.__run(recompress_image, content.read(), limit)
+                except MediaTooLargeError:
+                    MEDIA_PREPARED.inc('too_large')
+                    raise
+                except MediaPreparationError:
+                    MEDIA_PREPARED.inc('failed')
+                    raise
+                except Exception as err:
+                    # -- Pillow не смог прочитать картинку --
+                    MEDIA_PREPARED.inc('failed')
+                    raise MediaPreparationError(f"Cannot recompress {filename}: {err}") from err
+            if(key):
+                self.cache.set(key, data)
+        MEDIA_PREPARED.inc('recompressed')
+        return PreparedMedia(BytesIO(data), str(PurePosixPath(filename).with_suffix('.jpg')), 'image/jpeg', len(data))
+
+    def __run(self, function, *args):
+        if(self.workers <= 0):
+            return function(*args)
+        pool = self.__get_pool()
+        future = pool.submit(function, *args)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            # -- зависший процесс занимает место в пуле: пул останавливается, следующий файл получит новый --
+            log_error(f"Media preparation took longer than {self.timeout} s, the pool is restarted")
+            self.__discard_pool(pool)
+            raise MediaPreparationError(f"Media preparation took longer than {self.timeout} s")
+        except BrokenProcessPool as err:
+            # -- процесс пула убит (например, по памяти): следующий файл получит новый пул --
+            log_error(f"Media preparation pool is broken: {err}")
+            self.__discard_pool(pool)
+            raise MediaPreparationError(str(err))
+
+    def __discard_pool(self, pool) -> None:
+        with self.__lock:
+            if(self.__pool is pool):
+                self.__pool = None
+        # -- shutdown не прерывает работающие задачи, поэтому процессы пула завершаются явно --
+        for process in list((getattr(pool, '_processes', None) or {}).values()):
+            if(process.is_alive()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def __get_pool(self) -> ProcessPoolExecutor:
+        with self.__lock:
+            if(self.__pool is None):
+                # -- spawn, а не fork: в процессе уже работают потоки потребителей и kafka --
+                self.__pool = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+                log_info(f"Media preparation pool started with {self.workers} processes")
+            return self.__pool
@@ -0,0 +1,110 @@
+from logging import info as log_info
+from heapq import heappush, heapify
+from itertools import count
+from threading import Condition
+from time import monotonic
+
+from wtmetrics import STAGE_SECONDS
+
+# -- очереди с приоритетом: сообщения пользователей отправляются раньше уведомлений об ошибках --
+PRIORITY_CUSTOMER = 0
+PRIORITY_NOTICE = 1
+
+MAX_IDLE_BUCKETS = 10000
+
+
+class TokenBucket():
+
+    # TokenBucket - ведро токенов одного получателя: rate токенов в секунду, не больше capacity подряд
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+        self.waiting = []
+
+    def wait_time(self, now) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if(now < self.blocked_until):
+            return self.blocked_until - now
+        if(self.tokens >= 1):
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now) -> bool:
+        return not self.waiting and now >= self.blocked_until and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class OutboundScheduler():
+
+    # OutboundScheduler сглаживает всплески исходящих сообщений: перед отправкой поток ждёт токен
+    # в ведре получателя, а после ответа 429 все отправки этому получателю приостанавливаются на retry_after
+
+    def __init__(self, name, rate, capacity, max_retries=3, default_retry_after=6.0):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.max_retries = max_retries
+        self.default_retry_after = default_retry_after
+        self.__buckets = {}
+        self.__condition = Condition()
+        self.__tickets = count()
+
+    def acquire(self, destination, priority=PRIORITY_CUSTOMER) -> None:
+        with self.__condition:
+            bucket = self.__bucket(destination)
+            ticket = (priority, next(self.__tickets))
+            heappush(bucket.waiting, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if(bucket.waiting[0] == ticket):
+                        timeout = bucket.wait_time(monotonic())
+                        if(timeout <= 0):
+                            bucket.take()
+                            return
+                    self.__condition.wait(timeout)
+            finally:
+                bucket.waiting.remove(ticket)
+                heapify(bucket.waiting)
+                self.__condition.notify_all()
+
+    def retry_after(self, destination, seconds) -> None:
+        with self.__condition:
+            bucket = self.__bucket(destination)
+            bucket.blocked_until = max(bucket.blocked_until, monotonic() + seconds)
+            self.__condition.notify_all()
+        log_info(f"{self.name}: rate limited for {destination}, retry after {seconds} s")
+
+    def call(self, destination, func, priority=PRIORITY_CUSTOMER, get_retry_after=None):
+
+        # call отправляет сообщение с учётом лимита; если получатель ответил 429, ждёт retry_after и повторяет
+
+        attempt = 0
+        while True:
+            with STAGE_SECONDS.time(f'{self.name}_rate_limit_wait'):
+                self.acquire(destination, priority)
+            try:
+                return func()
+            except Exception as err:
+                seconds = get_retry_after(err) if get_retry_after else None
+                if(seconds is None or attempt >= self.max_retries):
+                    raise
+                attempt += 1
+                self.retry_after(destination, seconds or self.default_retry_after)
+
+    def __bucket(self, destination) -> TokenBucket:
+        bucket = self.__buckets.get(destination)
+        if(bucket is None):
+            if(len(self.__buckets) >= MAX_IDLE_BUCKETS):
+                now = monotonic()
+                for key in [key for key, value in self.__buckets.items() if value.idle(now)]:
+                    del self.__buckets[key]
+            bucket = self.__buckets[destination] = TokenBucket(self.rate, self.capacity)
+        return bucket
@@ -0,0 +1,91 @@
+from argparse import ArgumentParser
+from collections import Counter
+from json import dumps
+from time import monotonic
+from dotenv import load_dotenv
+
+from wtconfig import env_str, env_int, env_float
+from wtconsumer import offset_and_metadata
+from wtretry import dead_letter_topic
+from wttransport import create_transport, QueueLockedError, MalformedValue
+
+# -- у команды своя группа потребителей, чтобы не вызывать перебалансировку работающего бота --
+REPLAY_GROUP_ID = 'wtcombot-replay'
+
+
+def replay(transport, topic, limit=None, dry_run=False, idle_timeout=5.0) -> tuple[int, Counter]:
+
+    # replay переотправляет сообщения из <topic>_dlq в исходный топик и фиксирует смещения в <topic>_dlq.
+    # Чтение заканчивается, когда новых сообщений нет idle_timeout секунд или переотправлено limit сообщений
+
+    consumer = transport.consumer(group_id=REPLAY_GROUP_ID)
+    producer = transport.producer()
+    consumer.subscribe([dead_letter_topic(topic)])
+    replayed = 0
+    reasons = Counter()
+    deadline = monotonic() + idle_timeout
+    try:
+        while (limit is None or replayed < limit) and monotonic() < deadline:
+            records = consumer.poll(timeout_ms=500)
+            if(not records):
+                continue
+            deadline = monotonic() + idle_timeout
+            offsets = {}
+            for tp, messages in records.items():
+                for msg in messages:
+                    if(limit is not None and replayed >= limit):
+                        break
+                    record = msg.value
+                    if(isinstance(record, MalformedValue)):
+                        reasons[f"unreadable dead letter, {record.error}"] += 1
+                        offsets[tp] = offset_and_metadata(msg.offset + 1)
+                        continue
+                    reasons[record.get('error')] += 1
+                    if(not dry_run):
+                        producer.send(record['topic'], value=dumps(record['value']).encode('utf-8'), key=record.get('key'))
+                    offsets[tp] = offset_and_metadata(msg.offset + 1)
+                    replayed += 1
+            if(not dry_run and offsets):
+                producer.flush()
+                consumer.commit(offsets)
+    finally:
+        consumer.close()
+    return replayed, reasons
+
+
+def parse_args():
+    parser = ArgumentParser(description='Send messages from the dead-letter topics back to the bot')
+    parser.add_argument('envfile', help='env file of the bot')
+    parser.add_argument('--topic', action='append', choices=['whatsapp', 'telegram'], help='topic to replay, both by default')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of messages per topic')
+    parser.add_argument('--dry-run', action='store_true', help='only count the messages and their errors')
+    parser.add_argument('--idle-timeout', type=float, default=5.0, help='seconds without new messages after which replay stops')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if(not load_dotenv(args.envfile)):
+        raise SystemExit(f"Env file not found: {args.envfile}")
+    transport_name = env_str('WT_COMBOT_TRANSPORT', 'kafka')
+    queue_path = env_str('WT_COMBOT_QUEUE_PATH', '')
+    # -- очередь в памяти принадлежит процессу бота, из другого процесса её не прочитать --
+    if(transport_name == 'local' and not queue_path):
+        raise SystemExit("The local queue is kept in memory: set WT_COMBOT_QUEUE_PATH to replay dead letters")
+    # -- работающий бот держит файл очереди: строки, записанные мимо него, заняли бы его следующие смещения --
+    try:
+        transport = create_transport(transport_name,
+                                     bootstrap_servers=env_str('WT_COMBOT_KAFKA_SERVERS', 'localhost:9092'),
+                                     queue_size=env_int('WT_COMBOT_QUEUE_SIZE', 10000),
+                                     queue_path=queue_path,
+                                     put_timeout=env_float('WT_COMBOT_QUEUE_PUT_TIMEOUT', 1.0))
+    except QueueLockedError as err:
+        raise SystemExit(f"{err}: stop the bot before replaying dead letters from the local queue")
+    try:
+        for topic in args.topic or ['whatsapp', 'telegram']:
+            replayed, reasons = replay(transport, topic, args.limit, args.dry_run, args.idle_timeout)
+            print(f"{dead_letter_topic(topic)}: {replayed} messages {'found' if args.dry_run else 'replayed'}")
+            for reason, number in reasons.most_common():
+                print(f"  {number:>6}  {reason}")
+    finally:
+        transport.close()
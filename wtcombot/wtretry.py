@@ -0,0 +1,150 @@
+from logging import info as log_info, error as log_error, exception as log_exception
+from heapq import heappush, heappop
+from itertools import count
+from json import dumps
+from random import uniform
+from threading import Condition, Thread
+from time import monotonic, time
+
+from wterror import WTCombotError, WTCombotTransientError
+from wtmetrics import DEAD_LETTERS
+
+# -- сообщения, которые не удалось отправить, попадают в топик с этим окончанием --
+DLQ_SUFFIX = '_dlq'
+
+
+def is_transient(err) -> bool:
+
+    # is_transient - ошибка, после которой отправку имеет смысл повторить: 5xx, 429, обрыв соединения, таймаут.
+    # requests и telebot импортируются здесь, а не при запуске: к первой ошибке они уже загружены ботами
+
+    from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError, HTTPError
+    from telebot.apihelper import ApiTelegramException, ApiHTTPException
+
+    if(isinstance(err, (WTCombotTransientError, ConnectionError, Timeout, ChunkedEncodingError))):
+        return True
+    if(isinstance(err, HTTPError) and err.response is not None):
+        return err.response.status_code == 429 or err.response.status_code >= 500
+    if(isinstance(err, ApiTelegramException)):
+        return err.error_code == 429 or err.error_code >= 500
+    # -- 502 и 503 телеграм отдаёт HTML-страницей, а не JSON с error_code --
+    if(isinstance(err, ApiHTTPException) and err.result is not None):
+        return err.result.status_code == 429 or err.result.status_code >= 500
+    return False
+
+
+def dead_letter_topic(topic) -> str:
+    return f"{topic}{DLQ_SUFFIX}"
+
+
+class RetryPolicy():
+
+    # RetryPolicy - сколько раз повторять сообщение и через сколько секунд:
+    # экспоненциальная задержка со случайным разбросом (full jitter), не больше max_delay
+
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, err, attempt) -> bool:
+        return attempt < self.attempts and is_transient(err)
+
+    def backoff(self, attempt) -> float:
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class DelayQueue():
+
+    # DelayQueue вызывает функции в заданное время в своём потоке, поэтому ожидание повтора
+    # не занимает ни потребителя, ни обработчиков
+
+    def __init__(self, name='delay-queue'):
+        self.__heap = []
+        self.__tickets = count()
+        self.__condition = Condition()
+        self.__stopped = False
+        self.__thread = Thread(target=self.__run, name=name, daemon=True)
+
+    def start(self) -> 'DelayQueue':
+        self.__thread.start()
+        return self
+
+    def schedule(self, delay, func, *args) -> None:
+        with self.__condition:
+            heappush(self.__heap, (monotonic() + delay, next(self.__tickets), func, args))
+            self.__condition.notify()
+
+    def pending(self) -> int:
+        with self.__condition:
+            return len(self.__heap)
+
+    def stop(self) -> None:
+
+        # stop отбрасывает ещё не наступившие повторы: их смещения не зафиксированы,
+        # и после перезапуска сообщения будут прочитаны снова
+
+        with self.__condition:
+            self.__stopped = True
+            dropped = len(self.__heap)
+            self.__heap.clear()
+            self.__condition.notify()
+        if(self.__thread.is_alive()):
+            self.__thread.join()
+        if(dropped):
+            log_info(f"{dropped} delayed retries dropped, they will be read again after restart")
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while True:
+                    if(self.__stopped):
+                        return
+                    now = monotonic()
+                    if(self.__heap and self.__heap[0][0] <= now):
+                        _, _, func, args = heappop(self.__heap)
+                        break
+                    self.__condition.wait(self.__heap[0][0] - now if self.__heap else None)
+            try:
+                func(*args)
+            except Exception as err:
+                log_error(f"Exception from DelayQueue: {err}")
+                log_exception("message")
+
+
+class DeadLetterQueue():
+
+    # DeadLetterQueue отправляет сообщение, которое не удалось обработать, в топик <topic>_dlq
+    # вместе с причиной ошибки; оттуда его можно переотправить командой wtreplay.py
+
+    def __init__(self, producer, on_dead_letter=None):
+        self.producer = producer
+        self.on_dead_letter = on_dead_letter
+
+    def send(self, key, tp, offset, value, attempts, err) -> None:
+        self.__send(tp.topic, tp.partition, offset, key, value, attempts, err, f"{tp.topic}[{tp.partition}]@{offset}")
+
+    def send_value(self, topic, key, value, attempts, err) -> None:
+
+        # send_value - сообщение, которое уже не лежит в очереди (например, пачка текстов из TextCoalescer):
+        # value собирается заново в виде вебхука, у записи нет партиции и смещения
+
+        self.__send(topic, None, None, key, value, attempts, err, f"{topic} message of {key}")
+
+    def __send(self, topic, partition, offset, key, value, attempts, err, source) -> None:
+        reason = f"{type(err).__name__}: {err.get_message() if isinstance(err, WTCombotError) else err}"
+        log_error(f"{source} sent to {dead_letter_topic(topic)} after {attempts} attempts: {reason}")
+        DEAD_LETTERS.inc(topic)
+        record = {'topic': topic, 'partition': partition, 'offset': offset, 'key': key, 'attempts': attempts,
+                  'error': reason, 'failed_at': int(time()), 'value': value}
+        try:
+            self.producer.send(dead_letter_topic(topic), value=dumps(record).encode('utf-8'), key=key)
+        except Exception as err:
+            log_error(f"Exception from DeadLetterQueue.send: {err}")
+            log_exception("message")
+        if(self.on_dead_letter):
+            try:
+                self.on_dead_letter(topic, value, reason)
+            except Exception as err:
+                log_error(f"Exception from on_dead_letter: {err}")
+                log_exception("message")
@@ -0,0 +1,117 @@
+from logging import info as log_info, error as log_error, exception as log_exception
+from os import fork, wait, kill, _exit, WIFEXITED, WEXITSTATUS
+import signal
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from time import monotonic, sleep
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+BACKLOG = 1024
+# -- воркер, упавший быстрее, перезапускается не сразу, чтобы ошибка в настройках не превратилась в бесконечный fork --
+RESTART_DELAY = 1.0
+MIN_UPTIME = 5.0
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+
+    # KeepAliveRequestHandler - HTTP/1.1: Meta и Telegram присылают вебхуки по постоянным соединениям
+
+    protocol_version = 'HTTP/1.1'
+
+
+def serve_app(app, host='127.0.0.1', port=5000) -> None:
+
+    # serve_app обслуживает приложение в одном процессе несколькими потоками, без fork и без отладчика werkzeug:
+    # так работают роли consumer и all, в которых живут потоки-потребители
+
+    server = make_server(host, port, app, threaded=True, request_handler=KeepAliveRequestHandler)
+    log_info(f"Serving on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class PreforkServer():
+
+    # PreforkServer - сервер для роли web без внешних зависимостей. Родительский процесс открывает сокет
+    # и запускает workers процессов; каждый из них после fork создаёт своё приложение (и свой продюсер)
+    # через app_factory и принимает соединения с общего сокета в нескольких потоках.
+    # Упавший воркер перезапускается, SIGINT и SIGTERM останавливают все воркеры, SIGHUP передаётся воркерам
+
+    def __init__(self, app_factory, host='127.0.0.1', port=5000, workers=2):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.__children = {}
+        self.__stopping = False
+
+    def serve(self) -> None:
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(BACKLOG)
+        log_info(f"Pre-fork server on {self.host}:{self.port} with {self.workers} workers")
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGHUP, self.__forward)
+        for _ in range(self.workers):
+            self.__spawn(listener)
+        while self.__children:
+            try:
+                pid, status = wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = self.__children.pop(pid, None)
+            if(self.__stopping or started is None):
+                continue
+            code = WEXITSTATUS(status) if WIFEXITED(status) else -1
+            log_error(f"Worker {pid} exited with code {code}, restarting")
+            if(monotonic() - started < MIN_UPTIME):
+                sleep(RESTART_DELAY)
+            self.__spawn(listener)
+        listener.close()
+
+    def __spawn(self, listener) -> None:
+        pid = fork()
+        if(pid):
+            self.__children[pid] = monotonic()
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # -- пока приложение не поставило свой обработчик, SIGHUP воркер не останавливает --
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            app = self.app_factory()
+            bridge = app.extensions.get('wtcombot')
+
+            def stop(signum, frame):
+                raise SystemExit(0)
+
+            signal.signal(signal.SIGTERM, stop)
+            server = make_server(self.host, self.port, app, threaded=True, request_handler=KeepAliveRequestHandler, fd=listener.fileno())
+            try:
+                server.serve_forever()
+            finally:
+                if(bridge):
+                    bridge.stop()
+        except SystemExit:
+            pass
+        except Exception as err:
+            log_error(f"Exception in worker: {err}")
+            log_exception("message")
+            code = 1
+        _exit(code)
+
+    def __stop(self, signum, frame) -> None:
+        self.__stopping = True
+        self.__forward(signal.SIGTERM, frame)
+
+    def __forward(self, signum, frame) -> None:
+        for pid in list(self.__children):
+            try:
+                kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,198 @@
+from logging import info as log_info, error as log_error
+from collections import namedtuple
+from json import load
+from os import getenv, strerror
+from errno import ENOENT
+from pathlib import Path
+from re import fullmatch
+from dotenv import load_dotenv
+
+from wtcombot import TGWACOM
+from wtretry import is_transient
+
+# -- клиент: бизнес-номер в ватсапе и чат операторов в телеграме со своими ботами --
+Tenant = namedtuple('Tenant', 'name wa_number_id wa_access_token wa_verify_token tg_chat_id tg_bot_id tg_api_token')
+
+# -- поля клиента в файле WT_COMBOT_TENANTS; не указанное поле берётся из переменной окружения с тем же именем --
+TENANT_ENV = {field: f"WT_COMBOT_{field.upper()}" for field in Tenant._fields if field != 'name'}
+
+# -- имя клиента попадает в путь вебхука телеграма /t/<name> --
+TENANT_NAME = r'[A-Za-z0-9_-]{1,64}'
+
+
+def load_tenants(path) -> list[Tenant]:
+
+    # load_tenants читает список клиентов из JSON-файла:
+    # [{"name": "sales", "wa_number_id": "...", "wa_access_token": "...", "tg_chat_id": -100..., ...}, ...]
+    # Имена, номера и чаты не должны повторяться; одно имя может быть пустым - это клиент по умолчанию,
+    # которому принадлежат записи в базе, сделанные до появления клиентов
+
+    with open(path, encoding='utf-8') as file:
+        entries = load(file)
+    if(not isinstance(entries, list) or not entries):
+        raise ValueError(f"{path}: expected a non-empty list of tenants")
+    tenants = []
+    for entry in entries:
+        name = str(entry.get('name', ''))
+        if(name and not fullmatch(TENANT_NAME, name)):
+            raise ValueError(f"{path}: invalid tenant name '{name}', expected {TENANT_NAME}")
+        values = {field: entry.get(field, getenv(env_name)) for field, env_name in TENANT_ENV.items()}
+        tenants.append(Tenant(name=name, **{field: str(value) if value is not None else None for field, value in values.items()}))
+    for field in ('name', 'wa_number_id', 'tg_chat_id'):
+        values = [getattr(tenant, field) for tenant in tenants]
+        duplicates = {value for value in values if values.count(value) > 1}
+        if(duplicates):
+            raise ValueError(f"{path}: tenants with the same {field}: {', '.join(map(str, duplicates))}")
+    return tenants
+
+
+class TenantRegistry():
+
+    # TenantRegistry - все клиенты одного процесса. Вебхуки ватсапа распределяются по metadata.phone_number_id,
+    # обновления телеграма - по id чата. HTTP-сессии, пул базы, кэш media_id, дедупликация, объединение текстов
+    # и потоки-потребители общие, у клиента свои только боты, лимиты отправки и кэши связей сообщений.
+    # Без WT_COMBOT_TENANTS клиент один - тот, что описан в файле окружения
+
+    def __init__(self, filename):
+        if(not load_dotenv(filename)):
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), filename)
+        path = getenv('WT_COMBOT_TENANTS')
+        tenants = [None]
+        if(path):
+            # -- относительный путь считается от папки файла окружения --
+            path = Path(filename).parent / path
+            tenants = load_tenants(path)
+            log_info(f"Tenants from {path}: {', '.join(repr(tenant.name) for tenant in tenants)}")
+        self.bots = {}
+        for tenant in tenants:
+            bot = TGWACOM(filename, tenant)
+            self.bots[bot.name] = bot
+        self.default = next(iter(self.bots.values()))
+        self.resources = None
+        self.__by_number = {}
+        self.__by_chat = {}
+
+    def __len__(self) -> int:
+        return len(self.bots)
+
+    def tenant(self, name='') -> TGWACOM|None:
+        return self.bots.get(name)
+
+    def check_env_variables(self) -> bool:
+
+        # check_env_variables проверяет настройки всех клиентов и строит индексы по номеру и чату
+
+        valid = True
+        for bot in self.bots.values():
+            if(not bot.check_env_variables()):
+                log_error(f"Not all settings are declared for tenant '{bot.name}'")
+                valid = False
+        self.__by_number = {str(bot.get_wa_number_id()): bot for bot in self.bots.values()}
+        self.__by_chat = {bot.get_tg_chat_id(): bot for bot in self.bots.values()}
+        return valid
+
+    def setup(self) -> None:
+
+        # setup создаёт общие ресурсы один раз и ботов каждого клиента
+
+        self.resources = self.default.create_resources(self.send_texts, self.send_album, self.dead_letter_batch)
+        for bot in self.bots.values():
+            bot.setup(self.resources)
+
+    def close(self) -> None:
+        if(self.resources):
+            self.resources.close()
+
+    def get_http_stats(self) -> dict:
+        return self.resources.get_http_stats()
+
+    def is_wa_verify_token(self, token) -> bool:
+        return bool(token) and any(token == bot.get_wa_verify_token() for bot in self.bots.values())
+
+    def by_number(self, number_id) -> TGWACOM|None:
+        bot = self.__by_number.get(str(number_id))
+        return bot or (self.default if len(self.bots) == 1 else None)
+
+    def by_chat(self, chat_id) -> TGWACOM|None:
+        bot = self.__by_chat.get(chat_id)
+        return bot or (self.default if len(self.bots) == 1 else None)
+
+    def wa_point(self, json_data) -> None:
+
+        # wa_point делит вебхук по бизнес-номерам и передаёт каждую часть клиенту этого номера.
+        # Ошибка одного клиента не мешает остальным: она поднимается после них (временная - раньше других,
+        # чтобы вебхук повторился), и при повторе уже пересланные сообщения отсекает дедупликация
+
+        errors = []
+        for number_id, envelope in self.split_by_number(json_data).items():
+            bot = self.by_number(number_id)
+            if(bot is None):
+                log_error(f"Whatsapp webhook for an unknown phone_number_id: {number_id}")
+                continue
+            try:
+                bot.wa_point(envelope)
+            except Exception as err:
+                log_error(f"Exception from wa_point of tenant '{bot.name}': {err}")
+                errors.append(err)
+        if(errors):
+            raise next((err for err in errors if is_transient(err)), errors[0])
+
+    def tg_point(self, data) -> None:
+        bot = self.by_chat(self.get_chat_id(data))
+        if(bot is None):
+            log_info(f"Telegram update from a chat without a tenant: {self.get_chat_id(data)}")
+            return
+        bot.tg_point(data)
+
+    def notify_dead_letter(self, topic, data, reason) -> None:
+        bot = self.by_chat(self.get_chat_id(data)) if topic == 'telegram' else None
+        if(bot):
+            bot.notify_dead_letter(topic, data, reason)
+
+    def send_texts(self, key, items, name) -> None:
+        self.bots[key[0]].send_texts(key, items, name)
+
+    def dead_letter_batch(self, key, items, attempts, err) -> None:
+        self.bots[key[0]].dead_letter_batch(key, items, attempts, err)
+
+    def set_dead_letters(self, dead_letters) -> None:
+        if(self.resources):
+            self.resources.dead_letters = dead_letters
+
+    def send_album(self, key, items, name) -> None:
+        self.bots[key[0]].send_album(key, items, name)
+
+    def get_conversation_key(self, topic, data) -> str|None:
+        bot = self.by_chat(self.get_chat_id(data)) if topic == 'telegram' else self.default
+        return (bot or self.default).get_conversation_key(topic, data)
+
+    def get_raw_conversation_key(self, topic, body, tenant='') -> str|None:
+
+        # для обновлений телеграма клиент известен по пути вебхука /t/<name>
+
+        return (self.bots.get(tenant) or self.default).get_raw_conversation_key(topic, body)
+
+    def get_lane(self, topic, data) -> str:
+        return self.default.get_lane(topic, data)
+
+    def consumeData(self, consumer, workers, committer, max_records=100, timeout_ms=500) -> None:
+        self.default.consumeData(consumer, workers, committer, max_records, timeout_ms, get_key=self.get_conversation_key)
+
+    @staticmethod
+    def get_chat_id(data) -> int|None:
+        message = data.get('message') or {}
+        return message.get('chat', {}).get('id')
+
+    @staticmethod
+    def split_by_number(json_data) -> dict:
+
+        # split_by_number раскладывает изменения вебхука по metadata.phone_number_id,
+        # сохраняя конверт entry/changes, который разбирает WhatsAppBot.split_envelope
+
+        envelopes = {}
+        for entry in json_data.get("entry", []):
+            for change in entry.get("changes", []):
+                number_id = str(change.get("value", {}).get("metadata", {}).get("phone_number_id", ''))
+                envelope = envelopes.setdefault(number_id, {**json_data, "entry": []})
+                envelope["entry"].append({**entry, "changes": [change]})
+        return envelopes
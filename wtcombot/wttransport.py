@@ -0,0 +1,309 @@
+from logging import info as log_info, error as log_error
+from collections import namedtuple, deque
+from json import loads
+from sqlite3 import connect as sqlite_connect
+from threading import Condition, Lock
+from time import time, monotonic
+
+# -- у локальной очереди одна партиция на топик --
+TopicPartition = namedtuple('TopicPartition', 'topic partition')
+Record = namedtuple('Record', 'topic partition offset timestamp key value')
+
+QUEUE_SIZE = 10000
+PUT_TIMEOUT = 1.0
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueLockedError(Exception):
+    pass
+
+
+class MalformedValue(namedtuple('MalformedValue', 'raw error')):
+
+    # MalformedValue - тело сообщения, которое не разбирается как JSON; потребитель отправляет его в DLQ
+
+    pass
+
+
+def deserialize(value) -> dict|MalformedValue:
+
+    # deserialize не поднимает исключение: kafka не сдвигает позицию за сообщение, которое не удалось разобрать,
+    # и каждый следующий poll падал бы на нём же
+
+    try:
+        return loads(value.decode('utf-8'))
+    except (AttributeError, ValueError) as err:
+        return MalformedValue(value or b'', f"{type(err).__name__}: {err}")
+
+
+def serialize_key(key) -> bytes|None:
+    return key.encode('utf-8') if key else None
+
+
+class KafkaTransport():
+
+    # KafkaTransport - вебхуки передаются потребителям через брокер kafka
+
+    def __init__(self, bootstrap_servers=('localhost:9092',), group_id='test-consumer-group'):
+        self.bootstrap_servers = list(bootstrap_servers)
+        self.group_id = group_id
+
+    @property
+    def errors(self) -> tuple:
+
+        # errors - исключения продюсера и потребителя; kafka импортируется при первом обращении, а не при запуске
+
+        from kafka.errors import KafkaError
+        return (KafkaError,)
+
+    def producer(self):
+        from kafka import KafkaProducer
+        return KafkaProducer(key_serializer=serialize_key, api_version=(0,10,2), bootstrap_servers=self.bootstrap_servers)
+
+    def consumer(self, max_records=100, group_id=None):
+        from kafka import KafkaConsumer
+        return KafkaConsumer(value_deserializer=deserialize, auto_offset_reset='earliest', bootstrap_servers=self.bootstrap_servers,
+                             group_id=group_id or self.group_id, max_poll_records=max_records, enable_auto_commit=False, api_version=(0,10,2))
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStore():
+
+    # SQLiteStore сохраняет ещё не зафиксированные сообщения локальной очереди на диск,
+    # чтобы они были обработаны после перезапуска бота. Смещения очереди живут в памяти процесса,
+    # поэтому файл открывает только один процесс: второй получает QueueLockedError, а не пишет строки
+    # со смещениями, которые первый потом займёт повторно
+
+    def __init__(self, path):
+        from fcntl import flock, LOCK_EX, LOCK_NB
+        self.path = path
+        self.__lock = Lock()
+        self.__lock_file = open(f"{path}.lock", 'a')
+        try:
+            flock(self.__lock_file, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            self.__lock_file.close()
+            raise QueueLockedError(f"Queue file {path} is used by another process")
+        self.__conn = sqlite_connect(path, check_same_thread=False, isolation_level=None)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA synchronous=NORMAL')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS queue_messages (topic text NOT NULL, message_offset integer NOT NULL, '
+                            'timestamp integer NOT NULL, key blob, value blob NOT NULL, PRIMARY KEY (topic, message_offset))')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS queue_offsets (topic text PRIMARY KEY, committed integer NOT NULL)')
+
+    def load(self, topic) -> tuple[int, list]:
+        with self.__lock:
+            row = self.__conn.execute('SELECT committed FROM queue_offsets WHERE topic = ?', (topic,)).fetchone()
+            committed = row[0] if row else 0
+            rows = self.__conn.execute('SELECT message_offset, timestamp, key, value FROM queue_messages '
+                                       'WHERE topic = ? AND message_offset >= ? ORDER BY message_offset', (topic, committed)).fetchall()
+        return committed, rows
+
+    def append(self, topic, offset, timestamp, key, value) -> None:
+        with self.__lock:
+            self.__conn.execute('INSERT INTO queue_messages (topic, message_offset, timestamp, key, value) VALUES (?, ?, ?, ?, ?)',
+                                (topic, offset, timestamp, key, value))
+
+    def commit(self, topic, offset) -> None:
+        with self.__lock:
+            self.__conn.execute('BEGIN')
+            self.__conn.execute('INSERT INTO queue_offsets (topic, committed) VALUES (?, ?) '
+                                'ON CONFLICT (topic) DO UPDATE SET committed = excluded.committed', (topic, offset))
+            self.__conn.execute('DELETE FROM queue_messages WHERE topic = ? AND message_offset < ?', (topic, offset))
+            self.__conn.execute('COMMIT')
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+        # -- закрытие файла снимает блокировку --
+        self.__lock_file.close()
+
+
+class LocalQueue():
+
+    # LocalQueue - ограниченная очередь одного топика; сообщение удаляется после фиксации его смещения
+
+    def __init__(self, topic, maxsize=QUEUE_SIZE, store=None):
+        self.topic = topic
+        self.tp = TopicPartition(topic, 0)
+        self.maxsize = maxsize
+        self.store = store
+        self.records = deque()
+        self.condition = Condition()
+        self.committed = 0
+        if(store):
+            self.committed, rows = store.load(topic)
+            self.records.extend(Record(topic, 0, offset, timestamp, key, value) for offset, timestamp, key, value in rows)
+            if(rows):
+                log_info(f"Queue '{topic}': {len(rows)} messages restored from {store.path}")
+        self.next_offset = self.records[-1].offset + 1 if self.records else self.committed
+
+    def put(self, key, value, timeout=PUT_TIMEOUT) -> int:
+        deadline = monotonic() + timeout
+        with self.condition:
+            while len(self.records) >= self.maxsize:
+                remaining = deadline - monotonic()
+                if(remaining <= 0):
+                    raise QueueFullError(f"Queue '{self.topic}' is full: {self.maxsize} messages are waiting")
+                self.condition.wait(remaining)
+            record = Record(self.topic, 0, self.next_offset, int(time() * 1000), key, value)
+            if(self.store):
+                self.store.append(self.topic, record.offset, record.timestamp, key, value)
+            self.records.append(record)
+            self.next_offset += 1
+            self.condition.notify_all()
+            return record.offset
+
+    def fetch(self, position, max_records, timeout) -> list:
+        with self.condition:
+            if(self.next_offset <= position and timeout > 0):
+                self.condition.wait(timeout)
+            if(not self.records):
+                return []
+            start = max(0, position - self.records[0].offset)
+            return [self.records[i] for i in range(start, min(len(self.records), start + max_records))]
+
+    def commit(self, offset) -> None:
+        with self.condition:
+            if(offset <= self.committed):
+                return
+            if(self.store):
+                self.store.commit(self.topic, offset)
+            self.committed = offset
+            while self.records and self.records[0].offset < offset:
+                self.records.popleft()
+            self.condition.notify_all()
+
+
+class LocalProducer():
+
+    # LocalProducer кладёт тело вебхука в очередь своего процесса, ключ сериализуется как в kafka
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def send(self, topic, value=None, key=None) -> int:
+        return self.transport.queue(topic).put(serialize_key(key), value, self.transport.put_timeout)
+
+    def partitions_for(self, topic) -> set:
+        return {self.transport.queue(topic).tp.partition}
+
+    def flush(self, timeout=None) -> None:
+        pass
+
+    def close(self, timeout=None) -> None:
+        pass
+
+
+class LocalConsumer():
+
+    # LocalConsumer читает локальную очередь с тем же интерфейсом, что у KafkaConsumer:
+    # poll, pause/resume, commit/commit_async, highwater/position
+
+    def __init__(self, transport, max_records=100):
+        self.transport = transport
+        self.max_records = max_records
+        self.queue = None
+        self.position_offset = 0
+        self.is_paused = False
+
+    def subscribe(self, topics, listener=None) -> None:
+        self.queue = self.transport.queue(topics[0])
+        self.position_offset = self.queue.committed
+        if(listener):
+            listener.on_partitions_assigned([self.queue.tp])
+
+    def assignment(self) -> set:
+        return {self.queue.tp} if self.queue else set()
+
+    def paused(self) -> set:
+        return self.assignment() if self.is_paused else set()
+
+    def pause(self, *partitions) -> None:
+        self.is_paused = self.is_paused or bool(partitions)
+
+    def resume(self, *partitions) -> None:
+        self.is_paused = self.is_paused and not partitions
+
+    def poll(self, timeout_ms=0, max_records=None) -> dict:
+
+        # poll разбирает сообщения по одному, как kafka: неразобранное приходит как MalformedValue, а не теряет
+        # остальные сообщения пачки. Позиция сдвигается, только когда вся пачка разобрана
+
+        if(self.is_paused):
+            return {}
+        records = self.queue.fetch(self.position_offset, max_records or self.max_records, timeout_ms / 1000)
+        if(not records):
+            return {}
+        batch = [record._replace(value=deserialize(record.value)) for record in records]
+        self.position_offset = records[-1].offset + 1
+        return {self.queue.tp: batch}
+
+    def commit(self, offsets=None) -> None:
+        for tp, meta in (offsets or {}).items():
+            self.transport.queue(tp.topic).commit(meta.offset)
+
+    def commit_async(self, offsets=None, callback=None) -> None:
+        try:
+            self.commit(offsets)
+        except Exception as err:
+            log_error(f"Exception from LocalConsumer.commit_async: {err}")
+            if(callback):
+                callback(offsets, err)
+            return
+        if(callback):
+            callback(offsets, None)
+
+    def highwater(self, tp) -> int:
+        return self.queue.next_offset
+
+    def position(self, tp) -> int:
+        return self.position_offset
+
+    def close(self) -> None:
+        pass
+
+
+class LocalTransport():
+
+    # LocalTransport - очередь внутри процесса бота вместо kafka: без брокера и лишнего сетевого перехода.
+    # При заданном path очередь хранится ещё и в SQLite
+
+    def __init__(self, maxsize=QUEUE_SIZE, path=None, put_timeout=PUT_TIMEOUT):
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.store = SQLiteStore(path) if path else None
+        self.__queues = {}
+        self.__lock = Lock()
+
+    errors = (QueueFullError,)
+
+    def queue(self, topic) -> LocalQueue:
+        with self.__lock:
+            queue = self.__queues.get(topic)
+            if(queue is None):
+                queue = self.__queues[topic] = LocalQueue(topic, self.maxsize, self.store)
+            return queue
+
+    def producer(self) -> LocalProducer:
+        return LocalProducer(self)
+
+    def consumer(self, max_records=100, group_id=None) -> LocalConsumer:
+        return LocalConsumer(self, max_records)
+
+    def close(self) -> None:
+        if(self.store):
+            self.store.close()
+
+
+def create_transport(name='kafka', bootstrap_servers='localhost:9092', queue_size=QUEUE_SIZE, queue_path='', put_timeout=PUT_TIMEOUT):
+    if(name == 'kafka'):
+        return KafkaTransport([server.strip() for server in bootstrap_servers.split(',') if server.strip()])
+    if(name == 'local'):
+        return LocalTransport(queue_size, queue_path or None, put_timeout)
+    raise ValueError(f"Unknown transport: {name}")